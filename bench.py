@@ -0,0 +1,696 @@
+#!/usr/bin/python2.7
+
+# Copyright 2016 SICS Swedish ICT AB
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+# Microbenchmarks of the hot paths of the monitor: reading the
+# counters, sampling, estimating, building and formatting the meter
+# records, and the sinks. They run offline, on a fake sysfs tree and a
+# fake /proc/net/dev in a temporary directory whose counters are
+# advanced by a synthetic traffic generator, so that they can be
+# compared between computers and between versions of the code.
+#
+# Each benchmark runs an operation a number of times and reports the
+# operations per second, the percentiles of the latency of one
+# operation, and the objects allocated per operation. Python 2 cannot
+# count short-lived allocations, so the latter is the number of
+# objects tracked by the cyclic garbage collector that were created
+# and not freed (gc.get_count() with the collector disabled), i.e. the
+# garbage that eventually causes collector pauses in the sampler.
+#
+# The sample rate benchmark runs a Sampler thread at each requested
+# rate for a while and reports the rate it actually achieved, and the
+# lateness of its ticks (see scheduler.py).
+#
+# The fan-out benchmark sends a command with monconf.py to a number of
+# local stand-ins for the configuration servers of a fleet of
+# monitors, which reply after a delay like a remote monitor would,
+# with each of the requested degrees of parallelism.
+#
+# The results are written as JSON (see --output), and two result
+# files can be compared with --compare.
+#
+#   bench.py                     run all benchmarks
+#   bench.py -b 'sampler.*'      run some of them
+#   bench.py --compare old.json new.json
+
+import os
+import gc
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import select
+import fnmatch
+import heapq
+import platform
+import tempfile
+from Queue import Queue
+from datetime import datetime
+from threading import Thread, Event
+from clock import monotonic
+from counters import SysfsCounterSource, ProcNetDevCounterSource, FakeCounterSource, create_counter_source, EXTRA_COUNTERS
+from sampler import Sampler
+from ceilocomm import CeiloComm
+from meterformat import to_json, encode
+from riskkernel import lognorm_sf_many
+from replay import ReplayGroup
+from monitor import Monitor
+from monconf import fan_out
+from version import __version__
+from utc import UTC
+
+RESULTS_VERSION = 1
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+# Synthetic traffic: log-normally distributed rates around a mean
+# utilisation of the link, for each interface and direction.
+class TrafficGenerator(object):
+    def __init__(self, interfaces, link_speed=1000, utilisation=0.3, sigma=0.5, seed=1):
+        self.interfaces = list(interfaces)
+        self.linerate = link_speed * 1000 * 1000 / 8
+        self.mean = utilisation * self.linerate
+        self.sigma = sigma
+        self.random = random.Random(seed)
+        self.counters = dict((interface, [0, 0]) for interface in self.interfaces)
+
+    # The bytes sent in dt seconds at a random rate.
+    def bytes(self, dt):
+        rate = self.random.lognormvariate(0.0, self.sigma) * self.mean
+        return int(min(rate, self.linerate) * dt)
+
+    # Advance all counters by dt seconds of traffic.
+    def advance(self, dt):
+        for interface in self.interfaces:
+            counters = self.counters[interface]
+            counters[0] += self.bytes(dt)
+            counters[1] += self.bytes(dt)
+
+
+# A fake /sys/class/net and /proc/net/dev with the counters of a
+# traffic generator. The counter files are rewritten in place, since
+# the sysfs counter source keeps them open.
+class FakeCounterTree(object):
+    def __init__(self, traffic):
+        self.traffic = traffic
+        self.root = tempfile.mkdtemp(prefix='ramon-bench-')
+        self.sysfs = os.path.join(self.root, 'class', 'net')
+        self.procnetdev = os.path.join(self.root, 'net_dev')
+        self.fds = []
+        for interface in traffic.interfaces:
+            statistics = os.path.join(self.sysfs, interface, 'statistics')
+            os.makedirs(statistics)
+            for counter in ('tx_bytes', 'rx_bytes'):
+                self.fds.append(os.open(os.path.join(statistics, counter),
+                                        os.O_RDWR | os.O_CREAT, 0644))
+        self.procfd = os.open(self.procnetdev, os.O_RDWR | os.O_CREAT, 0644)
+        self.write()
+        self.stop_event = Event()
+        self.thread = None
+
+    def write(self):
+        lines = ['Inter-|   Receive                                                |  Transmit\n',
+                 ' face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed\n']
+        for i, interface in enumerate(self.traffic.interfaces):
+            tx, rx = self.traffic.counters[interface]
+            os.lseek(self.fds[2 * i], 0, os.SEEK_SET)
+            os.write(self.fds[2 * i], '%20d\n' % tx)
+            os.lseek(self.fds[2 * i + 1], 0, os.SEEK_SET)
+            os.write(self.fds[2 * i + 1], '%20d\n' % rx)
+            lines.append('%6s: %20d 0 0 0 0 0 0 0 %20d 0 0 0 0 0 0 0\n' % (interface, rx, tx))
+        os.lseek(self.procfd, 0, os.SEEK_SET)
+        os.write(self.procfd, ''.join(lines))
+
+    # Advance the traffic and rewrite the counters every interval
+    # seconds in a background thread.
+    def start(self, interval=0.01):
+        def run():
+            while not self.stop_event.wait(interval):
+                self.traffic.advance(interval)
+                self.write()
+        self.thread = Thread(target=run, name='FakeCounterTree')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self.stop()
+        for fd in self.fds + [self.procfd]:
+            os.close(fd)
+        shutil.rmtree(self.root)
+
+
+# The sampler and the monitor report here.
+class Quiet(object):
+    def debugPrint(self, tracestring):
+        pass
+
+
+# The p-th percentile of the sorted values.
+def percentile(values, p):
+    if not values:
+        return 0.0
+    k = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+# Run op n times, calling before (untimed) before each run, and return
+# the operations per second, the latency percentiles (in microseconds)
+# and the objects allocated per operation.
+def measure(op, n, before=None):
+    latencies = [0.0] * n
+    timer = monotonic
+    gc.collect()
+    gc.disable()
+    try:
+        allocated = gc.get_count()[0]
+        for i in xrange(n):
+            if before is not None:
+                before()
+            start = timer()
+            op()
+            latencies[i] = timer() - start
+        allocated = gc.get_count()[0] - allocated
+    finally:
+        gc.enable()
+    total = sum(latencies)
+    latencies.sort()
+    result = {'operations': n,
+              'ops_per_second': n / total if total > 0.0 else 0.0,
+              'gc_objects_per_op': float(allocated) / n}
+    for p in PERCENTILES:
+        result['latency_p%g_us' % p] = percentile(latencies, p) * 1e6
+    result['latency_max_us'] = latencies[-1] * 1e6
+    return result
+
+
+def bench_counters(config, tree):
+    results = {}
+    interfaces = tree.traffic.interfaces
+    sources = [('counters.sysfs', lambda: SysfsCounterSource(interfaces, root=tree.sysfs)),
+               ('counters.procnetdev', lambda: ProcNetDevCounterSource(interfaces, path=tree.procnetdev)),
+               ('counters.procnetdev.extra', lambda: ProcNetDevCounterSource(interfaces, sorted(EXTRA_COUNTERS), path=tree.procnetdev)),
+               ('counters.netlink', lambda: create_counter_source('netlink', ['lo'])),
+               ('counters.netlink.extra', lambda: create_counter_source('netlink', ['lo'], sorted(EXTRA_COUNTERS)))]
+    for name, create in sources:
+        if not selected(config, name):
+            continue
+        try:
+            source = create()
+        except (IOError, OSError, socket.error, ValueError) as e:
+            results[name] = {'skipped': str(e)}
+            continue
+        try:
+            results[name] = measure(source.read, config['operations'])
+            results[name]['interfaces'] = len(source.interfaces)
+        finally:
+            source.close()
+    return results
+
+
+# A sampler on a fake counter source advanced by the traffic
+# generator, one tick of 1 / sample_rate seconds at a time. With
+# extra counters, the packets are advanced by one per 1000 bytes.
+def fake_sampler(traffic, sample_rate, extra=()):
+    clock = [0.0]
+    source = FakeCounterSource(traffic.interfaces, extra, clock=lambda: clock[0])
+    sampler = Sampler(Queue(), sample_rate, Quiet(), interface=traffic.interfaces,
+                      counter_source=source, window_length=1.0)
+    def tick():
+        clock[0] += 1.0 / sample_rate
+        traffic.advance(1.0 / sample_rate)
+        for interface in traffic.interfaces:
+            if 'packets' in source.extra:
+                tx, rx = source.counters[interface]
+                source.advance_extra(interface, 'packets',
+                                     (traffic.counters[interface][0] - tx) // 1000,
+                                     (traffic.counters[interface][1] - rx) // 1000)
+            source.set_counters(interface, *traffic.counters[interface])
+    sampler.start_window(0.0)
+    return sampler, tick
+
+
+def bench_sampler(config, traffic):
+    results = {}
+    if selected(config, 'sampler.sample'):
+        sampler, tick = fake_sampler(traffic, config['sample_rate'])
+        results['sampler.sample'] = measure(sampler.sample, config['operations'], tick)
+        results['sampler.sample']['interfaces'] = len(traffic.interfaces)
+    if selected(config, 'sampler.sample.extra'):
+        sampler, tick = fake_sampler(traffic, config['sample_rate'], sorted(EXTRA_COUNTERS))
+        results['sampler.sample.extra'] = measure(sampler.sample, config['operations'], tick)
+        results['sampler.sample.extra']['interfaces'] = len(traffic.interfaces)
+    if selected(config, 'sampler.end_window'):
+        sampler, tick = fake_sampler(traffic, config['sample_rate'])
+        def end_window():
+            sampler.end_window(sampler.last_data[0])
+        def sample():
+            tick()
+            sampler.sample()
+        results['sampler.end_window'] = measure(end_window, max(1, config['operations'] / 10), sample)
+    return results
+
+
+# A monitor whose windows have been filled from a replay of synthetic
+# traffic. Returns the replay group, the monitor, and a function that
+# sets the counters of the next reading without feeding it.
+def filled_monitor(config, traffic):
+    group = ReplayGroup(traffic.interfaces, config['sample_rate'], 1.0,
+                        {'link_speed': config['link_speed'],
+                         'meter_interval': 1e9,
+                         'cutoffs': [99],
+                         'alarm_triggers': [95],
+                         'horizons': config['horizons']},
+                        [config['estimation_interval']])
+    rate = float(config['sample_rate'])
+    seconds = max([config['estimation_interval']] + config['horizons']) + 1
+    def counters():
+        traffic.advance(1.0 / rate)
+        return ([traffic.counters[i][0] for i in traffic.interfaces],
+                [traffic.counters[i][1] for i in traffic.interfaces])
+    for k in xrange(int(seconds * rate)):
+        tx, rx = counters()
+        group.feed(k / rate, tx, rx)
+    def step():
+        tx, rx = counters()
+        group.clock.now += 1.0 / rate
+        group.set_counters(tx, rx)
+    return group, group.monitors[0], step
+
+
+def bench_monitor(config, traffic):
+    results = {}
+    names = ['monitor.collect', 'monitor.estimate', 'monitor.meter_records',
+             'risk.lognorm_sf_many', 'format.json', 'format.binary']
+    if not [name for name in names if selected(config, name)]:
+        return results
+    group, monitor, step = filled_monitor(config, traffic)
+    sampler = group.sampler
+    n = config['operations']
+    if selected(config, 'monitor.collect'):
+        # One slot published and collected per operation.
+        def publish():
+            step()
+            sampler.sample()
+            sampler.end_window(sampler.last_data[0])
+        results['monitor.collect'] = measure(lambda: monitor.collect(sampler), max(1, n / 10), publish)
+    if selected(config, 'monitor.estimate'):
+        results['monitor.estimate'] = measure(lambda: Monitor.estimate(monitor, sampler), max(1, n / 10))
+    now = datetime.now(tz=UTC())
+    if selected(config, 'monitor.meter_records'):
+        results['monitor.meter_records'] = measure(lambda: monitor.meter_records(now), n)
+    if selected(config, 'risk.lognorm_sf_many'):
+        estimates = monitor.estimates
+        cutoff_rates = [est.linerate * monitor.cutoff for est in estimates]
+        mus = [est.mu_tx for est in estimates]
+        sigma2s = [est.sigma2_tx for est in estimates]
+        results['risk.lognorm_sf_many'] = measure(lambda: lognorm_sf_many(cutoff_rates, mus, sigma2s), n)
+    record = monitor.meter_records(now)[0]
+    if selected(config, 'format.json'):
+        results['format.json'] = measure(lambda: json.dumps(to_json(record)) + '\n', n)
+        results['format.json']['bytes'] = len(json.dumps(to_json(record)) + '\n')
+    if selected(config, 'format.binary'):
+        results['format.binary'] = measure(lambda: encode(record), n)
+        results['format.binary']['bytes'] = len(encode(record))
+    return results
+
+
+# A local socket that reads and discards everything sent to it.
+# Returns its address and a function that stops it.
+def drain_server():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    def run():
+        conn, addr = server.accept()
+        while conn.recv(1 << 16):
+            pass
+        conn.close()
+    thread = Thread(target=run, name='BenchDrain')
+    thread.setDaemon(True)
+    thread.start()
+    return server.getsockname(), server.close
+
+
+# A local HTTP server standing in for Ceilometer. Returns its address
+# and a function that stops it.
+def ceilometer_stub():
+    import BaseHTTPServer
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.getheader('content-length', 0)))
+            body = '[]'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = Thread(target=server.serve_forever, name='BenchCeilometer')
+    thread.setDaemon(True)
+    thread.start()
+    def stop():
+        server.shutdown()
+        server.server_close()
+    return server.server_address, stop
+
+
+def bench_sinks(config, traffic, tmpdir):
+    results = {}
+    names = ['sink.file.json', 'sink.file.binary', 'sink.port.json', 'sink.ceilometer']
+    if not [name for name in names if selected(config, name)]:
+        return results
+    group, monitor, step = filled_monitor(config, traffic)
+    record = monitor.meter_records(datetime.now(tz=UTC()))[0]
+    n = config['operations']
+    for name in names:
+        if not selected(config, name):
+            continue
+        stop = None
+        try:
+            if name.startswith('sink.file'):
+                comm = CeiloComm(None, None, file_name=os.path.join(tmpdir, name),
+                                 meter_format=name.split('.')[-1])
+            elif name == 'sink.port.json':
+                address, stop = drain_server()
+                comm = CeiloComm(None, None, host_and_port=address, backlog=n)
+            else:
+                try:
+                    import requests
+                except ImportError as e:
+                    results[name] = {'skipped': str(e)}
+                    continue
+                (host, port), stop = ceilometer_stub()
+                comm = CeiloComm('resource', 'project',
+                                 meterURL='http://%s:%d/v2/meters' % (host, port),
+                                 authURL='http://%s:%d/v2.0/tokens' % (host, port),
+                                 batch_size=config['batch_size'])
+            start = monotonic()
+            results[name] = measure(lambda: comm.putMeter('bench', record, 'token'), n)
+            # The sinks write in the background; include the time to
+            # finish writing.
+            comm.close()
+            results[name]['drained_per_second'] = n / (monotonic() - start)
+        finally:
+            if stop is not None:
+                stop()
+    return results
+
+
+# Stand-ins for the configuration servers of count monitors, all on
+# 127.0.0.1 and served by one thread, which reply to each command
+# line after delay seconds. Returns their (host, port) addresses and a
+# function that stops them.
+def confserver_stubs(count, delay):
+    listeners = {}
+    for i in range(count):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(128)
+        listeners[server.fileno()] = server
+    addresses = [server.getsockname() for server in listeners.values()]
+    stopping = Event()
+
+    def run():
+        connections = {}        # fileno -> (socket, buffered data)
+        due = []                # heap of (time, fileno, reply)
+        poller = select.poll()
+        for fd in listeners:
+            poller.register(fd, select.POLLIN)
+        while not stopping.is_set():
+            timeout = 100
+            if due:
+                timeout = max(0, min(timeout, int((due[0][0] - time.time()) * 1000) + 1))
+            for fd, event in poller.poll(timeout):
+                if fd in listeners:
+                    conn, addr = listeners[fd].accept()
+                    connections[conn.fileno()] = [conn, '']
+                    poller.register(conn.fileno(), select.POLLIN)
+                elif fd in connections:
+                    conn, data = connections[fd]
+                    chunk = conn.recv(4096)
+                    if not chunk:
+                        poller.unregister(fd)
+                        conn.close()
+                        del connections[fd]
+                        continue
+                    data += chunk
+                    while '\n' in data:
+                        line, data = data.split('\n', 1)
+                        request = json.loads(line)
+                        reply = {'return': dict((name, 'ok') for name in request if name != 'id')}
+                        if 'id' in request:
+                            reply['id'] = request['id']
+                        heapq.heappush(due, (time.time() + delay, fd, json.dumps(reply) + '\n'))
+                    connections[fd][1] = data
+            now = time.time()
+            while due and due[0][0] <= now:
+                when, fd, reply = heapq.heappop(due)
+                if fd in connections:
+                    connections[fd][0].sendall(reply)
+        for conn, data in connections.values():
+            conn.close()
+
+    thread = Thread(target=run, name='BenchConfServers')
+    thread.setDaemon(True)
+    thread.start()
+
+    def stop():
+        stopping.set()
+        thread.join()
+        for server in listeners.values():
+            server.close()
+    return addresses, stop
+
+
+# Send a command to the stand-ins of a fleet of monitors with each of
+# the requested degrees of parallelism, as 'monconf.py --hosts' does.
+def bench_fanout(config):
+    results = {}
+    if not selected(config, 'monconf.fanout.*'):
+        return results
+    addresses, stop = confserver_stubs(config['fanout_hosts'], config['fanout_delay'])
+    try:
+        for parallel in config['fanout_parallel']:
+            name = 'monconf.fanout.%d' % parallel
+            if not selected(config, name):
+                continue
+            start = monotonic()
+            replies = fan_out(addresses, {'sample_rate': 500}, parallel=parallel, timeout=30.0)
+            seconds = monotonic() - start
+            results[name] = {'hosts': len(addresses),
+                             'parallel': parallel,
+                             'reply_delay_ms': config['fanout_delay'] * 1000,
+                             'seconds': seconds,
+                             'hosts_per_second': len(addresses) / seconds,
+                             'failed': sum(1 for reply in replies if reply[3] is not None)}
+    finally:
+        stop()
+    return results
+
+
+# Run a sampler thread on the fake sysfs tree at each of the requested
+# rates, and report the rate it achieved and the lateness of its ticks.
+def bench_sample_rates(config, tree):
+    results = {}
+    if not selected(config, 'sampler.rate.*'):
+        return results
+    tree.start()
+    try:
+        for rate in config['rates']:
+            name = 'sampler.rate.%d' % rate
+            if not selected(config, name):
+                continue
+            source = SysfsCounterSource(tree.traffic.interfaces, root=tree.sysfs)
+            inq = Queue()
+            sampler = Sampler(inq, rate, Quiet(), interface=tree.traffic.interfaces,
+                              counter_source=source, window_length=1.0)
+            sampler.start()
+            time.sleep(config['duration'])
+            stats = sampler.scheduler.stats()
+            inq.put('stop')
+            sampler.request_event.set()
+            sampler.join()
+            sampler.close()
+            results[name] = {'requested_rate': rate,
+                             'achieved_rate': stats['achieved_rate'],
+                             'ticks': stats['ticks'],
+                             'skipped_ticks': stats['skipped'],
+                             'mean_lateness_us': stats['mean_lateness'] * 1e6,
+                             'max_lateness_us': stats['max_lateness'] * 1e6,
+                             'interfaces': len(tree.traffic.interfaces)}
+    finally:
+        tree.stop()
+    return results
+
+
+def selected(config, name):
+    patterns = config['benchmarks']
+    if not patterns:
+        return True
+    for pattern in patterns:
+        if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(pattern, name):
+            return True
+    return False
+
+
+def run(config):
+    interfaces = ['bench%d' % i for i in range(config['interfaces'])]
+    traffic = TrafficGenerator(interfaces, link_speed=config['link_speed'])
+    tree = FakeCounterTree(traffic)
+    results = {}
+    try:
+        results.update(bench_counters(config, tree))
+        results.update(bench_sampler(config, traffic))
+        results.update(bench_monitor(config, traffic))
+        results.update(bench_sinks(config, traffic, tree.root))
+        results.update(bench_sample_rates(config, tree))
+        results.update(bench_fanout(config))
+    finally:
+        tree.close()
+    return {'results_version': RESULTS_VERSION,
+            'timestamp': datetime.now(tz=UTC()).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'monitor_version': __version__,
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'hostname': socket.gethostname(),
+            'config': config,
+            'results': results}
+
+
+def print_results(run_results):
+    results = run_results['results']
+    print("%-24s %12s %9s %9s %9s %9s %8s" % ('benchmark', 'ops/s', 'p50 us', 'p90 us', 'p99 us', 'max us', 'gc/op'))
+    for name in sorted(results):
+        result = results[name]
+        if 'skipped' in result:
+            print("%-24s skipped: %s" % (name, result['skipped']))
+        elif 'requested_rate' in result:
+            print("%-24s achieved %.1f of %d samples/s, lateness mean %.1f us, max %.1f us, %d skipped" % (
+                name, result['achieved_rate'], result['requested_rate'],
+                result['mean_lateness_us'], result['max_lateness_us'], result['skipped_ticks']))
+        elif 'hosts_per_second' in result:
+            print("%-24s %d monitors %d at a time in %.3f s, %.0f monitors/s, %d failed" % (
+                name, result['hosts'], result['parallel'], result['seconds'],
+                result['hosts_per_second'], result['failed']))
+        else:
+            print("%-24s %12.0f %9.1f %9.1f %9.1f %9.1f %8.2f" % (
+                name, result['ops_per_second'], result['latency_p50_us'],
+                result['latency_p90_us'], result['latency_p99_us'],
+                result['latency_max_us'], result['gc_objects_per_op']))
+
+
+# Compare two result files: the throughput (or achieved rate) of the
+# second relative to the first.
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)['results']
+    with open(new_path) as f:
+        new = json.load(f)['results']
+    print("%-24s %12s %12s %8s %10s %10s" % ('benchmark', 'old ops/s', 'new ops/s', 'ratio', 'old p99', 'new p99'))
+    for name in sorted(set(old) & set(new)):
+        a = old[name]
+        b = new[name]
+        if 'skipped' in a or 'skipped' in b:
+            continue
+        if 'achieved_rate' in a:
+            key = 'achieved_rate'
+        elif 'hosts_per_second' in a:
+            key = 'hosts_per_second'
+        else:
+            key = 'ops_per_second'
+        ratio = b[key] / a[key] if a[key] else 0.0
+        print("%-24s %12.0f %12.0f %7.2fx %10.1f %10.1f" % (
+            name, a[key], b[key], ratio,
+            a.get('latency_p99_us', a.get('max_lateness_us', 0.0)),
+            b.get('latency_p99_us', b.get('max_lateness_us', 0.0))))
+    for name in sorted(set(old) ^ set(new)):
+        print("%-24s only in %s" % (name, old_path if name in old else new_path))
+
+
+def int_list(value):
+    return [int(x) for x in value.split(',') if x.strip()]
+
+
+def float_list(value):
+    return [float(x) for x in value.split(',') if x.strip()]
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths of the rate monitor')
+    parser.add_argument('-b', "--benchmarks", help='The benchmarks to run, as a comma separated list of names or patterns, e.g. "sampler.*,format.*"; default all', default='')
+    parser.add_argument('-n', "--operations", help='The number of operations per benchmark; default 20000', type=int, default=20000)
+    parser.add_argument('-i', "--interfaces", help='The number of fake interfaces; default 4', type=int, default=4)
+    parser.add_argument('-s', "--sample_rate", help='The sample rate of the sampler and monitor benchmarks; default 1000', type=int, default=1000)
+    parser.add_argument('-e', "--estimation_interval", help='The estimation interval of the monitor benchmarks; default 10 seconds', type=float, default=10.0)
+    parser.add_argument('-H', "--horizons", help='Additional horizons of the monitor benchmarks, as a comma separated list; default 60', type=float_list, default=[60.0])
+    parser.add_argument('-k', "--link_speed", help='The link speed of the fake interfaces (in Mbits per second); default 1000', type=int, default=1000)
+    parser.add_argument("--batch_size", help='The batch size of the Ceilometer sink benchmark; default 100', type=int, default=100)
+    parser.add_argument("--rates", help='The sample rates to try with the sample rate benchmark, as a comma separated list; default 1000,5000,10000', type=int_list, default=[1000, 5000, 10000])
+    parser.add_argument("--duration", help='How long to run the sampler at each rate (in seconds); default 3', type=float, default=3.0)
+    parser.add_argument("--fanout_hosts", help='The number of stand-in monitors of the fan-out benchmark; default 200', type=int, default=200)
+    parser.add_argument("--fanout_delay", help='The time (in seconds) a stand-in monitor takes to reply; default 0.01', type=float, default=0.01)
+    parser.add_argument("--fanout_parallel", help='The numbers of monitors to configure at the same time in the fan-out benchmark, as a comma separated list; default 1,16,64', type=int_list, default=[1, 16, 64])
+    parser.add_argument('-o', "--output", help='Write the results as JSON to this file; default bench-<time>.json, - for stdout only')
+    parser.add_argument("--compare", help='Compare two result files instead of running the benchmarks', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    config = {'benchmarks': [b.strip() for b in args.benchmarks.split(',') if b.strip()],
+              'operations': args.operations,
+              'interfaces': args.interfaces,
+              'sample_rate': args.sample_rate,
+              'estimation_interval': args.estimation_interval,
+              'horizons': args.horizons,
+              'link_speed': args.link_speed,
+              'batch_size': args.batch_size,
+              'rates': args.rates,
+              'duration': args.duration,
+              'fanout_hosts': args.fanout_hosts,
+              'fanout_delay': args.fanout_delay,
+              'fanout_parallel': args.fanout_parallel}
+    run_results = run(config)
+    print_results(run_results)
+    output = args.output
+    if output is None:
+        output = 'bench-' + time.strftime('%Y-%m-%dT%H_%M_%S') + '.json'
+    if output == '-':
+        print(json.dumps(run_results, indent=4, sort_keys=True))
+    else:
+        with open(output, 'w') as f:
+            json.dump(run_results, f, indent=4, sort_keys=True)
+        print("Results written to " + output)
+
+
+if __name__ == '__main__':
+    main()
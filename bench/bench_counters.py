@@ -0,0 +1,90 @@
+#!/usr/bin/python2.7
+
+# Copyright 2016 SICS Swedish ICT AB
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measure the counter sources in counters.py: system calls per sample
+# and the maximum sample rate each source can sustain when reading
+# back to back, i.e. an upper bound for the sample rate of the Sampler.
+#
+# Example:
+#     bench/bench_counters.py -i eth0,lo -t 2
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from counters import create_counter_source, COUNTER_SOURCES
+
+
+def bench_source(kind, interfaces, duration):
+    try:
+        source = create_counter_source(kind, interfaces)
+    except Exception as e:
+        return {'source': kind, 'error': str(e)}
+    try:
+        reads = 0
+        start = time.time()
+        stop = start + duration
+        now = start
+        while now < stop:
+            source.read()
+            reads += 1
+            if reads % 64 == 0:
+                now = time.time()
+        elapsed = time.time() - start
+        return {'source': kind,
+                'interfaces': len(interfaces),
+                'reads': reads,
+                'max_sample_rate': reads / elapsed,
+                'usec_per_read': 1e6 * elapsed / reads,
+                'syscalls_per_read': source.syscalls_per_read(len(interfaces))}
+    finally:
+        source.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Counter source benchmark")
+    parser.add_argument('-i', "--interface", help='Comma separated interfaces to read; default all in /proc/net/dev', default=None)
+    parser.add_argument('-t', "--time", help='Seconds to run each source; default 2', type=float, default=2.0)
+    parser.add_argument("--sources", help='Comma separated sources; default netlink,procnetdev,sysfs', default='netlink,procnetdev,sysfs')
+    args = parser.parse_args()
+
+    if args.interface is None:
+        interfaces = sorted(os.listdir('/sys/class/net'))
+    else:
+        interfaces = args.interface.split(',')
+
+    print("interfaces: %s" % ','.join(interfaces))
+    print("%-12s %14s %12s %10s" % ('source', 'max rate (/s)', 'usec/read', 'syscalls'))
+    for kind in args.sources.split(','):
+        if kind not in COUNTER_SOURCES:
+            print("%-12s unknown source" % kind)
+            continue
+        result = bench_source(kind, interfaces, args.time)
+        if 'error' in result:
+            print("%-12s unavailable: %s" % (kind, result['error']))
+        else:
+            print("%-12s %14.0f %12.2f %10s" % (kind, result['max_sample_rate'],
+                                                result['usec_per_read'],
+                                                result['syscalls_per_read']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/python2.7
+
+# Copyright 2016 SICS Swedish ICT AB
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compare start-up time and resident memory of importing the monitor
+# with the imports it used to do at module load (scipy.stats, requests
+# and sh), each in a fresh interpreter.
+#
+# Example:
+#     bench/bench_startup.py -n 10
+
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+CASES = [
+    ('python', 'pass'),
+    ('monitor', 'import monitor'),
+    ('monitor + riskkernel', 'import monitor, riskkernel; riskkernel.lognorm_sf(1e6, 10.0, 1.0)'),
+    ('scipy.stats', 'import scipy.stats'),
+    ('requests', 'import requests'),
+    ('sh', 'import sh'),
+    ('old module load', 'import scipy.stats, requests, sh; import monitor'),
+]
+
+# Runs in the child; prints the peak RSS in kB after the statement.
+CHILD = '''
+import sys, resource
+sys.path.insert(0, %r)
+%s
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+
+def run_case(statement, runs):
+    times = []
+    rss = []
+    for i in range(runs):
+        start = time.time()
+        p = subprocess.Popen([sys.executable, '-c', CHILD % (TOP, statement)],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        elapsed = time.time() - start
+        if p.returncode != 0:
+            return None, err.strip().splitlines()[-1]
+        times.append(elapsed)
+        rss.append(int(out.strip().splitlines()[-1]))
+    times.sort()
+    rss.sort()
+    return (times[len(times) // 2], rss[len(rss) // 2]), None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Start-up time and RSS of the monitor imports")
+    parser.add_argument('-n', "--runs", help='Runs per case; default 5', type=int, default=5)
+    args = parser.parse_args()
+
+    print("%-24s %12s %12s" % ('imports', 'median ms', 'max RSS kB'))
+    for name, statement in CASES:
+        result, error = run_case(statement, args.runs)
+        if result is None:
+            print("%-24s unavailable: %s" % (name, error))
+        else:
+            print("%-24s %12.1f %12d" % (name, 1000 * result[0], result[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -12,13 +12,56 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import requests
 import json
-import socket
+import time
 from datetime import datetime
+from threading import Thread, Event, Lock, local
 from utc import UTC
+from sinks import StreamSink, FileSink
+from meterformat import to_json, encode
 #import pdb
 
+# NOTE: requests is imported by the methods that talk to Keystone and
+# Ceilometer, so that it is not loaded at all in mode 1.
+
+# Refresh the authorization token this many seconds before it expires.
+TOKEN_REFRESH_MARGIN = 300
+
+# A batch that could not be posted is tried again this many times,
+# with a delay from BATCH_MIN_BACKOFF doubling up to BATCH_MAX_BACKOFF
+# seconds, before its samples are dropped.
+BATCH_RETRIES = 5
+BATCH_MIN_BACKOFF = 0.5
+BATCH_MAX_BACKOFF = 30.0
+
+# When closing, wait at most this many seconds for the batch thread to
+# finish the post it is making.
+BATCH_CLOSE_TIMEOUT = 5.0
+
+# Convert the expiration time of a Keystone token to a datetime in UTC.
+def token_expiry(authexpstr):
+    if authexpstr[-1] == 'Z':
+        authexpstr = authexpstr[0:-1] # remove the Z
+    if '.' in authexpstr:
+        authexpstr = authexpstr[0:authexpstr.index('.')] # remove fractions of a second
+    return datetime.strptime(authexpstr,'%Y-%m-%dT%H:%M:%S').replace(tzinfo=UTC())
+
+
+# Data for Ceilometer is sent over HTTP sessions, which keep their
+# connections alive between requests. A requests Session is not
+# thread-safe, so each thread (the exporter, the batch thread and the
+# token refresh) has its own. The samples of putMeter are
+# coalesced into batches of at most batch_size samples, and a batch is
+# posted when it is full or when its oldest sample is batch_delay
+# seconds old, whichever comes first. (The v2 meters API takes a list
+# of samples in one POST.) With batch_size 1 every sample is posted at
+# once.
+# A batch that cannot be posted is kept and tried again by the batch
+# thread (see retryLater), and its samples are counted as dropped
+# when it has failed BATCH_RETRIES more times.
+#
+# The authorization token is refreshed in the background (see
+# startTokenRefresh), so that putMeter never waits for Keystone.
 class CeiloComm():
     def __init__(self,
                  resource_id,
@@ -30,8 +73,23 @@ class CeiloComm():
                                  # written to a file instead of to Ceilometer
 #                 port_number=None  # if this is not None meter data will be
 #		                 # written to a port instead of to Ceilometer
-                 host_and_port=None  # if this is not None meter data will be
-		                 # written to a port instead of to Ceilometer
+                 host_and_port=None,  # if this is not None meter data will be
+		                 # written to a port instead of to Ceilometer;
+                                 # (host, port), or the path of a Unix
+                                 # domain socket
+                 socket_type='stream', # 'stream' or 'dgram'
+                 backlog=1000,  # meter data waiting to be written to the port
+                 backlog_policy='drop-oldest', # or 'block'
+                 batch_size=100,
+                 batch_delay=1.0,
+                 flush_size=65536, # bytes written to the file between flushes
+                 flush_interval=1.0, # longest time (in seconds) data
+                                     # waits to be flushed to the file
+                 fsync='never', # or 'flush' or 'rotate'
+                 rotate_size=0, # rotate the file at this size (in bytes)
+                 rotate_interval=0, # or every this many seconds
+                 compress='none', # or 'gzip' or 'zstd'
+                 meter_format='json' # or 'binary', for the file and port
                  ):
         self.resource_id=resource_id
         self.project_id=project_id
@@ -42,8 +100,52 @@ class CeiloComm():
             self.authURL=authURL
         if file_name is None and host_and_port is None and meterURL is None:
             self.meterURL = 'http://' + controller + ':8777/v2/meters'
+        else:
+            self.meterURL=meterURL
+        self.meter_format = meter_format
         self.file_name = file_name
+        if file_name is not None:
+            self.file_sink = FileSink(file_name, flush_size=flush_size,
+                                      flush_interval=flush_interval,
+                                      fsync=fsync, rotate_size=rotate_size,
+                                      rotate_interval=rotate_interval,
+                                      compress=compress)
+        else:
+            self.file_sink = None
         self.host_and_port = host_and_port
+        if host_and_port is not None:
+            self.stream_sink = StreamSink(host_and_port, socket_type=socket_type,
+                                          backlog=backlog, policy=backlog_policy)
+        else:
+            self.stream_sink = None
+        self.sessions = local()     # the session of each thread
+        self.all_sessions = []      # the sessions of all threads
+        self.session_lock = Lock()
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.batches = {}       # metername -> (time of first sample, samples)
+        self.failed_batches = [] # (metername, samples, attempts, time of next attempt)
+        self.dropped_samples = 0
+        self.batch_lock = Lock()
+        self.batch_thread = None
+        self.authtoken = None
+        self.authexptime = None
+        self.token_thread = None
+        self.closing = Event()
+        self.post_errors = 0
+
+
+    # The HTTP session of the calling thread, for its requests to
+    # Keystone and Ceilometer.
+    def getSession(self):
+        session = getattr(self.sessions, 'session', None)
+        if session is None:
+            import requests
+            session = requests.Session()
+            self.sessions.session = session
+            with self.session_lock:
+                self.all_sessions.append(session)
+        return session
 
 
     # Get authorization token data from Keystone and return the token together with its expiration date/time
@@ -55,9 +157,10 @@ class CeiloComm():
             return {'tok': 'dummy',
                     'exp': datetime.strftime(datetime.max.replace(tzinfo=UTC()),'%Y-%m-%dT%H:%M:%SZ')}
         else:
+            import requests
             headers = {'Content-Type': 'application/json'}
             payload = {'auth': {'tenantName': tenantname, 'passwordCredentials': {'username': username, 'password': password}}}
-            response = requests.post(self.authURL, data=json.dumps(payload), headers=headers)
+            response = self.getSession().post(self.authURL, data=json.dumps(payload), headers=headers)
             if response.status_code == requests.codes.ok:
                 return {'tok': response.json().get('access').get('token').get('id'),
                         'exp': response.json().get('access').get('token').get('expires')}
@@ -66,11 +169,12 @@ class CeiloComm():
 
     # Get metering data from Ceilometer.
     def getMeter(self,metername,timestart,authtoken):
+        import requests
 #curl -X GET -H "X-Auth-Token: 806f3ea653324082ac0d2bca2ab34ae5" -H "Content-Type: application/json" -d '{"q": [{"field": "timestamp", "op": "ge", "value": "2014-04-01T13:34:17"}]}' http://10.0.0.11:8777/v2/meters/test
         headers = {'X-Auth-Token': authtoken, 'Content-Type': 'application/json'}
         payload = {'q': [{'field': 'timestamp', 'op': 'ge', 'value': timestart}]}
         url = self.meterURL + '/' + metername
-        response = requests.get(url, data = json.dumps(payload), headers=headers)
+        response = self.getSession().get(url, data = json.dumps(payload), headers=headers)
         if response.status_code == requests.codes.ok:
             return response.json()
         else:
@@ -86,43 +190,224 @@ class CeiloComm():
     def printMeter(self,metername,timestart,authtoken):
         print(json.dumps(self.getMeter(metername,timestart,authtoken),indent=4))
 
+    # Get an authorization token, and keep it fresh by getting a new
+    # one in a background thread margin seconds before it expires. If
+    # getting a new token fails, it is retried with an increasing
+    # delay, while the old token is used.
+    def startTokenRefresh(self,tenantname='admin',username='admin',password='',margin=TOKEN_REFRESH_MARGIN):
+        self.refreshToken(tenantname,username,password)
+        if self.file_name is not None or self.host_and_port is not None:
+            return # the dummy token never expires
+        self.token_thread = Thread(target=self.tokenRefreshLoop,
+                                   args=(tenantname,username,password,margin),
+                                   name='TokenRefresh')
+        self.token_thread.setDaemon(True)
+        self.token_thread.start()
+
+    def refreshToken(self,tenantname,username,password):
+        authtokenpair = self.getAuthToken(tenantname=tenantname,username=username,password=password)
+        self.authexptime = token_expiry(authtokenpair.get('exp'))
+        self.authtoken = authtokenpair.get('tok')
+
+    def tokenRefreshLoop(self,tenantname,username,password,margin):
+        retry_delay = 1.0
+        while not self.closing.is_set():
+            now = datetime.now(tz=UTC())
+            remaining = self.authexptime - now
+            wait = remaining.days * 86400 + remaining.seconds - margin
+            if wait > 0:
+                self.closing.wait(wait)
+                continue
+            try:
+                self.refreshToken(tenantname,username,password)
+                retry_delay = 1.0
+            except Exception as e:
+                print("Could not refresh the authorization token: " + str(e))
+                self.closing.wait(retry_delay)
+                retry_delay = min(2 * retry_delay, 60.0)
+
+    # The current authorization token.
+    def authToken(self):
+        return self.authtoken
+
     # Store metering data in Ceilometer.
     # If self.file_name is not None, append the metering data to a
     # file with that name instead of storing it in Ceilometer.
-    # If self.port_number is not None, write the metering data to a
+    # If self.host_and_port is not None, write the metering data to a
     # port with that number instead of storing it in Ceilometer.
-    def putMeter(self,metername,data,authtoken,username='admin',project_id=None,resource_id=None):
+    # The data is a record of plain values (see meterformat.py), which
+    # is written to the file or port in self.meter_format, and stored
+    # in Ceilometer in its JSON shape.
+    # A sample for Ceilometer is added to the batch of its meter, and
+    # the batch is posted when it is full; the sample is returned. A
+    # full batch that cannot be posted is kept to be tried again by
+    # the batch thread, so the sample is not lost.
+    def putMeter(self,metername,data,authtoken=None,username='admin',project_id=None,resource_id=None):
 #curl -X POST -H 'X-Auth-Token: TOKEN' -H 'Content-Type: application/json'   -d '[{"counter_name": "test","user_id": "admin","resource_id": "76799085-e0ff-4620-9b7f-120d3c51cc49","resource_metadata": {"display_name": "my_test","my_custom_metadata_1": "value1","my_custom_metadata_2": "value2"},"counter_unit": "b/s","counter_volume": 117,"project_id": "855f014353ec48d98ef7b887fc6980e1","counter_type": "gauge"}]'  http://controller:8777/v2/meters/test
         if self.file_name is not None: # Append to file
-            with open(self.file_name, "a") as meterfile:
-                meterfile.write(json.dumps(data) + '\n')
+            # The file sink keeps the file open, and buffers the data.
+            self.file_sink.send(self.format(data))
             return data
         if self.host_and_port is not None: # write to port
-            self.meter_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.meter_socket.connect(self.host_and_port)
-            self.meter_socket.send(bytes(json.dumps(data) + '\n'))
+            # The stream sink keeps the connection open, and sends the
+            # data in the background.
+            self.stream_sink.send(self.format(data))
             return data
-        if self.file_name is None and self.port_number is None: # Write to ceilometer
-            if project_id is None:
-                project_id = self.project_id
-            if resource_id is None:
-                resource_id = self.resource_id
-            headers = {'X-Auth-Token': authtoken, 'Content-Type': 'application/json'}
-            datad = {
-                'project_id': project_id,
-                'counter_type': 'gauge',
-                'counter_volume': 4711, # Just some random value. All relevant data is in the resource_metadata field.
-                'resource_id': resource_id,
-                'counter_unit': 'b/s',
-                'user_id': username,
-                'resource_metadata': data,
-                'counter_name': metername # Should be the same as the meter name at the end of the URL
-            }
-            payload = [ datad ]
-            url = self.meterURL + '/' + metername
-            response = requests.post(url, data = json.dumps(payload), headers=headers)
+        # Write to ceilometer
+        if project_id is None:
+            project_id = self.project_id
+        if resource_id is None:
+            resource_id = self.resource_id
+        datad = {
+            'project_id': project_id,
+            'counter_type': 'gauge',
+            'counter_volume': 4711, # Just some random value. All relevant data is in the resource_metadata field.
+            'resource_id': resource_id,
+            'counter_unit': 'b/s',
+            'user_id': username,
+            'resource_metadata': to_json(data),
+            'counter_name': metername # Should be the same as the meter name at the end of the URL
+        }
+        if self.batch_size <= 1:
+            self.postSamples(metername,[datad],authtoken)
+            return datad
+        with self.batch_lock:
+            batch = self.batches.get(metername)
+            if batch is None:
+                batch = (time.time(),[])
+                self.batches[metername] = batch
+            batch[1].append(datad)
+            full = len(batch[1]) >= self.batch_size
+            if full:
+                del self.batches[metername]
+        if full:
+            try:
+                self.postSamples(metername,batch[1],authtoken)
+            except Exception as e:
+                self.retryLater(metername,batch[1],e)
+        self.startBatchThread()
+        return datad
+
+    # A record as written to the file or port: a JSON line, or a
+    # binary frame.
+    def format(self,data):
+        if self.meter_format == 'binary':
+            return encode(data)
+        return json.dumps(to_json(data)) + '\n'
+
+    # Post a list of samples to Ceilometer in one request.
+    def postSamples(self,metername,samples,authtoken=None):
+        import requests
+        if authtoken is None:
+            authtoken = self.authtoken
+        headers = {'X-Auth-Token': authtoken, 'Content-Type': 'application/json'}
+        url = self.meterURL + '/' + metername
+        try:
+            response = self.getSession().post(url, data = json.dumps(samples), headers=headers)
             if response.status_code == requests.codes.ok:
                 return response.json()
             else:
                 print(json.dumps(response.json(),indent=4))
                 response.raise_for_status()
+        except Exception:
+            self.post_errors += 1
+            raise
+
+    # Post the batches that are older than max_age seconds (all
+    # batches by default). A batch that cannot be posted is kept to be
+    # tried again.
+    def flush(self,max_age=0.0):
+        now = time.time()
+        with self.batch_lock:
+            due = [(metername,batch) for metername,batch in self.batches.items()
+                   if now - batch[0] >= max_age]
+            for metername,batch in due:
+                del self.batches[metername]
+        for metername,batch in due:
+            try:
+                self.postSamples(metername,batch[1])
+            except Exception as e:
+                self.retryLater(metername,batch[1],e)
+
+    # Keep a batch that could not be posted (after attempts earlier
+    # tries) to be tried again after a delay, or drop and count its
+    # samples when it has been tried BATCH_RETRIES times, or when this
+    # was the last try.
+    def retryLater(self,metername,samples,error,attempts=0,last=False):
+        print("Could not post meter data to Ceilometer: " + str(error))
+        attempts += 1
+        with self.batch_lock:
+            if attempts > BATCH_RETRIES or last:
+                print("Dropping " + str(len(samples)) + " samples of " + metername)
+                self.dropped_samples += len(samples)
+                return
+            backoff = min(BATCH_MIN_BACKOFF * 2 ** (attempts - 1), BATCH_MAX_BACKOFF)
+            self.failed_batches.append((metername,samples,attempts,time.time() + backoff))
+
+    # Post the failed batches that are due to be tried again (all of
+    # them with force, as the last try when closing).
+    def retryFailed(self,force=False):
+        now = time.time()
+        with self.batch_lock:
+            due = [entry for entry in self.failed_batches if force or now >= entry[3]]
+            self.failed_batches = [entry for entry in self.failed_batches
+                                   if not (force or now >= entry[3])]
+        for metername,samples,attempts,next_attempt in due:
+            try:
+                self.postSamples(metername,samples)
+            except Exception as e:
+                self.retryLater(metername,samples,e,attempts,last=force)
+
+    def startBatchThread(self):
+        if self.batch_thread is None:
+            self.batch_thread = Thread(target=self.batchLoop,name='CeiloBatch')
+            self.batch_thread.setDaemon(True)
+            self.batch_thread.start()
+
+    # Post the batches that have waited batch_delay seconds, and try
+    # the failed batches again.
+    def batchLoop(self):
+        while not self.closing.is_set():
+            self.closing.wait(self.batch_delay / 4.0)
+            self.flush(self.batch_delay)
+            self.retryFailed()
+
+    # The statistics of the sinks in use. errors is the total number
+    # of errors of all sinks: failed posts to Ceilometer, lost
+    # connections of the port, and failed compressions of the file.
+    def stats(self):
+        stats = {'errors': self.post_errors}
+        if self.file_sink is not None:
+            stats['file'] = self.file_sink.stats()
+            stats['errors'] += stats['file']['errors']
+        if self.stream_sink is not None:
+            stats['port'] = self.stream_sink.stats()
+            stats['errors'] += stats['port']['errors']
+        if self.file_name is None and self.host_and_port is None:
+            with self.batch_lock:
+                pending = sum([len(entry[1]) for entry in self.failed_batches])
+            stats['ceilometer'] = {'post_errors': self.post_errors,
+                                   'retry_samples': pending,
+                                   'dropped_samples': self.dropped_samples}
+        return stats
+
+    # Stop the background threads, then post what is left in the
+    # batches, trying the failed batches one last time, and close the
+    # sessions. The batch thread is waited for, so that a post it is
+    # making is not cut off by its session being closed.
+    def close(self):
+        self.closing.set()
+        if self.batch_thread is not None:
+            self.batch_thread.join(BATCH_CLOSE_TIMEOUT)
+        if self.file_sink is not None:
+            self.file_sink.close()
+        if self.stream_sink is not None:
+            self.stream_sink.close()
+        if self.file_name is None and self.host_and_port is None:
+            self.flush()
+            self.retryFailed(force=True)
+        with self.session_lock:
+            sessions = self.all_sessions
+            self.all_sessions = []
+        for session in sessions:
+            session.close()
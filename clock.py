@@ -0,0 +1,60 @@
+# Copyright 2016 SICS Swedish ICT AB
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A monotonic, high resolution clock in seconds, for timestamps that
+# are only compared with each other (sample times, deadlines,
+# intervals). Unlike time.time() it is not affected by NTP steps or
+# other changes of the system time.
+#
+# Python 2.7 has no time.monotonic(), so clock_gettime(CLOCK_MONOTONIC)
+# is called through ctypes. If neither is available, time.time() is
+# used.
+
+import time
+
+CLOCK_MONOTONIC = 1
+
+
+def _ctypes_monotonic():
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    for name in (ctypes.util.find_library('rt'), ctypes.util.find_library('c'), None):
+        try:
+            lib = ctypes.CDLL(name, use_errno=True)
+            clock_gettime = lib.clock_gettime
+            break
+        except (OSError, AttributeError):
+            continue
+    else:
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    ts = timespec()
+    pts = ctypes.pointer(ts)
+    if clock_gettime(CLOCK_MONOTONIC, pts) != 0:
+        return None
+
+    def monotonic():
+        clock_gettime(CLOCK_MONOTONIC, pts)
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+else:
+    monotonic = _ctypes_monotonic() or time.time
@@ -16,44 +16,187 @@
 
 from __future__ import print_function
 
+# The configuration server of the monitor (see monconf.py).
+#
+# A client sends commands as JSON objects, one per line, and gets one
+# reply line for each: {"return": {...}}. A command may carry an "id",
+# which is copied to its reply, so a client can send many commands on
+# one connection without waiting for the replies, and match the
+# replies to its commands.
+#
+# All connections are served by one thread with an asyncore event
+# loop, so concurrent clients need no threads of their own. The
+# commands are carried out by the main loop of the monitor: each
+# command is put on handler.config_queue together with a function
+# that routes its reply back to the connection it came from, and
+# handler.conf_event wakes up the main loop. The reply is handed to
+# the event loop thread, which sends it.
+
 import json
-import sys, os
-import SocketServer
+import socket
+import asyncore
+import asynchat
+from collections import deque
+from threading import Event
+
+# The longest command accepted, in bytes.
+MAX_COMMAND = 1 << 20
+
+
+# Wakes up the event loop when there are replies to send.
+class Waker(asyncore.dispatcher):
+    def __init__(self, server):
+        self.server = server
+        reader, self.writer = socket.socketpair()
+        self.writer.setblocking(False)
+        asyncore.dispatcher.__init__(self, reader, map=server.map)
+
+    # Called from any thread.
+    def wake(self):
+        try:
+            self.writer.send('x')
+        except socket.error:
+            pass                # the buffer is full, so a wakeup is pending
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except socket.error:
+            pass
+        self.server.send_replies()
+
+    def writable(self):
+        return False
+
+    def handle_close(self):
+        self.close()
+        self.writer.close()
+
+
+# One client connection.
+class ConfChannel(asynchat.async_chat):
+    def __init__(self, sock, server):
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        self.server = server
+        self.set_terminator('\n')
+        self.buffer = []
+        self.buffered = 0
+        self.too_long = False
+
+    # A client that sends a command that is too long gets an error,
+    # and is disconnected.
+    def collect_incoming_data(self, data):
+        if self.too_long:
+            return
+        self.buffered += len(data)
+        if self.buffered > MAX_COMMAND:
+            self.too_long = True
+            self.buffer = []
+            self.send_reply({'return': 'Command longer than ' + str(MAX_COMMAND) + ' bytes'})
+            self.close_when_done()
+            return
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        if self.too_long:
+            return
+        line = ''.join(self.buffer).strip()
+        self.buffer = []
+        self.buffered = 0
+        if not line:
+            return
+        try:
+            data = json.loads(line.decode('UTF-8'))
+            if not isinstance(data, dict):
+                raise ValueError('A command must be a JSON object')
+        except ValueError as e:
+            self.send_reply({'return': str(e)})
+            return
+        self.server.submit(self, data.pop('id', None), data)
+
+    def send_reply(self, message):
+        self.push(bytes(json.dumps(message)) + '\n')
 
-class ConfTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        self.server.report_error('ConfChannel')
+        self.close()
+
+
+class ConfServer(asyncore.dispatcher):
     def __init__(self, (host, port), handler):
-        SocketServer.TCPServer.__init__(self, (host, port), handler, bind_and_activate=False)
-        self.allow_reuse_address = True
-        self.server_bind()
-        self.server_activate()
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.handler = handler
+        self.replies = deque()
+        self.closing = Event()
+        self.stopped = Event()
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(128)
+        self.waker = Waker(self)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            ConfChannel(pair[0], self)
+
+    # Queue a command for the monitor. Its reply is sent to channel.
+    def submit(self, channel, request_id, data):
+        handler = self.handler
+        if handler.debug:
+            handler.debugPrint('ConfServer.submit(): handler.config_queue.put(' + repr(data) + ')')
+
+        def reply_to(reply):
+            message = {'return': reply}
+            if request_id is not None:
+                message['id'] = request_id
+            self.replies.append((channel, message))
+            self.waker.wake()
+
+        handler.config_queue.put((data, reply_to))
+        handler.conf_event.set()
+
+    # Send the replies handed over by the monitor. Replies to clients
+    # that have gone are dropped.
+    def send_replies(self):
+        while self.replies:
+            channel, message = self.replies.popleft()
+            if channel.connected:
+                channel.send_reply(message)
+
+    # Is anything still waiting to be sent?
+    def sending(self):
+        if self.replies:
+            return True
+        for channel in self.map.values():
+            if isinstance(channel, ConfChannel) and channel.connected and channel.producer_fifo:
+                return True
+        return False
+
+    def serve_forever(self, poll_interval=0.5):
+        while not self.closing.is_set() or self.sending():
+            asyncore.loop(timeout=poll_interval, use_poll=True, map=self.map, count=1)
+        asyncore.close_all(self.map)
+        self.stopped.set()
+
+    # Stop serving once the replies have been sent, waiting at most
+    # timeout seconds.
+    def shutdown(self, timeout=1.0):
+        self.closing.set()
+        self.waker.wake()
+        self.stopped.wait(timeout)
+
+    def report_error(self, where):
+        nil, t, v, tbinfo = asyncore.compact_traceback()
+        print(where + ": Exception while serving a client:", t, v, tbinfo)
+
+    def handle_error(self):
+        self.report_error('ConfServer')
 
-BaseRequestHandler = SocketServer.BaseRequestHandler
 
 def createConfServer(Host,Port,handler):
-    class ConfTCPServerHandler(BaseRequestHandler):
-        def handle(self):
-            try:
-                data = json.loads(self.request.recv(1024).decode('UTF-8').strip())
-                if handler.debug:
-                    handler.debugPrint('ConfTCPServerHandler.handle(): handler.config_queue.put(' + repr(data))
-                handler.config_queue.put(data)
-                handler.conf_event.set()
-                handler.config_queue.join()
-                if handler.debug:
-                    handler.debugPrint('ConfTCPServerHandler.handle: ' + repr(handler.config_reply) + '.get()')
-                    handler.debugPrint('ConfTCPServerHandler.handle: qsize==' + repr(handler.config_reply.qsize()))
-                reply = handler.config_reply.get()
-                handler.config_reply.task_done()
-                if handler.debug:
-                    handler.debugPrint('ConfTCPServerHandler.handle: self.request.sendall(bytes(json.dumps({\'return\': reply})))')
-                self.request.sendall(bytes(json.dumps({'return': reply})))
-
-            except Exception as e:
-                print("ConfTCPServerHandler.handle(): Exception while receiving message: ", e)
-                exc_type, exc_obj, exc_tb = sys.exc_info()
-                fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                print("                              ", exc_type, fname, exc_tb.tb_lineno)
-                self.request.sendall(bytes(json.dumps({'return': str(e)})))
-
-    confserver = ConfTCPServer((Host,Port),ConfTCPServerHandler)
-    return confserver
+    return ConfServer((Host,Port),handler)
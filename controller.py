@@ -0,0 +1,98 @@
+# Copyright 2016 SICS Swedish ICT AB
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A controller that adapts the sample rate to the estimated risk, so
+# that quiet links are sampled slowly and links near overload at the
+# full rate.
+#
+# After each estimation the controller looks at the highest overload
+# risk of the monitored interfaces, relative to the alarm trigger
+# value (the pressure), and at the highest coefficient of variation
+# (std / mean) of their rates:
+#
+#   - At a pressure of urgent_level or more, the rate goes straight to
+#     max_rate.
+#   - At a pressure of raise_level or more, or a coefficient of
+#     variation of cv_high or more, the rate is multiplied by factor.
+#   - When the pressure is below lower_level and the coefficient of
+#     variation below cv_low for hold estimations in a row, the rate
+#     is divided by factor.
+#
+# The rate is kept between min_rate and max_rate. The gaps between the
+# raise and lower levels, and the hold count, are the hysteresis that
+# keeps the rate from oscillating.
+
+import math
+
+
+class RateController(object):
+    def __init__(self, min_rate, max_rate, factor=2.0,
+                 lower_level=0.1, raise_level=0.5, urgent_level=0.9,
+                 cv_low=0.5, cv_high=2.0, hold=3):
+        if min_rate <= 0 or min_rate > max_rate:
+            raise ValueError("Invalid sample rate bounds: %r, %r" % (min_rate, max_rate))
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.factor = factor
+        self.lower_level = lower_level
+        self.raise_level = raise_level
+        self.urgent_level = urgent_level
+        self.cv_low = cv_low
+        self.cv_high = cv_high
+        self.hold = hold
+        self.calm = 0
+        self.rate = max_rate
+
+    def set_bounds(self, min_rate, max_rate):
+        if min_rate <= 0 or min_rate > max_rate:
+            raise ValueError("Invalid sample rate bounds: %r, %r" % (min_rate, max_rate))
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = self.clamp(self.rate)
+
+    def clamp(self, rate):
+        return int(min(self.max_rate, max(self.min_rate, rate)))
+
+    # Return the sample rate to use after an estimation with the given
+    # interface estimates (see monitor.InterfaceEstimate). An alarm
+    # trigger of 0 (or less) alarms at any risk, so it counts as the
+    # highest pressure.
+    def update(self, estimates, alarm_trigger_value):
+        pressure = 0.0
+        cv = 0.0
+        for est in estimates:
+            risk = max(est.overload_risk_tx, est.overload_risk_rx)
+            if alarm_trigger_value > 0:
+                pressure = max(pressure, risk / float(alarm_trigger_value))
+            else:
+                pressure = max(pressure, self.urgent_level)
+            for mean, var in ((est.mean_tx, est.var_tx), (est.mean_rx, est.var_rx)):
+                if mean > 0.0:
+                    cv = max(cv, math.sqrt(var) / mean)
+        self.pressure = pressure
+        self.cv = cv
+        if pressure >= self.urgent_level:
+            self.calm = 0
+            self.rate = self.max_rate
+        elif pressure >= self.raise_level or cv >= self.cv_high:
+            self.calm = 0
+            self.rate = self.clamp(self.rate * self.factor)
+        elif pressure < self.lower_level and cv < self.cv_low:
+            self.calm += 1
+            if self.calm >= self.hold:
+                self.calm = 0
+                self.rate = self.clamp(self.rate / self.factor)
+        else:
+            self.calm = 0
+        return self.rate
@@ -0,0 +1,562 @@
+# Copyright 2016 SICS Swedish ICT AB
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Counter sources read the tx/rx byte counters of a set of network
+# interfaces. Every source reads the counters of all its interfaces
+# in one call to read(), which returns
+#
+#     [timestamp, [tx_bytes, ...], [rx_bytes, ...]]
+#
+# with one entry per interface, in the order given to set_interfaces().
+# The timestamp is taken from the monotonic clock (see clock.py).
+#
+# A source can also read extra counters (see EXTRA_COUNTERS), given
+# as a list of names when it is created. read() then returns a fourth
+# list with the tx and the rx value of each extra counter of each
+# interface, in the order
+#
+#     [if0 counter0 tx, if0 counter0 rx, if0 counter1 tx, ..., if1 counter0 tx, ...]
+#
+# The extra counters come from the same read as the byte counters,
+# except for sysfs, which has one more file per counter.
+#
+# Available sources:
+#   netlink    - One netlink dump over a NETLINK_ROUTE socket, reading
+#                the 64-bit counters of all interfaces (Linux). The
+#                dump is RTM_GETSTATS filtered to IFLA_STATS_LINK_64
+#                where the kernel supports it (Linux 4.7 and later),
+#                and RTM_GETLINK with IFLA_STATS64 otherwise.
+#   procnetdev - One read of /proc/net/dev (Linux).
+#   sysfs      - One read per counter file in
+#                /sys/class/net/<interface>/statistics (Linux). This
+#                is the fallback if the other sources are unavailable.
+#   netstat    - Runs netstat once per interface and read (OS X). Only
+#                usable for testing.
+#   fake       - Counters set or advanced by the caller (testing).
+
+import os
+import sys
+import socket
+import struct
+from clock import monotonic
+
+# The sources that are tried, in order, when the source is 'auto'.
+AUTO_SOURCES = ['netlink', 'procnetdev', 'sysfs']
+
+# The extra counters that can be read, with the names of their tx
+# and rx counter files in /sys/class/net/<interface>/statistics. There
+# is no tx multicast counter, so it is always 0.
+EXTRA_COUNTERS = {'packets': ('tx_packets', 'rx_packets'),
+                  'dropped': ('tx_dropped', 'rx_dropped'),
+                  'errors': ('tx_errors', 'rx_errors'),
+                  'multicast': (None, 'multicast')}
+
+
+# Split a specification of extra counters, a list of names or a comma
+# separated string, e.g. "packets,dropped", into a list of names.
+def extra_counter_list(counters):
+    if counters is None:
+        return []
+    if isinstance(counters, basestring):
+        counters = [c.strip() for c in counters.split(',') if c.strip() != '']
+    counters = [str(c) for c in counters]
+    for counter in counters:
+        if counter not in EXTRA_COUNTERS:
+            raise ValueError("Unknown counter: " + repr(counter))
+    return counters
+
+
+class CounterSource(object):
+    name = None
+    # Number of bits in the counters, used for wrap-around adjustment.
+    counter_bits = 64
+
+    def __init__(self, interfaces, extra=()):
+        self.interfaces = []
+        self.extra = extra_counter_list(extra)
+        self.set_interfaces(interfaces)
+
+    def set_interfaces(self, interfaces):
+        self.interfaces = list(interfaces)
+
+    def read(self):
+        raise NotImplementedError
+
+    # The number of system calls made by one read() of n interfaces.
+    def syscalls_per_read(self, n):
+        return None
+
+    def close(self):
+        pass
+
+
+class SysfsCounterSource(CounterSource):
+    name = 'sysfs'
+
+    def __init__(self, interfaces, extra=(), root='/sys/class/net'):
+        self.root = root
+        self.fds = []
+        self.files = {}         # interface -> [tx_bytes fd, rx_bytes fd, extra fds...]
+        CounterSource.__init__(self, interfaces, extra)
+
+    # The counter files are opened once and kept open, also when the
+    # interfaces change: only the files of new interfaces are opened,
+    # and those of removed interfaces closed. Opening a missing
+    # interface raises an IOError/OSError. A counter without a file
+    # (tx multicast) has the fd None.
+    def set_interfaces(self, interfaces):
+        files = ['tx_bytes', 'rx_bytes']
+        for counter in self.extra:
+            files.extend(EXTRA_COUNTERS[counter])
+        opened = {}
+        try:
+            for interface in interfaces:
+                if interface not in self.files and interface not in opened:
+                    fds = []
+                    opened[interface] = fds
+                    for counter in files:
+                        if counter is None:
+                            fds.append(None)
+                        else:
+                            fds.append(os.open(os.path.join(self.root, interface, 'statistics', counter), os.O_RDONLY))
+        except (IOError, OSError):
+            for fds in opened.values():
+                for fd in fds:
+                    if fd is not None:
+                        os.close(fd)
+            raise
+        self.files.update(opened)
+        for interface in self.files.keys():
+            if interface not in interfaces:
+                for fd in self.files.pop(interface):
+                    if fd is not None:
+                        os.close(fd)
+        self.fds = [fd for interface in interfaces for fd in self.files[interface]]
+        self.interfaces = list(interfaces)
+
+    def read(self):
+        tx = []
+        rx = []
+        fds = self.fds
+        if not self.extra:
+            for i in range(0, len(fds), 2):
+                os.lseek(fds[i], 0, os.SEEK_SET)
+                tx.append(int(os.read(fds[i], 32)))
+                os.lseek(fds[i + 1], 0, os.SEEK_SET)
+                rx.append(int(os.read(fds[i + 1], 32)))
+            return [monotonic(), tx, rx]
+        extra = []
+        stride = 2 + 2 * len(self.extra)
+        for i in range(0, len(fds), stride):
+            os.lseek(fds[i], 0, os.SEEK_SET)
+            tx.append(int(os.read(fds[i], 32)))
+            os.lseek(fds[i + 1], 0, os.SEEK_SET)
+            rx.append(int(os.read(fds[i + 1], 32)))
+            for fd in fds[i + 2:i + stride]:
+                if fd is None:
+                    extra.append(0)
+                else:
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    extra.append(int(os.read(fd, 32)))
+        return [monotonic(), tx, rx, extra]
+
+    # lseek() and read() per counter file.
+    def syscalls_per_read(self, n):
+        files = 2 + len([f for counter in self.extra for f in EXTRA_COUNTERS[counter] if f is not None])
+        return 2 * files * n
+
+    def close(self):
+        for fds in self.files.values():
+            for fd in fds:
+                if fd is not None:
+                    os.close(fd)
+        self.files = {}
+        self.fds = []
+
+
+class ProcNetDevCounterSource(CounterSource):
+    name = 'procnetdev'
+
+    # The indexes of the tx and the rx field of each extra counter on
+    # a line of /proc/net/dev: the eight rx fields are bytes, packets,
+    # errs, drop, fifo, frame, compressed and multicast, and the tx
+    # fields bytes, packets, errs, drop, fifo, colls, carrier and
+    # compressed.
+    FIELDS = {'packets': (9, 1),
+              'dropped': (11, 3),
+              'errors': (10, 2),
+              'multicast': (None, 7)}
+
+    def __init__(self, interfaces, extra=(), path='/proc/net/dev'):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        CounterSource.__init__(self, interfaces, extra)
+        self.fields = [field for counter in self.extra for field in self.FIELDS[counter]]
+
+    def set_interfaces(self, interfaces):
+        present = self.read_all()
+        for interface in interfaces:
+            if interface not in present:
+                raise IOError("No such interface in " + self.path + ": " + interface)
+        self.interfaces = list(interfaces)
+
+    # Return a dict mapping every interface to its counter fields (as
+    # strings, see FIELDS). Only the fields that are used are
+    # converted to numbers, by read().
+    def read_all(self):
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        # Large enough to get the whole file in one read() even with
+        # hundreds of interfaces.
+        text = os.read(self.fd, 1 << 20)
+        counters = {}
+        for line in text.splitlines()[2:]:
+            name, sep, fields = line.partition(':')
+            counters[name.strip()] = fields.split()
+        return counters
+
+    def read(self):
+        counters = self.read_all()
+        timestamp = monotonic()
+        tx = []
+        rx = []
+        extra = []
+        fields = self.fields
+        for interface in self.interfaces:
+            try:
+                data = counters[interface]
+            except KeyError:
+                raise IOError("No such interface in " + self.path + ": " + interface)
+            # rx bytes is the first and tx bytes the ninth field.
+            tx.append(int(data[8]))
+            rx.append(int(data[0]))
+            if fields:
+                extra.extend([0 if field is None else int(data[field]) for field in fields])
+        if fields:
+            return [timestamp, tx, rx, extra]
+        return [timestamp, tx, rx]
+
+    # One lseek() and one read().
+    def syscalls_per_read(self, n):
+        return 2
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+# Netlink constants, see <linux/netlink.h>, <linux/rtnetlink.h> and
+# <linux/if_link.h>.
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x01
+NLM_F_DUMP = 0x300
+RTM_NEWLINK = 16
+RTM_GETLINK = 18
+RTM_NEWSTATS = 92
+RTM_GETSTATS = 94
+IFLA_IFNAME = 3
+IFLA_STATS64 = 23
+IFLA_STATS_LINK_64 = 1
+
+NLMSGHDR = struct.Struct('=IHHII')      # len, type, flags, seq, pid
+IFINFOMSG = struct.Struct('=BxHiII')    # family, type, index, flags, change
+IF_STATS_MSG = struct.Struct('=BxxxiI') # family, ifindex, filter_mask
+RTATTR = struct.Struct('=HH')           # len, type
+# The first nine fields of struct rtnl_link_stats64: rx_packets,
+# tx_packets, rx_bytes, tx_bytes, rx_errors, tx_errors, rx_dropped,
+# tx_dropped and multicast.
+STATS64 = struct.Struct('=QQQQQQQQQ')
+# The indexes in STATS64 of the tx and the rx field of each extra
+# counter.
+STATS64_FIELDS = {'packets': (1, 0),
+                  'dropped': (7, 6),
+                  'errors': (5, 4),
+                  'multicast': (None, 8)}
+
+
+def nlmsg_align(n):
+    return (n + 3) & ~3
+
+
+# Walk the route attributes in data[offset:end], and yield
+# (type, payload offset, payload length) for each attribute.
+def rtattrs(data, offset, end):
+    while offset + RTATTR.size <= end:
+        rta_len, rta_type = RTATTR.unpack_from(data, offset)
+        if rta_len < RTATTR.size:
+            break
+        yield rta_type, offset + RTATTR.size, rta_len - RTATTR.size
+        offset += nlmsg_align(rta_len)
+
+
+class NetlinkCounterSource(CounterSource):
+    name = 'netlink'
+
+    def __init__(self, interfaces, extra=(), bufsize=1 << 16):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self.sock.bind((0, 0))
+        self.buf = bytearray(bufsize)
+        self.seq = 0
+        self.recvs = 1
+        self.indexes = []
+        # RTM_GETSTATS only carries the interface index, so the
+        # indexes of the interfaces are looked up with RTM_GETLINK.
+        # It is also much cheaper to parse, since the replies contain
+        # nothing but the counters.
+        self.use_getstats = True
+        CounterSource.__init__(self, interfaces, extra)
+        self.fields = [field for counter in self.extra for field in STATS64_FIELDS[counter]]
+        try:
+            self.read_all_getstats()
+        except IOError:
+            self.use_getstats = False
+
+    def set_interfaces(self, interfaces):
+        links = self.read_all_getlink()
+        for interface in interfaces:
+            if interface not in links:
+                raise IOError("No such interface: " + interface)
+        self.indexes = [links[interface][0] for interface in interfaces]
+        self.interfaces = list(interfaces)
+
+    # Send a dump request and call handle(offset, length) for each
+    # reply message of type msg_type, until the dump is done.
+    def dump(self, request_type, request, msg_type, handle):
+        self.seq += 1
+        self.sock.send(NLMSGHDR.pack(NLMSGHDR.size + len(request),
+                                     request_type, NLM_F_REQUEST | NLM_F_DUMP,
+                                     self.seq, 0) + request)
+        buf = self.buf
+        recvs = 0
+        done = False
+        while not done:
+            n = self.sock.recv_into(buf)
+            recvs += 1
+            offset = 0
+            while offset + NLMSGHDR.size <= n:
+                msg_len, msg_type_, flags, seq, pid = NLMSGHDR.unpack_from(buf, offset)
+                if msg_len < NLMSGHDR.size:
+                    break
+                if seq != self.seq:
+                    pass # stale reply to an earlier request
+                elif msg_type_ == NLMSG_DONE:
+                    done = True
+                elif msg_type_ == NLMSG_ERROR:
+                    error = -struct.unpack_from('=i', buf, offset + NLMSGHDR.size)[0]
+                    raise IOError(error, "netlink dump failed: " + os.strerror(error))
+                elif msg_type_ == msg_type:
+                    handle(offset, msg_len)
+                offset += nlmsg_align(msg_len)
+        self.recvs = recvs
+
+    # Dump the link table and return a dict mapping every interface to
+    # its (index, STATS64 fields).
+    def read_all_getlink(self):
+        links = {}
+        buf = self.buf
+        def handle(offset, msg_len):
+            index = IFINFOMSG.unpack_from(buf, offset + NLMSGHDR.size)[2]
+            name = None
+            stats = None
+            attr_offset = offset + NLMSGHDR.size + IFINFOMSG.size
+            for rta_type, data_offset, data_len in rtattrs(buf, attr_offset, offset + msg_len):
+                if rta_type == IFLA_IFNAME:
+                    name = bytes(buf[data_offset:data_offset + data_len]).rstrip(b'\0').decode('ascii')
+                elif rta_type == IFLA_STATS64:
+                    stats = STATS64.unpack_from(buf, data_offset)
+            if name is not None and stats is not None:
+                links[name] = (index, stats)
+        self.dump(RTM_GETLINK, IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0),
+                  RTM_NEWLINK, handle)
+        return links
+
+    # Dump the 64-bit link statistics and return a dict mapping every
+    # interface index to its STATS64 fields.
+    def read_all_getstats(self):
+        counters = {}
+        buf = self.buf
+        def handle(offset, msg_len):
+            index = IF_STATS_MSG.unpack_from(buf, offset + NLMSGHDR.size)[1]
+            attr_offset = offset + NLMSGHDR.size + IF_STATS_MSG.size
+            for rta_type, data_offset, data_len in rtattrs(buf, attr_offset, offset + msg_len):
+                if rta_type == IFLA_STATS_LINK_64:
+                    counters[index] = STATS64.unpack_from(buf, data_offset)
+                    break
+        self.dump(RTM_GETSTATS,
+                  IF_STATS_MSG.pack(socket.AF_UNSPEC, 0, 1 << (IFLA_STATS_LINK_64 - 1)),
+                  RTM_NEWSTATS, handle)
+        return counters
+
+    def read(self):
+        if self.use_getstats:
+            counters = self.read_all_getstats()
+            keys = self.indexes
+        else:
+            counters = dict((name, data[1]) for name, data in self.read_all_getlink().items())
+            keys = self.interfaces
+        timestamp = monotonic()
+        tx = []
+        rx = []
+        extra = []
+        fields = self.fields
+        for i in range(len(keys)):
+            try:
+                data = counters[keys[i]]
+            except KeyError:
+                raise IOError("No such interface: " + self.interfaces[i])
+            tx.append(data[3])
+            rx.append(data[2])
+            if fields:
+                extra.extend([0 if field is None else data[field] for field in fields])
+        if fields:
+            return [timestamp, tx, rx, extra]
+        return [timestamp, tx, rx]
+
+    # One send() and as many recv() as the last dump needed.
+    def syscalls_per_read(self, n):
+        return 1 + self.recvs
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class NetstatCounterSource(CounterSource):
+    name = 'netstat'
+    counter_bits = 32
+
+    # The columns of the tx and the rx value of each extra counter in
+    # the output of netstat -i -b. netstat has no dropped or multicast
+    # counters, so those are always 0.
+    FIELDS = {'packets': (7, 4),
+              'dropped': (None, None),
+              'errors': (8, 5),
+              'multicast': (None, None)}
+
+    def __init__(self, interfaces, extra=()):
+        from sh import netstat
+        self.netstat = netstat
+        CounterSource.__init__(self, interfaces, extra)
+        self.fields = [field for counter in self.extra for field in self.FIELDS[counter]]
+
+    # Running netstat takes way to much time to be a practical method
+    # for reading the byte counters of an interface. This is only for
+    # testing on OS X, which does not have /sys/class/net/...
+    def read(self):
+        tx = []
+        rx = []
+        extra = []
+        for interface in self.interfaces:
+            tx_bytes = rx_bytes = 0
+            values = [0] * len(self.fields)
+            for line in self.netstat("-i", "-b", "-I", interface):
+                if line.startswith(interface):
+                    words = line.split()
+                    rx_bytes = int(words[6])
+                    tx_bytes = int(words[9])
+                    values = [0 if field is None else int(words[field]) for field in self.fields]
+                    break
+            tx.append(tx_bytes)
+            rx.append(rx_bytes)
+            extra.extend(values)
+        if self.fields:
+            return [monotonic(), tx, rx, extra]
+        return [monotonic(), tx, rx]
+
+
+# A counter source for testing. The counters are set with
+# set_counters() or advanced with advance(), the extra counters
+# advanced with advance_extra(), and the timestamps come from the
+# given clock function.
+class FakeCounterSource(CounterSource):
+    name = 'fake'
+
+    def __init__(self, interfaces, extra=(), clock=monotonic, counter_bits=64):
+        self.clock = clock
+        self.counter_bits = counter_bits
+        self.counters = {}
+        self.extra_counters = {}    # interface -> [counter0 tx, counter0 rx, ...]
+        self.reads = 0
+        CounterSource.__init__(self, interfaces, extra)
+
+    def set_interfaces(self, interfaces):
+        for interface in interfaces:
+            self.counters.setdefault(interface, [0, 0])
+            self.extra_counters.setdefault(interface, [0] * (2 * len(self.extra)))
+        self.interfaces = list(interfaces)
+
+    def set_counters(self, interface, tx_bytes, rx_bytes):
+        self.counters[interface] = [tx_bytes, rx_bytes]
+
+    # Add tx_bytes and rx_bytes to the counters of the interface,
+    # wrapping around like a real counter would.
+    def advance(self, interface, tx_bytes, rx_bytes):
+        wrap = 2 ** self.counter_bits
+        data = self.counters.setdefault(interface, [0, 0])
+        data[0] = (data[0] + tx_bytes) % wrap
+        data[1] = (data[1] + rx_bytes) % wrap
+
+    # Add tx and rx to the extra counter of the interface.
+    def advance_extra(self, interface, counter, tx, rx):
+        wrap = 2 ** self.counter_bits
+        data = self.extra_counters.setdefault(interface, [0] * (2 * len(self.extra)))
+        j = 2 * self.extra.index(counter)
+        data[j] = (data[j] + tx) % wrap
+        data[j + 1] = (data[j + 1] + rx) % wrap
+
+    def read(self):
+        self.reads += 1
+        counters = self.counters
+        data = [self.clock(),
+                [counters[interface][0] for interface in self.interfaces],
+                [counters[interface][1] for interface in self.interfaces]]
+        if self.extra:
+            data.append([value for interface in self.interfaces
+                         for value in self.extra_counters[interface]])
+        return data
+
+    def syscalls_per_read(self, n):
+        return 0
+
+
+COUNTER_SOURCES = {'netlink': NetlinkCounterSource,
+                   'procnetdev': ProcNetDevCounterSource,
+                   'sysfs': SysfsCounterSource,
+                   'netstat': NetstatCounterSource,
+                   'fake': FakeCounterSource}
+
+
+# Create a counter source of the given kind for the interfaces, also
+# reading the given extra counters. With kind 'auto' the netstat
+# source is used on OS X, and on other systems the first source in
+# AUTO_SOURCES that can be created.
+def create_counter_source(kind, interfaces, extra=()):
+    if kind == 'auto':
+        if sys.platform == 'darwin':
+            return NetstatCounterSource(interfaces, extra)
+        error = None
+        for kind in AUTO_SOURCES:
+            try:
+                return COUNTER_SOURCES[kind](interfaces, extra)
+            except (IOError, OSError, socket.error) as e:
+                error = e
+        raise error
+    try:
+        source_class = COUNTER_SOURCES[kind]
+    except KeyError:
+        raise ValueError("Unknown counter source: " + repr(kind))
+    return source_class(interfaces, extra)
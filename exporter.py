@@ -0,0 +1,134 @@
+# Copyright 2016 SICS Swedish ICT AB
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The export stage between the monitor and its sinks (a file, a port
+# or Ceilometer, see ceilocomm.py).
+#
+# The monitor puts its records in a bounded queue, and an Exporter
+# thread takes them out and exports them, so a slow or unavailable
+# sink never delays the estimations. When the queue is full, the
+# overflow policy decides what happens to a new record:
+#
+#   drop-oldest - The oldest record in the queue is dropped.
+#   drop-newest - The new record is dropped.
+#   block       - The monitor waits until there is room.
+#
+# A record whose export fails is retried with exponential backoff, up
+# to max_retries times, after which it is dropped. The exporter counts
+# the exported, dropped and failed records, and measures the export
+# latency (from put() until the record has been exported).
+
+from collections import deque
+from threading import Thread, Condition, Event
+from clock import monotonic
+
+OVERFLOW_POLICIES = ['drop-oldest', 'drop-newest', 'block']
+
+
+class Exporter(Thread):
+    # export is called with each record, and raises an exception if
+    # the record could not be exported.
+    def __init__(self, export, maxsize=1000, policy='drop-oldest',
+                 max_retries=5, min_backoff=0.5, max_backoff=30.0,
+                 name='Exporter'):
+        Thread.__init__(self, name=name)
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: " + repr(policy))
+        self.setDaemon(True)
+        self.export = export
+        self.maxsize = maxsize
+        self.policy = policy
+        self.max_retries = max_retries
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.queue = deque()
+        self.cond = Condition()
+        self.closing = Event()
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retries = 0
+        self.latency_last = 0.0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    # Queue a record for export. Returns False if the record was
+    # dropped.
+    def put(self, record):
+        with self.cond:
+            while len(self.queue) >= self.maxsize:
+                if self.policy == 'drop-newest':
+                    self.dropped += 1
+                    return False
+                elif self.policy == 'drop-oldest' or self.closing.is_set():
+                    self.queue.popleft()
+                    self.dropped += 1
+                else:
+                    self.cond.wait(0.1)
+            self.queue.append((monotonic(), record))
+            self.cond.notify_all()
+        return True
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closing.is_set():
+                    self.cond.wait(0.5)
+                if not self.queue:
+                    break       # closing and nothing left to export
+                queued, record = self.queue.popleft()
+                self.cond.notify_all()
+            backoff = self.min_backoff
+            attempt = 0
+            while True:
+                try:
+                    self.export(record)
+                except Exception as e:
+                    attempt += 1
+                    if attempt > self.max_retries or self.closing.is_set():
+                        print("Could not export a record: " + str(e))
+                        self.failed += 1
+                        break
+                    self.retries += 1
+                    self.closing.wait(backoff)
+                    backoff = min(2 * backoff, self.max_backoff)
+                    continue
+                latency = monotonic() - queued
+                self.exported += 1
+                self.latency_last = latency
+                self.latency_sum += latency
+                if latency > self.latency_max:
+                    self.latency_max = latency
+                break
+
+    # Export what is left in the queue, waiting at most timeout
+    # seconds, and stop the thread.
+    def close(self, timeout=5.0):
+        with self.cond:
+            self.closing.set()
+            self.cond.notify_all()
+        if self.is_alive():
+            self.join(timeout)
+
+    def stats(self):
+        return {'queue_depth': len(self.queue),
+                'queue_size': self.maxsize,
+                'policy': self.policy,
+                'exported': self.exported,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'retries': self.retries,
+                'latency_last': self.latency_last,
+                'latency_mean': self.latency_sum / self.exported if self.exported else 0.0,
+                'latency_max': self.latency_max}
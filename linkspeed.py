@@ -0,0 +1,288 @@
+# Copyright 2016 SICS Swedish ICT AB
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+# The line rates (in bytes/s) of the network interfaces, found without
+# running any program:
+#
+#   wired    - The link speed in /sys/class/net/<interface>/speed.
+#   wireless - The transmit bit rate to the associated stations (the
+#              access point of a client, or the fastest client of an
+#              access point), asked from nl80211 over a generic
+#              netlink socket, as 'iw dev <interface> station dump'
+#              does.
+#
+# (NOTE: 1 Mbit/s is 1000 * 1000 bits/s, not 1024 * 1024; see IEEE
+# 802.3-2008.)
+#
+# A LinkSpeeds thread keeps the line rates of the interfaces that have
+# been looked up in a cache, and looks them up again when they are
+# ttl seconds old, or at once when the kernel reports a change of the
+# link (see linkwatch.py). cached() only reads the cache, so the
+# estimation never waits for a lookup.
+
+import os
+import errno
+import select
+import socket
+import struct
+import traceback
+from threading import Thread, Lock
+from counters import NLMSGHDR, NLMSG_ERROR, NLMSG_DONE, NLM_F_REQUEST, NLM_F_DUMP, RTATTR, rtattrs, nlmsg_align
+from linkwatch import SYSFS_NET, link_index, link_messages, link_socket
+from clock import monotonic
+
+# Generic netlink and nl80211 constants, see <linux/netlink.h>,
+# <linux/genetlink.h> and <linux/nl80211.h>.
+NETLINK_GENERIC = 16
+GENL_ID_CTRL = 16
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+NL80211_CMD_GET_STATION = 17
+NL80211_ATTR_IFINDEX = 3
+NL80211_ATTR_STA_INFO = 21
+NL80211_STA_INFO_TX_BITRATE = 8
+NL80211_RATE_INFO_BITRATE = 1           # u16, in 100 kbit/s
+NL80211_RATE_INFO_BITRATE32 = 5         # u32, in 100 kbit/s
+NLA_TYPE_MASK = 0x3fff                  # without NLA_F_NESTED and NLA_F_NET_BYTEORDER
+
+GENLMSGHDR = struct.Struct('=BBH')      # cmd, version, reserved
+
+
+def nlattr(attr_type, data):
+    length = RTATTR.size + len(data)
+    return RTATTR.pack(length, attr_type) + data + b'\0' * (nlmsg_align(length) - length)
+
+
+# Walk the attributes in data[offset:end], with the flags masked off
+# the types.
+def nlattrs(data, offset, end):
+    for attr_type, data_offset, data_len in rtattrs(data, offset, end):
+        yield attr_type & NLA_TYPE_MASK, data_offset, data_len
+
+
+def is_wireless(interface, root=SYSFS_NET):
+    return os.path.exists(os.path.join(root, interface, 'phy80211')) or \
+        os.path.exists(os.path.join(root, interface, 'wireless'))
+
+
+# The link speed of a wired interface in bytes/s, or None if it is
+# unknown (e.g. the link is down).
+def wired_linerate(interface, root=SYSFS_NET):
+    try:
+        with open(os.path.join(root, interface, 'speed')) as f:
+            speed = int(f.read())
+    except (IOError, OSError, ValueError):
+        return None
+    if speed <= 0:
+        return None
+    return speed * 1000 * 1000 / 8
+
+
+# A generic netlink socket for asking nl80211 about the stations of
+# wireless interfaces. Raises an IOError if nl80211 is not available.
+class Nl80211(object):
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC)
+        self.sock.bind((0, 0))
+        self.seq = 0
+        try:
+            self.family = self.family_id('nl80211')
+        except (IOError, OSError, socket.error):
+            self.close()
+            raise
+
+    # Send a request and return the payloads (after the netlink
+    # header) of the replies, until the dump is done if it is one.
+    def transact(self, msg_type, flags, payload):
+        self.seq += 1
+        self.sock.send(NLMSGHDR.pack(NLMSGHDR.size + len(payload), msg_type, flags,
+                                     self.seq, 0) + payload)
+        replies = []
+        while True:
+            data = self.sock.recv(1 << 16)
+            offset = 0
+            while offset + NLMSGHDR.size <= len(data):
+                msg_len, msg_type_, msg_flags, seq, pid = NLMSGHDR.unpack_from(data, offset)
+                if msg_len < NLMSGHDR.size:
+                    break
+                if seq == self.seq:
+                    if msg_type_ == NLMSG_DONE:
+                        return replies
+                    if msg_type_ == NLMSG_ERROR:
+                        error = -struct.unpack_from('=i', data, offset + NLMSGHDR.size)[0]
+                        if error != 0:
+                            raise IOError(error, "nl80211: " + os.strerror(error))
+                        return replies
+                    replies.append(data[offset + NLMSGHDR.size:offset + msg_len])
+                    if not flags & NLM_F_DUMP:
+                        return replies
+                offset += nlmsg_align(msg_len)
+
+    def family_id(self, name):
+        payload = GENLMSGHDR.pack(CTRL_CMD_GETFAMILY, 1, 0) + \
+                  nlattr(CTRL_ATTR_FAMILY_NAME, name.encode('ascii') + b'\0')
+        for reply in self.transact(GENL_ID_CTRL, NLM_F_REQUEST, payload):
+            for attr_type, data_offset, data_len in nlattrs(reply, GENLMSGHDR.size, len(reply)):
+                if attr_type == CTRL_ATTR_FAMILY_ID:
+                    return struct.unpack_from('=H', reply, data_offset)[0]
+        raise IOError(errno.ENOENT, "No generic netlink family " + name)
+
+    # The highest transmit bit rate to the stations of the interface
+    # in bytes/s, or None if it has no stations.
+    def station_linerate(self, ifindex):
+        payload = GENLMSGHDR.pack(NL80211_CMD_GET_STATION, 0, 0) + \
+                  nlattr(NL80211_ATTR_IFINDEX, struct.pack('=I', ifindex))
+        best = None
+        for reply in self.transact(self.family, NLM_F_REQUEST | NLM_F_DUMP, payload):
+            for attr_type, sta_offset, sta_len in nlattrs(reply, GENLMSGHDR.size, len(reply)):
+                if attr_type != NL80211_ATTR_STA_INFO:
+                    continue
+                for info_type, rate_offset, rate_len in nlattrs(reply, sta_offset, sta_offset + sta_len):
+                    if info_type != NL80211_STA_INFO_TX_BITRATE:
+                        continue
+                    rate = None
+                    for rate_type, data_offset, data_len in nlattrs(reply, rate_offset, rate_offset + rate_len):
+                        if rate_type == NL80211_RATE_INFO_BITRATE32:
+                            rate = struct.unpack_from('=I', reply, data_offset)[0]
+                        elif rate_type == NL80211_RATE_INFO_BITRATE and rate is None:
+                            rate = struct.unpack_from('=H', reply, data_offset)[0]
+                    if rate and (best is None or rate > best):
+                        best = rate
+        if best is None:
+            return None
+        return best * 100 * 1000 / 8
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class LinkSpeeds(Thread):
+    def __init__(self, ttl=10.0, netlink=True, root=SYSFS_NET):
+        Thread.__init__(self, name='LinkSpeeds')
+        self.setDaemon(True)
+        self.ttl = ttl
+        self.root = root
+        self.entries = {}       # interface -> (wireless, linerate, expiry time)
+        self.lock = Lock()      # one lookup at a time, on the nl80211 socket
+        self.keep_running = True
+        self.lookups = 0
+        self.refreshes = 0
+        self.invalidations = 0
+        self.nl80211 = None
+        self.sock = None
+        if netlink:
+            try:
+                self.nl80211 = Nl80211()
+            except (IOError, OSError, socket.error, AttributeError):
+                pass            # no wireless line rates
+            try:
+                self.sock = link_socket()
+            except (socket.error, AttributeError):
+                pass            # no invalidation on link changes
+
+    # Look the line rate of the interface up now and cache it. Returns
+    # (wireless, linerate in bytes/s or None).
+    def lookup_now(self, interface):
+        with self.lock:
+            self.lookups += 1
+            wireless = is_wireless(interface, self.root)
+            linerate = None
+            if wireless:
+                ifindex = link_index(interface, self.root)
+                if self.nl80211 is not None and ifindex is not None:
+                    try:
+                        linerate = self.nl80211.station_linerate(ifindex)
+                    except (IOError, OSError, socket.error):
+                        linerate = None
+            else:
+                linerate = wired_linerate(interface, self.root)
+            self.entries[interface] = (wireless, linerate, monotonic() + self.ttl)
+        return wireless, linerate
+
+    # The cached line rate of the interface if it is fresh, and
+    # otherwise looked up now.
+    def lookup(self, interface):
+        entry = self.entries.get(interface)
+        if entry is None or monotonic() >= entry[2]:
+            return self.lookup_now(interface)
+        return entry[0], entry[1]
+
+    # The cached line rate of the interface, or None. This never
+    # waits for a lookup.
+    def cached(self, interface):
+        entry = self.entries.get(interface)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def forget(self, interface):
+        self.entries.pop(interface, None)
+
+    def run(self):
+        while self.keep_running:
+            now = monotonic()
+            entries = self.entries.items()
+            next_expiry = min([entry[2] for interface, entry in entries] or [now + self.ttl])
+            try:
+                for interface, entry in entries:
+                    if now >= entry[2] and interface in self.entries:
+                        self.refreshes += 1
+                        self.lookup_now(interface)
+            except Exception:
+                print("LinkSpeeds: lookup failed")
+                traceback.print_exc()
+            timeout = max(next_expiry - monotonic(), 0.1)
+            if self.sock is None:
+                select.select([], [], [], timeout)
+                continue
+            try:
+                ready = select.select([self.sock], [], [], timeout)[0]
+                if ready:
+                    data = self.sock.recv(1 << 16)
+                    # Look the changed links up again at once.
+                    for msg_type, index, name in link_messages(data):
+                        if name in self.entries:
+                            self.invalidations += 1
+                            self.lookup_now(name)
+            except (select.error, socket.error) as e:
+                if not self.keep_running:
+                    break
+                if getattr(e, 'errno', None) == errno.ENOBUFS:
+                    # Link messages were lost; look them all up again.
+                    for interface in self.entries.keys():
+                        self.lookup_now(interface)
+                else:
+                    raise
+
+    def stop(self):
+        self.keep_running = False
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.nl80211 is not None:
+            with self.lock:
+                self.nl80211.close()
+                self.nl80211 = None
+
+    def stats(self):
+        return {'interfaces': len(self.entries),
+                'lookups': self.lookups,
+                'refreshes': self.refreshes,
+                'invalidations': self.invalidations,
+                'nl80211': self.nl80211 is not None}
@@ -0,0 +1,234 @@
+# Copyright 2016 SICS Swedish ICT AB
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+# Follow the network interfaces (links) of the host as they come and
+# go, e.g. the tap interfaces of virtual machines.
+#
+# A LinkWatcher thread listens for the link messages of the kernel on
+# a NETLINK_ROUTE socket subscribed to RTNLGRP_LINK (Linux), and also
+# scans /sys/class/net every scan_interval seconds. The scan catches
+# messages lost when the socket buffer overflows, and is all there is
+# where the netlink socket cannot be opened.
+#
+# Only the links whose names match one of the include patterns and
+# none of the exclude patterns (shell-style, e.g. "tap*") are
+# followed. For every change the watcher calls
+#
+#     callback(added, removed)
+#
+# with the lists of the names of the links that have been added and
+# removed. A link that is deleted and created again with the same
+# name (and so with fresh counters) is both removed and added, in
+# that order. The first call, when the watcher starts, adds all
+# matching links.
+
+import os
+import errno
+import select
+import socket
+import traceback
+from fnmatch import fnmatchcase
+from threading import Thread
+from clock import monotonic
+from counters import NETLINK_ROUTE, NLMSGHDR, IFINFOMSG, IFLA_IFNAME, RTM_NEWLINK, rtattrs, nlmsg_align
+
+# See <linux/rtnetlink.h>.
+RTM_DELLINK = 17
+RTMGRP_LINK = 1         # 1 << (RTNLGRP_LINK - 1)
+
+SYSFS_NET = '/sys/class/net'
+
+
+# The names of the links of the host.
+def link_names(root=SYSFS_NET):
+    try:
+        return sorted(os.listdir(root))
+    except OSError:
+        return []
+
+
+# The interface index of a link, or None if it is gone.
+def link_index(name, root=SYSFS_NET):
+    try:
+        with open(os.path.join(root, name, 'ifindex')) as f:
+            return int(f.read())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+# Walk the link messages (RTM_NEWLINK and RTM_DELLINK) in data, and
+# yield (message type, interface index, name) for each.
+def link_messages(data):
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        msg_len, msg_type = NLMSGHDR.unpack_from(data, offset)[:2]
+        if msg_len < NLMSGHDR.size:
+            break
+        if msg_type in (RTM_NEWLINK, RTM_DELLINK):
+            index = IFINFOMSG.unpack_from(data, offset + NLMSGHDR.size)[2]
+            name = None
+            attr_offset = offset + NLMSGHDR.size + IFINFOMSG.size
+            for rta_type, data_offset, data_len in rtattrs(data, attr_offset, offset + msg_len):
+                if rta_type == IFLA_IFNAME:
+                    name = str(bytes(data[data_offset:data_offset + data_len]).rstrip(b'\0').decode('ascii'))
+                    break
+            yield msg_type, index, name
+        offset += nlmsg_align(msg_len)
+
+
+# A NETLINK_ROUTE socket subscribed to the link messages.
+def link_socket():
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    sock.bind((0, RTMGRP_LINK))
+    return sock
+
+
+# Split a comma separated list of patterns.
+def pattern_list(patterns):
+    if patterns is None:
+        return []
+    if isinstance(patterns, basestring):
+        return [p.strip() for p in patterns.split(',') if p.strip() != '']
+    return list(patterns)
+
+
+# Does the name match one of the include patterns and none of the
+# exclude patterns?
+class LinkFilter(object):
+    def __init__(self, include=None, exclude=None):
+        self.include = pattern_list(include) or ['*']
+        self.exclude = pattern_list(exclude)
+
+    def matches(self, name):
+        return any(fnmatchcase(name, p) for p in self.include) and \
+            not any(fnmatchcase(name, p) for p in self.exclude)
+
+
+class LinkWatcher(Thread):
+    def __init__(self, callback, include=None, exclude=None, scan_interval=5.0,
+                 netlink=True, root=SYSFS_NET):
+        Thread.__init__(self, name='LinkWatcher')
+        self.setDaemon(True)
+        self.callback = callback
+        self.filter = LinkFilter(include, exclude)
+        self.scan_interval = scan_interval
+        self.root = root
+        self.links = {}         # name -> interface index of the matching links
+        self.keep_running = True
+        self.scans = 0
+        self.messages = 0
+        self.overflows = 0
+        # The socket is opened before the first scan, so that no
+        # change is lost between the two.
+        self.sock = None
+        if netlink:
+            try:
+                self.sock = link_socket()
+            except (socket.error, AttributeError) as e:
+                print("LinkWatcher: no netlink socket (" + str(e) + "), scanning " + root + " only")
+                self.sock = None
+
+    def run(self):
+        self.scan()
+        next_scan = monotonic() + self.scan_interval
+        while self.keep_running:
+            timeout = max(next_scan - monotonic(), 0.0)
+            if self.sock is None:
+                ready = select.select([], [], [], timeout)[0]
+            else:
+                try:
+                    ready = select.select([self.sock], [], [], timeout)[0]
+                except (select.error, socket.error):
+                    if not self.keep_running:
+                        break
+                    raise
+            if not self.keep_running:
+                break
+            if ready:
+                try:
+                    data = self.sock.recv(1 << 16)
+                except socket.error as e:
+                    if e.errno != errno.ENOBUFS:
+                        raise
+                    # Messages were lost; the scan finds the changes.
+                    self.overflows += 1
+                    self.scan()
+                    continue
+                self.handle_messages(data)
+            if monotonic() >= next_scan:
+                self.scan()
+                next_scan = monotonic() + self.scan_interval
+
+    def stop(self):
+        self.keep_running = False
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    # Compare the links in /sys/class/net with the known ones.
+    def scan(self):
+        self.scans += 1
+        present = {}
+        for name in link_names(self.root):
+            if self.filter.matches(name):
+                index = link_index(name, self.root)
+                if index is not None:
+                    present[name] = index
+        removed = [name for name, index in self.links.items() if present.get(name) != index]
+        added = [name for name, index in present.items() if self.links.get(name) != index]
+        self.links = present
+        self.report(sorted(added), sorted(removed))
+
+    # Handle the link messages in data, in order.
+    def handle_messages(self, data):
+        added = []
+        removed = []
+        for msg_type, index, name in link_messages(data):
+            self.messages += 1
+            # A renamed link is removed under its old name, and a link
+            # created again under the same name is removed first.
+            for old, old_index in self.links.items():
+                if (old_index == index and (old != name or msg_type == RTM_DELLINK)) or \
+                   (old == name and old_index != index):
+                    self.remove_link(old, added, removed)
+            if name is not None and msg_type == RTM_NEWLINK and \
+               name not in self.links and self.filter.matches(name):
+                self.links[name] = index
+                added.append(name)
+        self.report(added, removed)
+
+    def remove_link(self, name, added, removed):
+        del self.links[name]
+        if name in added:
+            added.remove(name)
+        else:
+            removed.append(name)
+
+    def report(self, added, removed):
+        if not added and not removed:
+            return
+        try:
+            self.callback(added, removed)
+        except Exception:
+            print("LinkWatcher: callback failed")
+            traceback.print_exc()
+
+    def stats(self):
+        return {'links': len(self.links),
+                'netlink': self.sock is not None,
+                'scans': self.scans,
+                'messages': self.messages,
+                'overflows': self.overflows}
@@ -0,0 +1,404 @@
+#!/usr/bin/python2.7
+
+# Copyright 2016 SICS Swedish ICT AB
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+# The formats of the meter records.
+#
+# The monitor builds its records with plain Python values (see
+# Monitor.meter). to_json() turns a record into the JSON shape the
+# monitor has always written, where every value is a string made with
+# repr(), e.g. {"tx": "1234.5", "alarm_tx": "False", ...}. encode()
+# turns it into a compact binary frame instead, and decode() turns a
+# frame back into the JSON shape, so that consumers of the binary
+# format see exactly the same records.
+#
+# A binary frame, all values little-endian:
+#
+#   offset  size  type    name
+#        0     4  uint32  length of the rest of the frame
+#        4     1  uint8   format version, FORMAT_VERSION
+#        5     1  uint8   record type, METER or MESSAGE
+#        6     -          the record
+#
+# A METER record:
+#
+#        0     8  int64   timestamp, seconds since the epoch (UTC)
+#        8     1  uint8   flags, ALARM_TX | ALARM_RX | EXPORT | TELEMETRY |
+#                         PACKETS | DROPPED | ERRORS | MULTICAST
+#        9     1  uint8   H, the number of horizons
+#       10     1  uint8   L, the length of the interface name
+#       11     L  char[]  the interface name
+#     11+L     M  bytes   the int mask, one bit per number, set if the
+#                         number is an integer (M = (N + 7) / 8)
+#   11+L+M     M  bytes   the none mask, set if the number is None
+#  11+L+2M   8*N  double  the N numbers: NUMBER_FIELDS, then
+#                         EXPORT_FIELDS if the EXPORT flag is set,
+#                         TELEMETRY_FIELDS if the TELEMETRY flag is
+#                         set, the fields of each extra counter of
+#                         COUNTER_FIELDS whose flag is set, then the
+#                         H horizons, then the HORIZON_FIELDS of each
+#                         horizon
+#
+# A MESSAGE record (e.g. {'initialized': "'2016-03-15T12:00:00'"}):
+#
+#        0     1  uint8   the number of names
+#                         then for each name and value:
+#        -     2  uint16  the length of the name, and the name
+#        -     2  uint16  the length of the value, and the value
+#
+# The numbers are stored as doubles, and the masks tell how to repr()
+# them again. A reader must skip frames of a later format version or
+# an unknown record type, which it can since every frame starts with
+# its length.
+
+import sys
+import json
+import time
+import struct
+import calendar
+from ast import literal_eval
+from datetime import datetime
+from utc import UTC
+
+FORMAT_VERSION = 1
+METER = 1
+MESSAGE = 2
+
+ALARM_TX = 1
+ALARM_RX = 2
+EXPORT = 4
+TELEMETRY = 8
+PACKETS = 16
+DROPPED = 32
+ERRORS = 64
+MULTICAST = 128
+
+FRAME = struct.Struct('<IBB')
+METER_HEADER = struct.Struct('<qBBB')
+LENGTH = struct.Struct('<H')
+
+# The format of the meter timestamp in the JSON records.
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H.%M.%S'
+
+NUMBER_FIELDS = ['linerate', 'alarm_trigger_value', 'cutoff',
+                 'tx', 'var_tx', 'mu_tx', 'sigma2_tx',
+                 'overload_risk_tx', 'empirical_risk_tx',
+                 'rx', 'var_rx', 'mu_rx', 'sigma2_rx',
+                 'overload_risk_rx', 'empirical_risk_rx',
+                 'sample_rate', 'effective_sample_rate',
+                 'achieved_sample_rate', 'estimation_interval',
+                 'meter_interval']
+EXPORT_FIELDS = ['export_queue_depth', 'export_dropped', 'export_latency']
+# The self-telemetry of the monitor (see Monitor.telemetry_fields).
+TELEMETRY_FIELDS = ['telemetry_skipped_ticks', 'telemetry_lateness_mean',
+                    'telemetry_lateness_max', 'telemetry_read_time',
+                    'telemetry_estimate_time', 'telemetry_meter_time',
+                    'telemetry_lost_slots', 'telemetry_sink_errors',
+                    'telemetry_cpu_share']
+# The estimates of the extra counters (see counters.py), with the
+# flag of each: the mean rate (per second) and its variance of each
+# direction, and for the packets also the log-normal parameters. There
+# is no tx multicast counter.
+COUNTER_FIELDS = [(PACKETS, ['packets_tx', 'var_packets_tx', 'mu_packets_tx', 'sigma2_packets_tx',
+                             'packets_rx', 'var_packets_rx', 'mu_packets_rx', 'sigma2_packets_rx']),
+                  (DROPPED, ['dropped_tx', 'var_dropped_tx', 'dropped_rx', 'var_dropped_rx']),
+                  (ERRORS, ['errors_tx', 'var_errors_tx', 'errors_rx', 'var_errors_rx']),
+                  (MULTICAST, ['multicast_rx', 'var_multicast_rx'])]
+# The estimates stored for each horizon H, with the suffix _Hs.
+HORIZON_FIELDS = ['tx', 'var_tx', 'mu_tx', 'sigma2_tx',
+                  'overload_risk_tx', 'empirical_risk_tx',
+                  'rx', 'var_rx', 'mu_rx', 'sigma2_rx',
+                  'overload_risk_rx', 'empirical_risk_rx']
+
+FORMATS = ['json', 'binary']
+
+
+# The suffix of the names of the estimates over a horizon.
+def horizon_suffix(horizon):
+    return '_{:g}s'.format(horizon)
+
+
+# Meter records are those with an interface; the others are messages.
+def is_meter(record):
+    return 'interface' in record
+
+
+# The JSON shape of a record.
+def to_json(record):
+    data = {}
+    for name, value in record.iteritems():
+        if name == 'timestamp' and isinstance(value, datetime):
+            data[name] = value.strftime(TIMESTAMP_FORMAT)
+        else:
+            data[name] = repr(value)
+    return data
+
+
+# The masks of a list of numbers, as strings of bytes.
+def masks(numbers):
+    int_mask = bytearray((len(numbers) + 7) // 8)
+    none_mask = bytearray(len(int_mask))
+    for i, x in enumerate(numbers):
+        if x is None:
+            none_mask[i >> 3] |= 1 << (i & 7)
+        elif isinstance(x, (int, long)):
+            int_mask[i >> 3] |= 1 << (i & 7)
+    return str(int_mask), str(none_mask)
+
+
+# Encode a record as a binary frame.
+def encode(record):
+    if not is_meter(record):
+        body = [struct.pack('<B', len(record))]
+        for name, value in record.iteritems():
+            value = repr(value)
+            body.append(LENGTH.pack(len(name)) + name + LENGTH.pack(len(value)) + value)
+        body = ''.join(body)
+        return FRAME.pack(len(body) + 2, FORMAT_VERSION, MESSAGE) + body
+    flags = 0
+    if record['alarm_tx']:
+        flags |= ALARM_TX
+    if record['alarm_rx']:
+        flags |= ALARM_RX
+    numbers = [record[name] for name in NUMBER_FIELDS]
+    if 'export_queue_depth' in record:
+        flags |= EXPORT
+        numbers.extend([record[name] for name in EXPORT_FIELDS])
+    if 'telemetry_cpu_share' in record:
+        flags |= TELEMETRY
+        numbers.extend([record[name] for name in TELEMETRY_FIELDS])
+    for flag, fields in COUNTER_FIELDS:
+        if fields[0] in record:
+            flags |= flag
+            numbers.extend([record[name] for name in fields])
+    horizons = record['horizons']
+    numbers.extend(horizons)
+    for horizon in horizons:
+        suffix = horizon_suffix(horizon)
+        numbers.extend([record[name + suffix] for name in HORIZON_FIELDS])
+    int_mask, none_mask = masks(numbers)
+    interface = str(record['interface'])
+    timestamp = record['timestamp']
+    body = (METER_HEADER.pack(calendar.timegm(timestamp.utctimetuple()), flags,
+                              len(horizons), len(interface)) +
+            interface + int_mask + none_mask +
+            struct.pack('<%dd' % len(numbers),
+                        *[0.0 if x is None else x for x in numbers]))
+    return FRAME.pack(len(body) + 2, FORMAT_VERSION, METER) + body
+
+
+# Decode the frame at offset in buf. Returns the record, or None if
+# the frame is of a later version or unknown type, and the offset of
+# the next frame. The record is in its JSON shape, or with values
+# True, with plain values like those given to encode() (which is
+# cheaper when the strings of the JSON shape are not needed).
+def decode(buf, offset=0, values=False):
+    length, version, record_type = FRAME.unpack_from(buf, offset)
+    end = offset + 4 + length
+    offset += FRAME.size
+    if version != FORMAT_VERSION:
+        return None, end
+    if record_type == MESSAGE:
+        data = {}
+        count = ord(buf[offset])
+        offset += 1
+        for i in xrange(count):
+            n = LENGTH.unpack_from(buf, offset)[0]
+            name = buf[offset + 2:offset + 2 + n]
+            offset += 2 + n
+            n = LENGTH.unpack_from(buf, offset)[0]
+            data[name] = buf[offset + 2:offset + 2 + n]
+            offset += 2 + n
+        if values:
+            data = dict([(name, literal_eval(value)) for name, value in data.iteritems()])
+        return data, end
+    if record_type != METER:
+        return None, end
+    timestamp, flags, nhorizons, n = METER_HEADER.unpack_from(buf, offset)
+    offset += METER_HEADER.size
+    interface = buf[offset:offset + n]
+    offset += n
+    names = list(NUMBER_FIELDS)
+    if flags & EXPORT:
+        names.extend(EXPORT_FIELDS)
+    if flags & TELEMETRY:
+        names.extend(TELEMETRY_FIELDS)
+    for flag, fields in COUNTER_FIELDS:
+        if flags & flag:
+            names.extend(fields)
+    first_horizon = len(names)
+    count = first_horizon + nhorizons * (1 + len(HORIZON_FIELDS))
+    m = (count + 7) // 8
+    int_mask = bytearray(buf[offset:offset + m])
+    none_mask = bytearray(buf[offset + m:offset + 2 * m])
+    offset += 2 * m
+    numbers = list(struct.unpack_from('<%dd' % count, buf, offset))
+    for i in xrange(count):
+        if none_mask[i >> 3] & (1 << (i & 7)):
+            numbers[i] = None
+        elif int_mask[i >> 3] & (1 << (i & 7)):
+            numbers[i] = int(numbers[i])
+    horizons = numbers[first_horizon:first_horizon + nhorizons]
+    for horizon in horizons:
+        suffix = horizon_suffix(horizon)
+        names.extend([name + suffix for name in HORIZON_FIELDS])
+    del numbers[first_horizon:first_horizon + nhorizons]
+    if values:
+        data = dict(zip(names, numbers))
+        data['timestamp'] = datetime.fromtimestamp(timestamp, UTC())
+        data['interface'] = interface
+        data['alarm_tx'] = bool(flags & ALARM_TX)
+        data['alarm_rx'] = bool(flags & ALARM_RX)
+        data['horizons'] = horizons
+        return data, end
+    data = dict(zip(names, map(repr, numbers)))
+    data['timestamp'] = time.strftime(TIMESTAMP_FORMAT, time.gmtime(timestamp))
+    data['interface'] = repr(interface)
+    data['alarm_tx'] = repr(bool(flags & ALARM_TX))
+    data['alarm_rx'] = repr(bool(flags & ALARM_RX))
+    data['horizons'] = repr(horizons)
+    return data, end
+
+
+# Decode all complete frames in buf. Returns the records and the
+# number of bytes used.
+def decode_all(buf, values=False):
+    records = []
+    offset = 0
+    while offset + 4 <= len(buf):
+        length = struct.unpack_from('<I', buf, offset)[0]
+        if offset + 4 + length > len(buf):
+            break
+        data, offset = decode(buf, offset, values)
+        if data is not None:
+            records.append(data)
+    return records, offset
+
+
+# Open a meter file, possibly a compressed segment (see sinks.FileSink).
+def open_meter_file(path):
+    if path == '-':
+        return sys.stdin
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+    return open(path, 'rb')
+
+
+# Generate the records of binary meter files (see decode()).
+def read_records(paths, values=False):
+    for path in paths:
+        meterfile = open_meter_file(path)
+        try:
+            buf = ''
+            while True:
+                chunk = meterfile.read(65536)
+                if not chunk:
+                    break
+                records, used = decode_all(buf + chunk, values)
+                buf = (buf + chunk)[used:]
+                for data in records:
+                    yield data
+            if buf:
+                print("%s: %d bytes of a truncated frame at the end" % (path, len(buf)), file=sys.stderr)
+        finally:
+            if meterfile is not sys.stdin:
+                meterfile.close()
+
+
+# A typical meter record, with horizons horizons.
+def example_record(horizons=()):
+    record = {'timestamp': datetime.utcnow(),
+              'interface': 'eth0',
+              'linerate': 125000000,
+              'alarm_trigger_value': 95,
+              'cutoff': 0.99,
+              'alarm_tx': False,
+              'alarm_rx': True,
+              'sample_rate': 1000,
+              'effective_sample_rate': 1000,
+              'achieved_sample_rate': 999.8716392847561,
+              'estimation_interval': 10.0,
+              'meter_interval': 30.0,
+              'horizons': list(horizons),
+              'export_queue_depth': 0,
+              'export_dropped': 0,
+              'export_latency': 0.0012873620982468128}
+    for suffix in [''] + [horizon_suffix(h) for h in horizons]:
+        for name in HORIZON_FIELDS:
+            record[name + suffix] = 12345678.901234567 / (1 + len(name))
+    return record
+
+
+# Compare the encoding and decoding throughput and the record size of
+# the JSON and binary formats. A JSON record is decoded by parsing it
+# and converting its numbers back; a binary record both to its plain
+# values (binary) and to its JSON shape (binary-json).
+def benchmark(records=20000, horizons=()):
+    record = example_record(horizons)
+    results = []
+    for fmt in ['json', 'binary', 'binary-json']:
+        start = time.time()
+        if fmt == 'json':
+            for i in xrange(records):
+                encoded = json.dumps(to_json(record)) + '\n'
+        else:
+            for i in xrange(records):
+                encoded = encode(record)
+        encode_time = time.time() - start
+        start = time.time()
+        if fmt == 'json':
+            for i in xrange(records):
+                data = json.loads(encoded)
+                numbers = [float(data[name]) for name in NUMBER_FIELDS]
+        elif fmt == 'binary':
+            for i in xrange(records):
+                data = decode(encoded, values=True)[0]
+                numbers = [data[name] for name in NUMBER_FIELDS]
+        else:
+            for i in xrange(records):
+                data = decode(encoded)[0]
+        decode_time = time.time() - start
+        results.append({'format': fmt,
+                        'bytes': len(encoded),
+                        'encode_per_second': records / encode_time,
+                        'decode_per_second': records / decode_time})
+    return results
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Decode binary meter files (see --meter_format) to JSON lines, or compare the meter formats')
+    parser.add_argument('files', nargs='*', help='Binary meter files, possibly .gz or .zst compressed; - for stdin')
+    parser.add_argument('--bench', help='Compare the encoding and decoding throughput and the record size of the JSON and binary formats', action='store_true')
+    parser.add_argument('--records', help='The number of records to encode and decode with --bench; default 20000', type=int, default=20000)
+    parser.add_argument('-H', '--horizons', help='The horizons of the records with --bench, as a comma separated list; default none', default='')
+    args = parser.parse_args()
+    if args.bench:
+        horizons = [float(h) for h in args.horizons.split(',') if h]
+        for result in benchmark(args.records, horizons):
+            print("%(format)-11s %(bytes)5d bytes/record  encode %(encode_per_second)9.0f records/s  decode %(decode_per_second)9.0f records/s" % result)
+        return
+    for data in read_records(args.files or ['-']):
+        print(json.dumps(data))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+# Copyright 2016 SICS Swedish ICT AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A local HTTP endpoint serving the latest estimates of the monitor,
+# for scrapers that pull (e.g. Prometheus):
+#
+#   /metrics       - in the OpenMetrics text format
+#   /metrics.json  - as JSON, one object per interface with the names
+#                    of the meter records (see Monitor.meter_records)
+#
+# The bodies are rendered once per estimation by MetricsCache.update()
+# and served as they are, so a scrape costs no more than writing the
+# body to the socket, and never touches the sampler or the estimates.
+#
+# In the OpenMetrics format every estimate is a gauge with the labels
+# interface, direction (tx or rx) and window: "estimation" for the
+# estimation interval, or the horizon, e.g. "60s" (see -H).
+
+import json
+import time
+import SocketServer
+import BaseHTTPServer
+from meterformat import horizon_suffix, COUNTER_FIELDS
+
+PREFIX = 'ramon_'
+
+OPENMETRICS_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+JSON_TYPE = 'application/json'
+
+# The estimates of each direction and window: the name and help of
+# the metric, and the names of its tx and rx values in the records.
+ESTIMATES = [('rate_mean_bytes_per_second', 'The mean rate.', 'tx', 'rx'),
+             ('rate_variance', 'The variance of the rate, in (bytes/s)^2.', 'var_tx', 'var_rx'),
+             ('lognormal_mu', 'The location parameter of the log-normal distribution of the rate.', 'mu_tx', 'mu_rx'),
+             ('lognormal_sigma2', 'The scale parameter of the log-normal distribution of the rate.', 'sigma2_tx', 'sigma2_rx'),
+             ('overload_risk_percent', 'The risk that the rate is above the cutoff, assuming a log-normal distribution.', 'overload_risk_tx', 'overload_risk_rx'),
+             ('empirical_risk_percent', 'The share of the samples above the cutoff.', 'empirical_risk_tx', 'empirical_risk_rx')]
+
+# The estimates of the extra counters over the estimation interval:
+# the name and help of the metric, and the prefix of the names of its
+# values in the records (e.g. var_ for var_dropped_rx). Only those in
+# the records are rendered.
+COUNTER_ESTIMATES = [('counter_rate_mean_per_second', 'The mean rate of the counter.', ''),
+                     ('counter_rate_variance', 'The variance of the rate of the counter, in (1/s)^2.', 'var_'),
+                     ('counter_lognormal_mu', 'The location parameter of the log-normal distribution of the rate of the counter.', 'mu_'),
+                     ('counter_lognormal_sigma2', 'The scale parameter of the log-normal distribution of the rate of the counter.', 'sigma2_')]
+# The names of the rates of the extra counters in the records, e.g.
+# dropped_rx.
+COUNTER_RATES = [name for flag, fields in COUNTER_FIELDS for name in fields
+                 if not name.startswith(('var_', 'mu_', 'sigma2_'))]
+
+# The values of each interface: the name, help and name in the records.
+INTERFACE_VALUES = [('linerate_bytes_per_second', 'The line rate of the interface.', 'linerate'),
+                    ('cutoff_ratio', 'The share of the line rate used as the cutoff.', 'cutoff'),
+                    ('alarm_trigger_percent', 'The overload risk that triggers an alarm.', 'alarm_trigger_value'),
+                    ('sample_rate', 'The configured sample rate, in samples per second.', 'sample_rate'),
+                    ('effective_sample_rate', 'The sample rate used by the sampler.', 'effective_sample_rate'),
+                    ('achieved_sample_rate', 'The sample rate achieved during the last estimation interval.', 'achieved_sample_rate')]
+
+
+def label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def number(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(value)
+
+
+# The records of the latest estimates (of meter_records()) in the
+# OpenMetrics text format; timestamp is the time of the estimates in
+# seconds since the epoch.
+def render_openmetrics(records, timestamp):
+    lines = []
+
+    def family(name, help):
+        lines.append('# TYPE ' + PREFIX + name + ' gauge')
+        lines.append('# HELP ' + PREFIX + name + ' ' + help)
+
+    for name, help, tx, rx in ESTIMATES:
+        family(name, help)
+        for record in records:
+            interface = label_value(record['interface'])
+            windows = [('estimation', '')] + [(horizon_suffix(h)[1:], horizon_suffix(h))
+                                              for h in record['horizons']]
+            for window, suffix in windows:
+                for direction, value in (('tx', tx), ('rx', rx)):
+                    lines.append('%s%s{interface="%s",direction="%s",window="%s"} %s' % (
+                        PREFIX, name, interface, direction, window, number(record[value + suffix])))
+    for name, help, prefix in COUNTER_ESTIMATES:
+        samples = []
+        for record in records:
+            interface = label_value(record['interface'])
+            for rate in COUNTER_RATES:
+                if prefix + rate in record:
+                    counter, direction = rate.rsplit('_', 1)
+                    samples.append('%s%s{interface="%s",counter="%s",direction="%s"} %s' % (
+                        PREFIX, name, interface, counter, direction, number(record[prefix + rate])))
+        if samples:
+            family(name, help)
+            lines.extend(samples)
+    family('alarm', 'Whether the overload risk of the estimation interval is above the alarm trigger.')
+    for record in records:
+        interface = label_value(record['interface'])
+        for direction in ('tx', 'rx'):
+            lines.append('%salarm{interface="%s",direction="%s"} %s' % (
+                PREFIX, interface, direction, number(record['alarm_' + direction])))
+    for name, help, value in INTERFACE_VALUES:
+        family(name, help)
+        for record in records:
+            lines.append('%s%s{interface="%s"} %s' % (
+                PREFIX, name, label_value(record['interface']), number(record[value])))
+    family('estimate_timestamp_seconds', 'The time of the latest estimates.')
+    lines.append('%sestimate_timestamp_seconds %s' % (PREFIX, number(timestamp)))
+    lines.append('# EOF\n')
+    return '\n'.join(lines)
+
+
+# The records of the latest estimates as JSON.
+def render_json(records, timestamp):
+    interfaces = []
+    for record in records:
+        data = dict(record)
+        del data['timestamp']
+        interfaces.append(data)
+    return json.dumps({'timestamp': timestamp, 'interfaces': interfaces})
+
+
+# The rendered bodies of the latest estimates. update() replaces them
+# all at once, so a request always gets a consistent set.
+class MetricsCache(object):
+    def __init__(self):
+        self.update([], None)
+
+    def update(self, records, timestamp=None):
+        if timestamp is None and records:
+            timestamp = time.time()
+        self.bodies = {'/metrics': (OPENMETRICS_TYPE, render_openmetrics(records, timestamp)),
+                       '/metrics.json': (JSON_TYPE, render_json(records, timestamp))}
+
+
+class MetricsHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def createMetricsServer(Host, Port, cache):
+    class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.respond(True)
+
+        def do_HEAD(self):
+            self.respond(False)
+
+        def respond(self, send_body):
+            body = cache.bodies.get(self.path.split('?', 1)[0])
+            if body is None:
+                content_type, body = 'text/plain; charset=utf-8', 'Not found\n'
+                self.send_response(404)
+            else:
+                content_type, body = body
+                self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+
+        # The scrapes are not logged.
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHTTPServer((Host, Port), MetricsHandler)
@@ -0,0 +1,116 @@
+# Copyright 2016 SICS Swedish ICT AB
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Numerically stable, mergeable moment accumulators.
+#
+# A set of observations is summarized by its count n, its mean and M2,
+# the sum of squared deviations from the mean (so the population
+# variance is M2 / n). Observations are added with Welford's update,
+# and two summaries are merged with the pairwise formula of Chan,
+# Golub and LeVeque, which is O(1) and exact up to rounding. Unlike
+# running sums of x and x**2, neither loses precision when the count
+# or the magnitude of the observations grows, and the variance never
+# comes out negative.
+#
+# The sampler does the Welford update inline on its per-interface
+# arrays; the functions here work on (n, mean, m2) tuples.
+
+EMPTY = (0, 0.0, 0.0)
+
+
+# Add the observation x to the summary (n, mean, m2).
+def add(moments, x):
+    n, mean, m2 = moments
+    n += 1
+    delta = x - mean
+    mean += delta / n
+    return (n, mean, m2 + delta * (x - mean))
+
+
+# Merge the summaries a and b of two disjoint sets of observations.
+def merge(a, b):
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    if n_a == 0:
+        return b
+    if n_b == 0:
+        return a
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / float(n)
+    m2 = m2_a + m2_b + delta * delta * n_a * n_b / float(n)
+    return (n, mean, m2)
+
+
+# Merge any number of summaries.
+def merge_all(summaries):
+    result = EMPTY
+    for moments in summaries:
+        result = merge(result, moments)
+    return result
+
+
+# The population variance of a summary.
+def variance(moments):
+    n, mean, m2 = moments
+    if n == 0:
+        return 0.0
+    return m2 / n
+
+
+# Merge two lists of summaries element by element.
+def merge_lists(a, b):
+    return [merge(a[i], b[i]) for i in range(len(a))]
+
+
+# The merged summaries of the last size items pushed, where each item
+# is a list of width summaries (e.g. one per interface and direction).
+# The window is kept as two stacks: new items are pushed on the back
+# stack, whose merge is kept up to date, and the oldest items are
+# popped from the front stack, which holds the merge of each item and
+# all items after it in the front stack. When the front stack runs
+# empty, the back stack is moved over to it. This makes push and
+# aggregate O(width) amortized, whatever the size of the window.
+class SlidingMoments(object):
+    def __init__(self, size, width):
+        self.size = size
+        self.width = width
+        self.front = []
+        self.back = []
+        self.back_merged = [EMPTY] * width
+
+    def __len__(self):
+        return len(self.front) + len(self.back)
+
+    def push(self, item):
+        self.back.append(item)
+        self.back_merged = merge_lists(self.back_merged, item)
+        if len(self) > self.size:
+            self.pop()
+
+    # Remove the oldest item.
+    def pop(self):
+        if not self.front:
+            merged = [EMPTY] * self.width
+            while self.back:
+                merged = merge_lists(self.back.pop(), merged)
+                self.front.append(merged)
+            self.back_merged = [EMPTY] * self.width
+        self.front.pop()
+
+    # The merge of all items in the window.
+    def aggregate(self):
+        if self.front:
+            return merge_lists(self.front[-1], self.back_merged)
+        return self.back_merged
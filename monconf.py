@@ -14,88 +14,289 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import print_function
+
+# Configure one rate monitor, or many at once.
+#
+# With --hosts or --inventory the command is sent to every monitor in
+# the list, to up to --parallel of them at the same time, and the
+# replies are gathered into one table (or a JSON summary with --json)
+# that lists the monitors that failed. Each monitor gets --timeout
+# seconds to connect and reply.
+#
+# A list of monitors is a comma separated list (or in the inventory
+# file, one per line; # starts a comment) of
+#
+#   HOST             a host name or address, with the port of --port
+#   HOST:PORT        a host and port
+#   HOST:PORT-PORT   a range of ports on one host
+#   ADDRESS/BITS     the hosts of an IPv4 network, e.g. 10.0.0.0/24
+#                    (without its network and broadcast addresses),
+#                    optionally followed by :PORT or :PORT-PORT
+
 import argparse
 import socket
+import struct
 import json
+import sys
+import time
+from threading import Thread
+from Queue import Queue, Empty
 #import pdb
 from version import __version__
 
-parser = argparse.ArgumentParser(description="Monitor Configuration")
-parser.add_argument("--pause", help='Pause the rate monitor', action='store_true')
-parser.add_argument("--resume", help='Resume the rate monitor', action='store_true')
-parser.add_argument("--status", help='Show the status of the rate monitor', action='store_true')
-parser.add_argument("--exit", help='Tell the rate monitor to exit. Setting this option will cause all other options to be ignored', action='store_true')
-parser.add_argument('-i', "--interface", help='Interface to monitor')
-parser.add_argument('-s', "--sample_rate", help='Sample rate in samples per second', type=int)
-parser.add_argument('-e', "--estimation_interval", help='Estimation interval in seconds', type=int)
-parser.add_argument('-m', "--meter_interval", help='Meter interval in seconds', type=int)
-parser.add_argument('-k', "--link_speed", help='Set the link speed value for the monitored interface (in Mbits per second)', type=int)
-parser.add_argument('-a', "--alarm_trigger", help='The overload risk which will trigger an alarm (a percentage)', type=int)
-parser.add_argument('-o', "--cutoff", help='A percentage of the link speed to use in the overload risk calculation', type=int)
-# The following are "local" arguments, and will not be sent to the monitor.
-parser.add_argument("--host", help='IP or name of the computer running the rate monitor; default 127.0.0.1', nargs='?', default="127.0.0.1")
-parser.add_argument("--port", help='Port of the computer running the rate monitor; default 54736', nargs='?', default="54736", type=int)
-parser.add_argument('-v',"--version", help='Show version and exit',action='store_true')
-
-args = parser.parse_args()
-
-if args.version is True:
-    print(__version__)
-    exit(0)
-
-# # DEBUG
-# print("#")
-# print("print(args):")
-# print(args)
-# # END DEBUG
-
-#pdb.set_trace()
-if args.exit:
-    message = {'exit': True}
-else:
-    if args.resume and args.pause:
-        print("You cannot resume and pause the monitor simultaneously")
-        exit(1)
+DEFAULT_PORT = 54736
+
+
+# The hosts of an IPv4 network given as ADDRESS/BITS.
+def network_hosts(cidr):
+    address, bits = cidr.split('/')
+    bits = int(bits)
+    if not 0 <= bits <= 32:
+        raise ValueError("Bad network: " + cidr)
+    mask = (0xffffffff << (32 - bits)) & 0xffffffff
+    network = struct.unpack('!I', socket.inet_aton(address))[0] & mask
+    size = 1 << (32 - bits)
+    if size > 2:
+        first, last = network + 1, network + size - 2
     else:
-        args.resume = True if args.resume else None
-        args.pause = True if args.pause else None
+        first, last = network, network + size - 1
+    return [socket.inet_ntoa(struct.pack('!I', n)) for n in xrange(first, last + 1)]
+
+
+# Expand one entry of a list of monitors into (host, port) pairs.
+def parse_target(entry, default_port=DEFAULT_PORT):
+    entry = entry.strip()
+    host, sep, ports = entry.rpartition(':')
+    if not sep or ']' in ports:
+        host, ports = entry, str(default_port)
+    if '-' in ports:
+        first, last = ports.split('-', 1)
+        ports = range(int(first), int(last) + 1)
+    else:
+        ports = [int(ports)]
+    host = host.strip('[]')
+    hosts = network_hosts(host) if '/' in host else [host]
+    return [(h, p) for h in hosts for p in ports]
+
+
+# The (host, port) pairs of a list of monitors, in order and without
+# duplicates.
+def parse_targets(entries, default_port=DEFAULT_PORT):
+    targets = []
+    seen = set()
+    for entry in entries:
+        if not entry.strip():
+            continue
+        for target in parse_target(entry, default_port):
+            if target not in seen:
+                seen.add(target)
+                targets.append(target)
+    return targets
+
+
+# The entries of an inventory file.
+def read_inventory(path):
+    entries = []
+    with (sys.stdin if path == '-' else open(path)) as f:
+        for line in f:
+            line = line.split('#', 1)[0]
+            entries.extend(line.replace(',', ' ').split())
+    return entries
+
+
+# Send a command to the monitor at host:port and return its reply,
+# {'return': ...}. The whole exchange gets at most timeout seconds.
+def send_command(host, port, message, timeout=None):
+    deadline = None if timeout is None else time.time() + timeout
+    s = socket.create_connection((host, port), timeout)
+    try:
+        # The commands and the replies are JSON objects, one per line
+        # (see confserver.py).
+        s.sendall(bytes(json.dumps(message)) + '\n')
+        reply = ''
+        while not reply.endswith('\n'):
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout('timed out')
+                s.settimeout(remaining)
+            chunk = s.recv(4096)
+            if not chunk:
+                raise socket.error('connection closed before the reply')
+            reply += chunk
+    finally:
+        s.close()
+    return json.loads(reply.decode('UTF-8'))
+
+
+# Send a command to many monitors, to at most parallel of them at a
+# time. Returns a list of (host, port, reply, error), in the order of
+# targets, where either reply or error (a string) is None.
+def fan_out(targets, message, parallel=64, timeout=5.0):
+    results = [None] * len(targets)
+    work = Queue()
+    for i in range(len(targets)):
+        work.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = work.get_nowait()
+            except Empty:
+                return
+            host, port = targets[i]
+            try:
+                results[i] = (host, port, send_command(host, port, message, timeout), None)
+            except socket.timeout:
+                results[i] = (host, port, None, 'timed out')
+            except Exception as e:
+                results[i] = (host, port, None, str(e) or e.__class__.__name__)
+
+    workers = [Thread(target=worker, name='MonConf') for i in range(min(max(1, parallel), len(targets)))]
+    for thread in workers:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return results
+
 
-    if args.status and (args.resume or args.pause):
-        print("status cannot be queried when resuming or pausing")
+def target_name(host, port):
+    return '%s:%d' % (host, port)
+
+
+def json_summary(results, seconds):
+    return {'hosts': len(results),
+            'ok': sum(1 for result in results if result[3] is None),
+            'failed': dict((target_name(h, p), error) for h, p, reply, error in results if error is not None),
+            'replies': dict((target_name(h, p), reply.get('return')) for h, p, reply, error in results if error is None),
+            'seconds': seconds}
+
+
+def print_table(results, seconds):
+    width = max([len(target_name(h, p)) for h, p, reply, error in results] + [4])
+    for host, port, reply, error in results:
+        if error is None:
+            print("%-*s  ok      %s" % (width, target_name(host, port), json.dumps(reply.get('return'), sort_keys=True)))
+        else:
+            print("%-*s  FAILED  %s" % (width, target_name(host, port), error))
+    failed = [target_name(h, p) for h, p, reply, error in results if error is not None]
+    print("%d monitors, %d ok, %d failed in %.2f s" % (len(results), len(results) - len(failed), len(failed), seconds))
+    if failed:
+        print("failed: " + ', '.join(failed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monitor Configuration")
+    parser.add_argument("--pause", help='Pause the rate monitor', action='store_true')
+    parser.add_argument("--resume", help='Resume the rate monitor', action='store_true')
+    parser.add_argument("--status", help='Show the status of the rate monitor', action='store_true')
+    parser.add_argument("--stats", help='Show the self-telemetry of the rate monitor: achieved sample rate, tick lateness, stage times, queue depths, sink errors and CPU share', action='store_true')
+    parser.add_argument("--exit", help='Tell the rate monitor to exit. Setting this option will cause all other options to be ignored', action='store_true')
+    parser.add_argument('-i', "--interface", help='Interface(s) to monitor, as a comma separated list')
+    parser.add_argument("--add_interfaces", help='Interface(s) to monitor besides those already monitored, as a comma separated list')
+    parser.add_argument("--remove_interfaces", help='Interface(s) to stop monitoring, as a comma separated list')
+    parser.add_argument('-s', "--sample_rate", help='Sample rate in samples per second', type=int)
+    parser.add_argument('-e', "--estimation_interval", help='Estimation interval in seconds', type=int)
+    parser.add_argument('-m', "--meter_interval", help='Meter interval in seconds', type=int)
+    parser.add_argument('-k', "--link_speed", help='Set the link speed value for the monitored interface (in Mbits per second)', type=int)
+    parser.add_argument('-a', "--alarm_trigger", help='The overload risk which will trigger an alarm (a percentage)', type=int)
+    parser.add_argument('-o', "--cutoff", help='A percentage of the link speed to use in the overload risk calculation', type=int)
+    # The following are "local" arguments, and will not be sent to the monitor.
+    parser.add_argument("--host", help='IP or name of the computer running the rate monitor; default 127.0.0.1', nargs='?', default="127.0.0.1")
+    parser.add_argument("--port", help='Port of the computer running the rate monitor; default 54736', nargs='?', default=str(DEFAULT_PORT), type=int)
+    parser.add_argument("--hosts", help='Configure many rate monitors at once: a comma separated list of HOST, HOST:PORT, HOST:PORT-PORT or ADDRESS/BITS (an IPv4 network), optionally with :PORT')
+    parser.add_argument("--inventory", help='Configure the rate monitors listed in this file (- for stdin), one HOST, HOST:PORT, HOST:PORT-PORT or ADDRESS/BITS per line')
+    parser.add_argument("--parallel", help='The largest number of rate monitors to configure at the same time with --hosts or --inventory; default 64', type=int, default=64)
+    parser.add_argument("--timeout", help='The time (in seconds) each rate monitor gets to reply; default 5', type=float, default=5.0)
+    parser.add_argument("--json", help='With --hosts or --inventory, print a JSON summary instead of a table', action='store_true')
+    parser.add_argument('-v',"--version", help='Show version and exit',action='store_true')
+
+    args = parser.parse_args()
+
+    if args.version is True:
+        print(__version__)
+        exit(0)
+
+    if args.parallel < 1:
+        print("--parallel must be at least 1")
         exit(1)
+
+    # # DEBUG
+    # print("#")
+    # print("print(args):")
+    # print(args)
+    # # END DEBUG
+
+    #pdb.set_trace()
+    if args.exit:
+        message = {'exit': True}
     else:
-        args.status = True if args.status else None
-
-    sample_rate = args.sample_rate
-    estimation_interval = args.estimation_interval
-    meter_interval = args.meter_interval
-
-    message = {}
-    for confparam in ['resume','pause','status','interface','sample_rate','estimation_interval','meter_interval','link_speed','alarm_trigger','cutoff']:
-        confval = getattr(args,confparam)
-        if not confval is None:
-            message[confparam] = getattr(args,confparam)
-
-# # DEBUG
-# print("#")
-# print("print(message)")
-# print(message)
-# print("#")
-# # END DEBUG
-
-if message:
+        if args.resume and args.pause:
+            print("You cannot resume and pause the monitor simultaneously")
+            exit(1)
+        else:
+            args.resume = True if args.resume else None
+            args.pause = True if args.pause else None
+
+        if args.status and (args.resume or args.pause):
+            print("status cannot be queried when resuming or pausing")
+            exit(1)
+        else:
+            args.status = True if args.status else None
+        args.stats = True if args.stats else None
+
+        message = {}
+        for confparam in ['resume','pause','status','stats','interface','add_interfaces','remove_interfaces','sample_rate','estimation_interval','meter_interval','link_speed','alarm_trigger','cutoff']:
+            confval = getattr(args,confparam)
+            if not confval is None:
+                message[confparam] = getattr(args,confparam)
+
+    # # DEBUG
+    # print("#")
+    # print("print(message)")
+    # print(message)
+    # print("#")
+    # # END DEBUG
+
+    if not message:
+        print('unimplemented or empty option')
+        exit(1)
+
+    if args.hosts is not None or args.inventory is not None:
+        entries = []
+        if args.hosts is not None:
+            entries.extend(args.hosts.split(','))
+        try:
+            if args.inventory is not None:
+                entries.extend(read_inventory(args.inventory))
+            targets = parse_targets(entries, args.port)
+        except (IOError, ValueError, socket.error) as e:
+            print("Bad list of monitors: " + str(e))
+            exit(1)
+        start = time.time()
+        results = fan_out(targets, message, args.parallel, args.timeout)
+        seconds = time.time() - start
+        if args.json:
+            print(json.dumps(json_summary(results, seconds), indent=4, sort_keys=True))
+        else:
+            print_table(results, seconds)
+        exit(1 if [result for result in results if result[3] is not None] else 0)
+
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((args.host, args.port))
-        s.send(bytes(json.dumps(message)))
-
-        reply = s.recv(1024)
-        result = json.loads(reply.decode('UTF-8'))
-        print(result)
-    except socket.error as (errno, string):
-        print("Error " + repr(errno) + ": " + string)
+        result = send_command(args.host, args.port, message, args.timeout)
+        if args.stats:
+            print(json.dumps(result, indent=4, sort_keys=True))
+        else:
+            print(result)
+    except socket.timeout:
+        print("Error: no reply in " + str(args.timeout) + " seconds")
+    except socket.error as e:
+        print("Error " + repr(e.errno) + ": " + str(e.strerror or e))
     except Exception as e:
         print(e)
-        print(reply)
-else:
-    print('unimplemented or empty option')
+
+
+if __name__ == '__main__':
+    main()
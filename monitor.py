@@ -18,7 +18,6 @@ from __future__ import print_function
 
 import time
 import math
-import json
 import sys
 import traceback
 import SocketServer
@@ -26,7 +25,6 @@ import SocketServer
 from threading import Thread, Event
 import logging
 #import pdb
-import re
 
 class OS_type:
     darwin, other = range(2)
@@ -36,20 +34,28 @@ if sys.platform == 'darwin':
 else:
     OS = OS_type.other
 
-if OS != OS_type.darwin:
-    try:
-        from sh import iwconfig,ErrorReturnCode
-    except Exception as ex:
-        print("WARNING: import from sh failed - " + str(ex))
-
-from scipy.stats import lognorm
-from datetime import datetime, timedelta, tzinfo
+from datetime import datetime
 
 from Queue import Queue,Empty
+from collections import deque
 
 from ceilocomm import CeiloComm
-from sampler import Sampler
+from sampler import Sampler, interface_list, SKETCH
 from confserver import createConfServer
+from metrics import MetricsCache, createMetricsServer
+from riskkernel import lognorm_sf_many
+from moments import SlidingMoments
+from sketch import SlidingSketch
+from array import array
+from shmring import SampleRingWriter, DEFAULT_CAPACITY
+from controller import RateController
+from exporter import Exporter
+from meterformat import to_json, horizon_suffix
+from telemetry import StageTimer, CpuShare
+from linkwatch import LinkWatcher
+from linkspeed import LinkSpeeds
+from counters import EXTRA_COUNTERS, extra_counter_list
+from clock import monotonic
 
 from utc import UTC
 
@@ -60,6 +66,36 @@ class SamplerStatus:
     stopped, running, unknown = range(3)
 
 
+# The estimation state of one sampled interface.
+class InterfaceEstimate():
+    def __init__(self,interface,interface_type,linerate):
+        self.interface = interface
+        self.interface_type = interface_type
+        self.linerate = linerate
+        self.samples = 0
+        self.mean_tx = self.mean_rx = 0.0
+        self.var_tx = self.var_rx = 0.0
+        self.mu_tx = self.mu_rx = 0.0
+        self.sigma2_tx = self.sigma2_rx = 0.0
+        self.overload_risk_tx = self.overload_risk_rx = 0.0
+        # The fraction of the samples above the cutoff rate (in
+        # percent), read from the sketch of the rates.
+        self.empirical_risk_tx = self.empirical_risk_rx = 0.0
+        # The mean and the variance of the tx and the rx rate of each
+        # extra counter, in the order of Monitor.extra_counters.
+        self.extra_mean = []
+        self.extra_var = []
+
+
+# The parameters (mu, sigma2) of the log-normal distribution with the
+# given mean and variance, or (0.0, 0.0) if the mean is 0.
+def lognormal_parameters(mean,var):
+    if mean <= 0.0:
+        return 0.0,0.0
+    sigma2 = math.log(1.0+(var/(mean*mean)))
+    return math.log(mean) - (sigma2/2.0),sigma2
+
+
 #
 # Partly based on code from the UNIFY FP7 Demo for the Y1 review 2015,
 # by Pontus Skldstrm, Acreo Swedish ICT AB / Per Kreuger, SICS Swedish ICT AB.
@@ -76,11 +112,26 @@ class Monitor():
                  interface="eth0",
                  controller_IP='10.0.0.11',
                  conflistener_IP='0.0.0.0',
-                 confport=54736,
+                 confport=54736, # None for no configuration server
                  meter_file_name=None, # if not None, write metering
                                        # data to a file instead of to Ceilometer
                  meter_host_and_port=None, # if not None, write metering
-                                       # data to a local port instead of to Ceilometer
+                                       # data to a local port instead of to Ceilometer;
+                                       # (host, port) or the path of a
+                                       # Unix domain socket
+                 meter_socket_type='stream', # or 'dgram'
+                 backlog=1000, # meter data waiting to be written to the port
+                 backlog_policy='drop-oldest', # or 'block'
+                 flush_size=65536, # bytes written to the meter file
+                                   # between flushes
+                 flush_interval=1.0, # longest time (in seconds) meter
+                                     # data waits to be flushed to the file
+                 fsync='never', # or 'flush' or 'rotate'
+                 rotate_size=0, # rotate the meter file at this size (in bytes)
+                 rotate_interval=0, # or every this many seconds
+                 compress='none', # compression of the rotated meter
+                                  # files: or 'gzip' or 'zstd'
+                 meter_format='json', # or 'binary', see meterformat.py
                  debug=False,
                  log=False,
                  display_data=False,
@@ -89,6 +140,38 @@ class Monitor():
                  username='admin',
                  password=None,
                  tenantname='admin',
+                 counter_source='auto',
+                 tick_policy='catchup',
+                 horizons=None,
+                 sample_ring=None, # if not None, the path of a shared
+                                   # memory ring to write raw samples to
+                 sample_ring_size=DEFAULT_CAPACITY,
+                 adaptive_rate=False, # if True, adapt the sample rate
+                                      # to the risk, up to sample_rate
+                 min_sample_rate=10,
+                 batch_size=100, # samples per POST to Ceilometer
+                 batch_delay=1.0, # longest wait (in seconds) for a
+                                  # batch to fill up
+                 export_queue_size=1000, # records waiting to be exported
+                 export_policy='drop-oldest', # when the export queue is
+                                              # full: or 'drop-newest' or 'block'
+                 meter_telemetry=False, # if True, add the self-telemetry
+                                        # of the monitor to the meter records
+                 metrics_host='127.0.0.1',
+                 metrics_port=None, # if not None, serve the latest
+                                    # estimates over HTTP on this port
+                 export=None, # if not None, called with each record
+                              # instead of exporting it to a file, a
+                              # port or Ceilometer (see supervisor.py)
+                 watch_interfaces=None, # if not None, patterns of the
+                                        # links of the host to add and
+                                        # remove as they come and go
+                 exclude_interfaces=None, # patterns of links not to watch
+                 link_scan_interval=5.0, # seconds between scans of the links
+                 link_speed_ttl=10.0, # seconds before a line rate is looked up again
+                 extra_counters=None, # counters to estimate besides the
+                                      # bytes, e.g. ['packets', 'dropped'],
+                                      # see counters.py
                  mode=None):
         self.exit_flag = False
         self.mode = mode
@@ -114,39 +197,104 @@ class Monitor():
                                 format='%(asctime)s %(levelname)s %(message)s')
             # make the 'sh' module be quiet
             logging.getLogger("sh").setLevel(logging.CRITICAL + 1)
+        self.counter_source = counter_source
+        self.extra_counters = extra_counter_list(extra_counters)
+        self.tick_policy = tick_policy
+        self.meter_telemetry = meter_telemetry
+        # The self-telemetry of the monitor (see telemetry_stats()).
+        self.estimate_timer = StageTimer()
+        self.meter_timer = StageTimer()
+        self.cpu_share = CpuShare()
         self.conflistener_IP=conflistener_IP
         self.conflistenerport=confport
+        # The latest estimates are rendered for the metrics endpoint
+        # after each estimation (see metrics.py).
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        if metrics_port is None:
+            self.metrics = None
+        else:
+            self.metrics = MetricsCache()
         self.name = name
         #
+        # Commands from the configuration server, with the function
+        # that sends the reply of each (see confserver.py).
         self.config_queue = Queue()
-        self.config_reply = Queue()
+        #
+        # If the link speed is not given, the line rate of each
+        # interface is determined when the interface is added.
+        self.linerate = None
+        if link_speed is not None:
+            self.set_linerate(link_speed)
+        # The line rates of the interfaces are looked up, and kept up
+        # to date, in the background (see linkspeed.py).
+        self.link_speeds = LinkSpeeds(ttl=link_speed_ttl)
+        # The links of the host matching watch_interfaces are added to
+        # the interfaces, and removed when they go away (see
+        # linkwatch.py and links_changed()).
+        if watch_interfaces is None:
+            self.link_watcher = None
+        else:
+            self.link_watcher = LinkWatcher(self.links_changed,
+                                            include=watch_interfaces,
+                                            exclude=exclude_interfaces,
+                                            scan_interval=link_scan_interval)
+        # The estimates are made over sliding windows of the slots
+        # published by the sampler: one of est_interval seconds, and
+        # one for each of the additional horizons (in seconds). The
+        # slots are short enough for the shortest of these, but at
+        # most one second long.
+        self.est_interval = estimation_interval
+        self.horizons = sorted(set(horizons or []))
+        self.slot_length = min([1.0, estimation_interval] + self.horizons)
+        # The raw samples ring outlives the samplers.
+        if sample_ring is None:
+            self.sample_ring = None
+        else:
+            self.sample_ring = SampleRingWriter(sample_ring, sample_ring_size)
+        if adaptive_rate:
+            self.controller = RateController(min(min_sample_rate,sample_rate),sample_rate)
+        else:
+            self.controller = None
         self.reset(sample_rate,interface)
         #
         self.conf_event = Event()
         #
-        if link_speed is None:
-            self.interface_type,self.linerate = self.get_linerate(interface)
-            if self.linerate is None:
-                raise(ValueError("Cannot determine the linerate of " + interface))
-        else:
-            self.set_linerate(link_speed)
-            self.interface_type = InterfaceType.Ethernet
-        self.link_speed = self.linerate_to_link_speed(self.linerate)
-        self.est_interval = estimation_interval
         self.meter_interval = meter_interval
         self.resource_ID = resid
         self.project_ID = projid
         self.username = username
         self.tenantname = tenantname
-        if self.debug:
+        if self.debug or export is not None:
             self.ceilocomm = None
         else:
             self.ceilocomm = CeiloComm(resid,projid,controller=controller_IP,
                                        file_name=meter_file_name,
-                                       host_and_port=meter_host_and_port)
+                                       host_and_port=meter_host_and_port,
+                                       socket_type=meter_socket_type,
+                                       backlog=backlog,
+                                       backlog_policy=backlog_policy,
+                                       batch_size=batch_size,
+                                       batch_delay=batch_delay,
+                                       flush_size=flush_size,
+                                       flush_interval=flush_interval,
+                                       fsync=fsync,
+                                       rotate_size=rotate_size,
+                                       rotate_interval=rotate_interval,
+                                       compress=compress,
+                                       meter_format=meter_format)
         self.authpassword = password
-        if not self.debug:
+        if self.ceilocomm is not None:
             self.get_auth_token()
+        # The records are exported by a separate thread, so that slow
+        # sinks do not delay the estimations.
+        if self.debug:
+            self.exporter = None
+        else:
+            self.exporter = Exporter(export or self.export_record,
+                                     maxsize=export_queue_size,
+                                     policy=export_policy)
+            self.exporter.start()
 
 
     # Print some trace outout on the terminal, or if self.log is
@@ -159,24 +307,166 @@ class Monitor():
 
 
     def reset(self,sample_rate,interface):
-        self.time_of_last_meter = self.time_of_last_calc = time.time()
-        self.last_samples = 0
-        self.last_tx_agg = self.last_rx_agg = 0.0
-        self.last_txb2 = self.last_rxb2 = 0.0
-        self.mean_tx = self.mean_rx = 0.0
-        self.var_tx = self.var_rx = 0.0
-        self.mu_tx = self.mu_rx = 0.0
-        self.sigma2_tx = self.sigma2_rx = 0.0
+        self.time_of_last_meter = self.time_of_last_calc = monotonic()
+        self.achieved_sample_rate = 0.0
+        self.effective_sample_rate = sample_rate
+        self.snapshot_version = 0
         self.request_queue = Queue()
-        self.sample_queue = Queue()
-        self.sampler = Sampler(self.request_queue,self.sample_queue,
+        old_sampler = getattr(self,'sampler',None)
+        self.sampler = Sampler(self.request_queue,
                                sample_rate,self,interface=interface,
-                               debug=self.debug)
+                               debug=self.debug,
+                               counter_source=self.counter_source,
+                               tick_policy=self.tick_policy,
+                               window_length=self.slot_length,
+                               ring=self.sample_ring,
+                               drop_missing=self.link_watcher is not None,
+                               extra_counters=self.extra_counters)
+        if old_sampler is not None:
+            old_sampler.close()
+        self.init_estimates(self.sampler.get_interfaces())
+        # The moments are copied from the sampler's snapshot into this
+        # buffer, which is reused by every estimation.
+        self.rate_data = self.sampler.snapshot.reader_buffer()
         if self.debug:
             print("\33[H",end="")   # move cursor home
             print("\33[J",end="")   # clear screen
 
 
+    # Create fresh estimation state for each of the given interfaces,
+    # for the estimation interval and for each horizon, and empty the
+    # slot history.
+    def init_estimates(self,interfaces):
+        estimates = [self.new_estimate(interface) for interface in interfaces]
+        self.estimates = estimates
+        self.horizon_estimates = [(horizon,
+                                   [InterfaceEstimate(est.interface,est.interface_type,est.linerate)
+                                    for est in estimates])
+                                  for horizon in self.horizons]
+        self.slots = deque()
+        self.slots_since_estimate = 0
+        self.window_ticks = 0
+        self.window_time = 0.0
+        self.lost_slots = 0
+        self.init_windows()
+
+
+    def new_estimate(self,interface):
+        if self.linerate is None:
+            interface_type,linerate = self.get_linerate(interface)
+            if linerate is None:
+                raise(ValueError("Cannot determine the linerate of " + interface))
+        else:
+            interface_type,linerate = InterfaceType.Ethernet,self.linerate
+        return InterfaceEstimate(interface,interface_type,linerate)
+
+
+    # Change the estimated interfaces to the given ones, keeping the
+    # estimates and the slot history of those already estimated. The
+    # new interfaces have no samples in the earlier slots.
+    def update_estimates(self,interfaces):
+        old = dict((est.interface,i) for i,est in enumerate(self.estimates))
+        estimates = [self.estimates[old[interface]] if interface in old
+                     else self.new_estimate(interface)
+                     for interface in interfaces]
+        horizon_estimates = []
+        for horizon,hests in self.horizon_estimates:
+            horizon_estimates.append((horizon,
+                                      [hests[old[est.interface]] if est.interface in old
+                                       else InterfaceEstimate(est.interface,est.interface_type,est.linerate)
+                                       for est in estimates]))
+        # The tx and rx sketches of each interface kept, by their
+        # number in the old and in the new slots.
+        moved = {}
+        for j,est in enumerate(estimates):
+            i = old.get(est.interface)
+            if i is not None:
+                moved[2 * i] = 2 * j
+                moved[2 * i + 1] = 2 * j + 1
+        # The moments of the extra counters follow those of the bytes
+        # in the slots (see collect()).
+        k2 = 2 * len(self.extra_counters)
+        base = 2 * len(self.estimates)
+        slots = deque(maxlen=self.slots.maxlen)
+        for item,counts in self.slots:
+            new_item = []
+            new_extra = []
+            for est in estimates:
+                i = old.get(est.interface)
+                if i is None:
+                    new_item.extend([(0,0.0,0.0)] * 2)
+                    new_extra.extend([(0,0.0,0.0)] * k2)
+                else:
+                    new_item.extend(item[2 * i:2 * i + 2])
+                    new_extra.extend(item[base + i * k2:base + (i + 1) * k2])
+            slots.append((new_item + new_extra,SKETCH.move(counts,moved)))
+        self.estimates = estimates
+        self.horizon_estimates = horizon_estimates
+        self.slots = slots
+        self.init_windows()
+
+
+    # Called by the link watcher (in its thread) when links matching
+    # the watched patterns have been added to or removed from the
+    # host. The sampler is changed by the main loop, as for the
+    # add_interfaces and remove_interfaces commands. Links whose line
+    # rate cannot be determined are not added. The line rates found
+    # here are cached for when the interfaces are added.
+    def links_changed(self,added,removed):
+        usable = []
+        for interface in added:
+            if self.linerate is None and self.get_linerate(interface)[1] is None:
+                print("Not monitoring " + interface + ": cannot determine its linerate (see -k)")
+                continue
+            usable.append(interface)
+        for interface in removed:
+            self.link_speeds.forget(interface)
+        data = {}
+        if removed:
+            data['remove_interfaces'] = removed
+        if usable:
+            data['add_interfaces'] = usable
+        if data:
+            self.config_queue.put((data,self.links_changed_reply))
+            self.conf_event.set()
+
+    def links_changed_reply(self,reply):
+        if self.debug:
+            self.debugPrint('links_changed: ' + repr(reply))
+
+
+    # The number of slots in a window of the given length in seconds.
+    def horizon_slots(self,horizon):
+        return max(1, int(round(horizon / self.slot_length)))
+
+
+    # The number of moments in a slot of n interfaces: the tx and rx
+    # moments of the bytes of each interface, followed by the tx and
+    # rx moments of each extra counter of each interface.
+    def slot_width(self,n):
+        return 2 * n * (1 + len(self.extra_counters))
+
+
+    # Create the sliding windows of the estimation interval and the
+    # horizons, filled from the slot history. Each window is a pair of
+    # the merged moments and the merged sketches of its slots.
+    def init_windows(self):
+        sizes = set([self.horizon_slots(self.est_interval)] +
+                    [self.horizon_slots(horizon) for horizon in self.horizons])
+        # Each slot holds the moments of each interface (see
+        # slot_width()), and the sparse tx and rx sketches of each
+        # interface, which are merged into a flat array per window.
+        width = 2 * len(self.estimates)
+        self.windows = dict((size, (SlidingMoments(size, self.slot_width(len(self.estimates))),
+                                    SlidingSketch(size, width * SKETCH.buckets)))
+                            for size in sizes)
+        self.slots = deque(self.slots, max(sizes))
+        for item, counts in self.slots:
+            for moments, sketches in self.windows.values():
+                moments.push(item)
+                sketches.push(counts)
+
+
     def clear_queue(self,q):
         while not q.empty():
             try:
@@ -189,7 +479,6 @@ class Monitor():
     # Start a new sampler
     def start_sampler(self):
         self.clear_queue(self.request_queue)
-        self.clear_queue(self.sample_queue)
         self.reset(self.sampler.get_sample_rate(),
                    self.sampler.get_interface())
         self.sampler.setDaemon(True)
@@ -218,14 +507,30 @@ class Monitor():
             return SamplerStatus.unknown
 
 
-    # Set sample rate (in samples per second)
+    # Set sample rate (in samples per second). With an adaptive
+    # sample rate, this is the highest rate the controller may use.
     def set_sample_rate(self, sampler, sample_rate):
+        if self.controller is not None:
+            self.controller.set_bounds(min(self.controller.min_rate,sample_rate),sample_rate)
+            sample_rate = self.controller.rate
         sampler.set_sample_rate(sample_rate)
 
 
-    # Set estimation interval (in seconds)
+    # The configured sample rate, which is the highest rate the
+    # controller may use with an adaptive sample rate.
+    def get_sample_rate(self):
+        if self.controller is not None:
+            return self.controller.max_rate
+        return self.sampler.get_sample_rate()
+
+
+    # Set estimation interval (in seconds). The new window is filled
+    # from the slot history, so the past samples are not lost. An
+    # estimation interval shorter than the slots is rounded up to one
+    # slot.
     def set_estimation_interval(self,interval):
         self.est_interval = interval
+        self.init_windows()
 
 
     # Set meter interval (in seconds)
@@ -234,9 +539,13 @@ class Monitor():
 
 
     # Set linerate (link_speed is given in Mbits/s)
+    # The line rate is set for all sampled interfaces.
     def set_linerate(self,link_speed):
 #        self.linerate = link_speed * 1024 * 1024 / 8 # convert from Mbit/s to bytes/s
         self.linerate = link_speed * 1000 * 1000 / 8 # convert from Mbit/s to bytes/s
+        for est in getattr(self,'estimates',[]):
+            est.interface_type = InterfaceType.Ethernet
+            est.linerate = self.linerate
         
     # Convert back from linerate in bytes/s to link speed in Mbit/s
     def linerate_to_link_speed(self,linerate):
@@ -251,16 +560,13 @@ class Monitor():
         self.cutoff = cutoff / 100.0
 
 
-    def listen_for_configuration(self):
-        server = createConfServer(self.conflistener_IP,self.conflistenerport,self)
-        server.serve_forever()
-
-
-    def handle_configuration(self,sampler,config_queue,config_reply):
+    # Carry out one command from the configuration server, and send
+    # the reply to the client that sent it.
+    def handle_configuration(self,sampler,config_queue):
         reply = {}
         if self.debug:
             self.debugPrint('handle_configuration: config_queue.get()')
-        data = config_queue.get()
+        data, reply_to = config_queue.get()
         config_queue.task_done()
         #
         resume = data.get('resume')
@@ -292,6 +598,12 @@ class Monitor():
                 reply['status'] = 'running'
             else:
                 reply['status'] = 'unknown'
+            if self.exporter is not None:
+                reply['export'] = self.exporter.stats()
+        #
+        stats = data.get('stats')
+        if not stats is None:
+            reply['stats'] = self.telemetry_stats()
         #
         exit_cmd = data.get('exit')
         if not exit_cmd is None and sampler.keep_running == True:
@@ -300,13 +612,36 @@ class Monitor():
         #
         interface = data.get('interface')
         if not interface is None:
-            sampler.set_interface(interface)
-            reply['interface'] = sampler.get_interface()
+            if sampler.keep_running:
+                # Let the sampler thread switch interfaces between two
+                # samples. The estimates are reinitialized when the
+                # sampler reports the new interfaces.
+                self.request_queue.put(('interface',interface))
+                sampler.request_event.set()
+                reply['interface'] = ','.join(interface_list(interface))
+            else:
+                sampler.set_interface(interface)
+                self.init_estimates(sampler.get_interfaces())
+                reply['interface'] = sampler.get_interface()
+        #
+        # Removed before added, so that a link created again under the
+        # same name starts afresh.
+        for command,request in (('remove_interfaces','remove'),('add_interfaces','add')):
+            interfaces = data.get(command)
+            if not interfaces is None:
+                interfaces = interface_list(interfaces)
+                if sampler.keep_running:
+                    self.request_queue.put((request,interfaces))
+                    sampler.request_event.set()
+                else:
+                    getattr(sampler,request + '_interfaces')(interfaces)
+                    self.update_estimates(sampler.get_interfaces())
+                reply[command] = ','.join(interfaces)
         #
         sample_rate = data.get('sample_rate')
         if not sample_rate is None:
             self.set_sample_rate(sampler,sample_rate)
-            reply['sample_rate'] = sampler.get_sample_rate()
+            reply['sample_rate'] = self.get_sample_rate()
         #
         estimation_interval = data.get('estimation_interval')
         if not estimation_interval is None:
@@ -334,306 +669,497 @@ class Monitor():
             reply['cutoff'] = self.cutoff
         #
         if self.debug:
-            self.debugPrint('handle_configuration: ' + repr(self.config_reply) + '.put(' + repr(reply) + ')')
+            self.debugPrint('handle_configuration: reply_to(' + repr(reply) + ')')
 #        pdb.set_trace()
         if reply == {}:
             reply['unknown option(s)'] = data
-        self.config_reply.put(reply)
-        if self.debug:
-            self.debugPrint('handle_configuration: qsize==' + repr(self.config_reply.qsize()))
+        reply_to(reply)
 
 
-    # Get and save an authorization token and its expiration date/time
-    # from Keystone.
+    # Get an authorization token from Keystone, which CeiloComm then
+    # refreshes in the background before it expires.
     # The authorization token is used later when communicating with Ceilometer.
     def get_auth_token(self):
         if self.debug:
             return
-        authtokenpair = self.ceilocomm.getAuthToken(tenantname=self.tenantname,username=self.username,password=self.authpassword)
-        self.authtoken = authtokenpair.get('tok')
-        authexpstr = authtokenpair.get('exp')
-        if authexpstr[-1] == 'Z':
-            expstrUTC = authexpstr[0:-1] # remove the Z
-            local_authexptime = datetime.strptime(expstrUTC,'%Y-%m-%dT%H:%M:%S')
-            local_tz_offset = datetime.fromtimestamp(time.mktime(time.localtime())) - datetime.fromtimestamp(time.mktime(time.gmtime()))
-            authexptime_no_tz = local_authexptime - local_tz_offset # Convert local time to UTC
-            self.authexptime = authexptime_no_tz.replace(tzinfo=UTC())
-        else:
-            self.authexptime = datetime.strptime(authexpstr,'%Y-%m-%dT%H:%M:%S')
+        self.ceilocomm.startTokenRefresh(tenantname=self.tenantname,username=self.username,password=self.authpassword)
+
+
+    # Collect the slots published by the sampler since the last
+    # call, and add them to the slot history and the sliding windows.
+    # This neither waits for nor wakes up the sampler thread.
+    def collect(self, sampler):
+        snapshot = sampler.snapshot
+        rate_data = self.rate_data
+        latest = snapshot.version
+        while self.snapshot_version < latest:
+            self.snapshot_version += 1
+            if snapshot.read_into(rate_data,self.snapshot_version) is None:
+                # We fell too far behind and the sampler has reused
+                # the slot. An empty slot keeps the windows in step
+                # with the time.
+                self.lost_slots += 1
+                self.add_slot([(0, 0.0, 0.0)] * self.slot_width(len(self.estimates)),
+                              array('I'))
+                continue
+            # The sampler may have added or removed interfaces since
+            # the last slot.
+            if list(rate_data['interfaces']) != [est.interface for est in self.estimates]:
+                self.update_estimates(rate_data['interfaces'])
+            samples = rate_data['samples']
+            mean_tx = rate_data['mean_tx']
+            m2_tx = rate_data['m2_tx']
+            mean_rx = rate_data['mean_rx']
+            m2_rx = rate_data['m2_rx']
+            # The slots are merged weighted by time rather than by the
+            # number of samples, since with an adaptive sample rate a
+            # sample of one slot can stand for a longer time than a
+            # sample of another. Each sample stands for one sample
+            # period of its slot.
+            ticks = rate_data['ticks']
+            if ticks > 0:
+                period = (rate_data['end'] - rate_data['start']) / ticks
+            else:
+                period = 0.0
+            item = []
+            for i in range(len(samples)):
+                weight = samples[i] * period
+                item.append((weight, mean_tx[i], m2_tx[i] * period))
+                item.append((weight, mean_rx[i], m2_rx[i] * period))
+            k2 = 2 * len(self.extra_counters)
+            if k2:
+                mean_extra = rate_data['mean_extra']
+                m2_extra = rate_data['m2_extra']
+                for j in range(len(mean_extra)):
+                    item.append((samples[j // k2] * period, mean_extra[j], m2_extra[j] * period))
+            self.add_slot(item, array('I', rate_data['sketch']))
+            self.window_ticks += rate_data['ticks']
+            self.window_time += rate_data['end'] - rate_data['start']
+            self.effective_sample_rate = rate_data['rate']
+
+
+    def add_slot(self, item, counts):
+        self.slots.append((item, counts))
+        for moments, sketches in self.windows.values():
+            moments.push(item)
+            sketches.push(counts)
+        self.slots_since_estimate += 1
+
+
+    # Is a new estimate due, i.e. has the sampler published an
+    # estimation interval's worth of slots since the last one?
+    def estimate_due(self):
+        return self.slots_since_estimate >= self.horizon_slots(self.est_interval)
 
 
     def estimate(self, sampler):
 
-        # A wireless interface can increase or decrease its line rate
-        # so the line rate is checked regularly for WiFi.
-        if (self.interface_type == InterfaceType.Wireless):
-            dummy,self.linerate = self.get_linerate_wireless(sampler.get_interface())
-
-        t = time.time()
+        t = monotonic()
         est_timer = t - self.time_of_last_calc
         self.time_of_last_calc =  t
 
-#        self.request_queue.put('r')
-        self.request_queue.put('rate_data')
-        rate_data = self.sample_queue.get()
-        self.sample_queue.task_done()
-        tx_agg = rate_data['tx_agg']
-        rx_agg = rate_data['rx_agg']
-        samples = rate_data['samples']
-        txb2 = rate_data['txb2']
-        rxb2 = rate_data['rxb2']
+        self.collect(sampler)
+        if self.snapshot_version == 0:
+            return # no slot published yet
+        self.slots_since_estimate = 0
+
+        # The sample rate actually achieved by the sampler since the
+        # last estimation.
+        if self.window_time > 0.0:
+            self.achieved_sample_rate = self.window_ticks / self.window_time
+        self.window_ticks = 0
+        self.window_time = 0.0
+
+        # The line rate of an interface can change, e.g. the bit rate
+        # of a wireless interface, so the latest line rates are
+        # taken from the cache, which is refreshed in the background.
+        # A line rate that is unknown for the moment (e.g. the link is
+        # down) is kept as it was.
+        if self.linerate is None:
+            for est in self.estimates:
+                linerate = self.link_speeds.cached(est.interface)
+                if linerate is not None:
+                    est.linerate = linerate
+
+        self.estimate_window(self.estimates,
+                             self.windows[self.horizon_slots(self.est_interval)])
+        for horizon,estimates in self.horizon_estimates:
+            for i in range(len(estimates)):
+                estimates[i].linerate = self.estimates[i].linerate
+            self.estimate_window(estimates,
+                                 self.windows[self.horizon_slots(horizon)])
+
+        # Adapt the sample rate to the new estimates. The sampler
+        # changes the rate at the start of its next slot.
+        if self.controller is not None:
+            sampler.set_sample_rate(self.controller.update(self.estimates,self.alarm_trigger_value))
+        if self.metrics is not None:
+            self.metrics.update(self.meter_records(datetime.now(tz=UTC())), time.time())
+        self.estimate_timer.add(monotonic() - t)
+        self.cpu_share.update()
+
+        if self.display_data:
+            try:
+                print("\33[H",end="") # move cursor home
+                print("\33[2Ksample_rate (/s): {:d}, effective: {:d}, achieved: {:.1f}, interfaces: {:d}".format(self.get_sample_rate(), self.effective_sample_rate, self.achieved_sample_rate, len(self.estimates)))
+                for est in self.estimates:
+                    print("\33[2Kinterface: {}, linerate (bytes/s): {:d}, link speed (Mbit/s): {:d}".format(est.interface,est.linerate,self.linerate_to_link_speed(est.linerate)))
+                    print("\33[2K  TX(mean: %.2e b/s std: %.2e mu: %.2e s2: %.2e, ol-risk: %.2e, emp-risk: %.2e) "%(est.mean_tx,math.sqrt(est.var_tx),est.mu_tx,est.sigma2_tx, est.overload_risk_tx, est.empirical_risk_tx))
+                    print("\33[2K  RX(mean: %.2e b/s std: %.2e mu: %.2e s2: %.2e, ol-risk: %.2e, emp-risk: %.2e) "%(est.mean_rx,math.sqrt(est.var_rx),est.mu_rx,est.sigma2_rx, est.overload_risk_rx, est.empirical_risk_rx))
+                    for horizon,estimates in self.horizon_estimates:
+                        hest = estimates[self.estimates.index(est)]
+                        print("\33[2K  {:>5g}s: TX(mean: {:.2e} b/s ol-risk: {:.2e}) RX(mean: {:.2e} b/s ol-risk: {:.2e})".format(horizon,hest.mean_tx,hest.overload_risk_tx,hest.mean_rx,hest.overload_risk_rx))
+                print("\33[2Kestimation timer: {:.4f}".format(est_timer))
+                ticks = sampler.scheduler
+                print("\33[2Ktick lateness (ms): mean {:.3f}, max {:.3f}, skipped ticks: {:d}, cpu: {:.1f}%".format(
+                    ticks.lateness_sum / ticks.ticks * 1000 if ticks.ticks else 0.0,
+                    ticks.lateness_max * 1000, ticks.skipped, self.cpu_share.share * 100))
+                print("\33[2Kestimation interval: {:.2f}".format(self.est_interval))
+                print("\33[2Kmeter interval: %d"%(self.meter_interval))
+                print("\33[2Kmode: %d"%(self.mode))
+                if self.debug:
+                    print("\33[2Kdebug: %s"%str(self.debug))
+                    print("\33[2Kslot: %d, lost slots: %d"%(self.snapshot_version,self.lost_slots))
+            except ValueError as ve:
+                print("\33[2KError in display ({}):".format(ve))
+                traceback.print_exc()
+                for est in self.estimates:
+                    print("\33[2K%s: var_tx: %.2e, var_rx: %.2e "%(est.interface,est.var_tx,est.var_rx))
+                print("\33[2Krate_data: %s"%(self.rate_data,))
+                exit(1)
+
 
-        n = samples - self.last_samples
+    # Estimate the given interface estimates from the moments and the
+    # sketches merged over a sliding window of slots.
+    def estimate_window(self,estimates,window):
+        moments, sketches = window
+        merged = moments.aggregate()
+        k2 = 2 * len(self.extra_counters)
+        base = 2 * len(estimates)
+        for i in range(len(estimates)):
+            est = estimates[i]
+            tx = merged[2 * i]
+            rx = merged[2 * i + 1]
+            self.estimate_interface(est,tx[0],tx[1],tx[2],rx[1],rx[2])
+            if k2 and tx[0] > 0:
+                extra = merged[base + i * k2:base + (i + 1) * k2]
+                est.extra_mean = [mean for weight,mean,m2 in extra]
+                est.extra_var = [m2 / weight if weight > 0 else 0.0 for weight,mean,m2 in extra]
+            # The empirical risk does not assume any distribution of
+            # the rates, so it shows when the log-normal fit is off,
+            # e.g. for bimodal traffic.
+            cutoff_rate = est.linerate * self.cutoff
+            est.empirical_risk_tx = SKETCH.tail_probability(SKETCH.counts(sketches.merged, 2 * i), cutoff_rate) * 100
+            est.empirical_risk_rx = SKETCH.tail_probability(SKETCH.counts(sketches.merged, 2 * i + 1), cutoff_rate) * 100
+        # Calculate the overload risk of all interfaces at once.
+        self.estimate_risks(estimates)
+
+
+    # Number of screen lines used by the estimation display (not
+    # counting the debug lines).
+    def display_lines(self):
+        return 6 + (3 + len(self.horizons)) * len(self.estimates)
+
+
+    # Estimate the log-normal parameters of one interface from the
+    # moments of the rates in a window of slots: the weight of the
+    # samples (their total time), and the mean and the weighted sum of
+    # squared deviations from the mean (m2) of each direction (see
+    # moments.py). The overload risk
+    # is computed by estimate_risks().
+    def estimate_interface(self,est,samples,mean_tx,m2_tx,mean_rx,m2_rx):
+        if samples == 0:
+            return
 
         # Approximately kbytes/sec, but not really since we have a
         # measurement jitter of the number of samples recorded in each
         # sampling period. (Usually, by default ms). (The sampling
         # often cannot keep up).
-        self.mean_tx = (tx_agg - self.last_tx_agg) / n
-        self.mean_rx = (rx_agg - self.last_rx_agg) / n
-
-        mean_square_tx = self.mean_tx*self.mean_tx
-        mean_square_rx = self.mean_rx*self.mean_rx
-
-        sum_square_tx = (txb2 - self.last_txb2) / n
-        sum_square_rx = (rxb2 - self.last_rxb2) / n
-
-        # NOTE: Rounding to 5 decimals is perhaps correct if we get
-        # negative variance due to the measurement jitter.
-        # It is not clear why we get a measurement jitter, so why this
-        # is necessary is a somewhat of a mystery.
-        self.var_tx = sum_square_tx - mean_square_tx
-        if self.var_tx < 0:
-            if self.display_data:
-                print("\33[9;1H")  # 
-                print("\33[0J")
-            print("WARNING: self.var_tx == " + str(self.var_tx))
-            self.var_tx = round(sum_square_tx - mean_square_tx,5) # round to avoid negative value
-        self.var_rx = sum_square_rx - mean_square_rx
-        if self.var_rx < 0:
-            if self.display_data:
-                print("\33[10;1H")  # 
-                print("\33[0J")
-            print("WARNING: self.var_rx == " + str(self.var_rx))
-            self.var_rx = round(sum_square_rx - mean_square_rx,5) # round to avoid negative value
+        est.samples = samples
+        est.mean_tx = mean_tx
+        est.mean_rx = mean_rx
 
-        if self.debug and False:
-            print("\33[12;1H")
-            print("\33[0J################### DEBUG ##################")
-            print("\33[0Jest_timer:      %f"%est_timer)
-            print("\33[0Jself.mean_tx:   %f        self.mean_rx:  %f"%(self.mean_tx,self.mean_rx))
-            print("\33[0Jtxb2:           %f        rxb2           %f"%(txb2,rxb2))
-            print("\33[0Jself.last_txb2  %f        self.last_rxb2 %f"%(self.last_txb2,self.last_rxb2))
-            print("\33[0Jmean_square_tx  %f        mean_square_rx %f"%((mean_square_tx),(mean_square_rx)))
-            print("\33[0Jsum_square_tx   %f        sum_square_rx  %f"%(sum_square_tx,sum_square_rx))
-            print("\33[0Jself.var tx:         %f        self.var_rx:        %f"%(self.var_tx,self.var_rx))
+        mean_square_tx = est.mean_tx*est.mean_tx
+        mean_square_rx = est.mean_rx*est.mean_rx
 
-
-        self.last_samples = samples
-
-        self.last_tx_agg = tx_agg
-        self.last_rx_agg = rx_agg
-
-        self.last_txb2 = txb2
-        self.last_rxb2 = rxb2
+        # Unlike the difference of the sum of squares and the squared
+        # mean that was used before, m2 cannot be negative, so no
+        # rounding is needed.
+        est.var_tx = m2_tx / samples
+        est.var_rx = m2_rx / samples
 
         # Estimate the moments
         try:
-            if self.mean_tx != 0.0:
-                self.sigma2_tx = math.log(1.0+(self.var_tx/mean_square_tx))
-                self.mu_tx = math.log(self.mean_tx) - (self.sigma2_tx/2.0)
+            if est.mean_tx != 0.0:
+                est.sigma2_tx = math.log(1.0+(est.var_tx/mean_square_tx))
+                est.mu_tx = math.log(est.mean_tx) - (est.sigma2_tx/2.0)
             else:
-#                self.sigma2_tx = float('nan')
-                self.sigma2_tx = 0.0
-                self.mu_tx = 0.0
+#                est.sigma2_tx = float('nan')
+                est.sigma2_tx = 0.0
+                est.mu_tx = 0.0
 
-            if self.mean_rx != 0.0:
-                self.sigma2_rx = math.log(1.0+(self.var_rx/(mean_square_rx)))
-                self.mu_rx = math.log(self.mean_rx) - (self.sigma2_rx/2.0)
+            if est.mean_rx != 0.0:
+                est.sigma2_rx = math.log(1.0+(est.var_rx/(mean_square_rx)))
+                est.mu_rx = math.log(est.mean_rx) - (est.sigma2_rx/2.0)
             else:
-#                self.sigma2_rx = float('nan')
-                self.sigma2_rx = 0.0
-                self.mu_rx = 0.0
-
-        # Calculate the overload risk
-
-## Based on the original code, using the CDF (Cumulative Distribution Function).
-#            self.overload_risk_tx = (1-lognorm.cdf(self.linerate * self.cutoff,math.sqrt(self.sigma2_tx),0,math.exp(self.mu_tx)))*100
-#            self.overload_risk_rx = (1-lognorm.cdf(self.linerate * self.cutoff,math.sqrt(self.sigma2_rx),0,math.exp(self.mu_rx)))*100
-
-## Using the survival function (1 - cdf). See http://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.lognorm.html for a motivation).
-            self.overload_risk_tx = (lognorm.sf(self.linerate * self.cutoff,math.sqrt(self.sigma2_tx),0,math.exp(self.mu_tx)))*100
-            self.overload_risk_rx = (lognorm.sf(self.linerate * self.cutoff,math.sqrt(self.sigma2_rx),0,math.exp(self.mu_rx)))*100
-
-### According to our dicussion, using the PPF (Percentile Point Function (or Quantile function).
-#            self.cutoff_rate_tx = (1-lognorm.ppf( self.cutoff,math.sqrt(self.sigma2_tx),0,math.exp(self.mu_tx)))
-#            self.cutoff_rate_rx = (1-lognorm.ppf( self.cutoff,math.sqrt(self.sigma2_rx),0,math.exp(self.mu_rx)))
-            # To estimate a risk: compare the calculated cutoff rate with the nominal line rate.
+#                est.sigma2_rx = float('nan')
+                est.sigma2_rx = 0.0
+                est.mu_rx = 0.0
 
         except ValueError as ve:
             if self.display_data:
                 print("\33[2K")
-            print("Error in estimation: ({}):".format(ve))
+            print("Error in estimation of {} ({}):".format(est.interface,ve))
             traceback.print_exc()
             if self.display_data:
                 print("\33[2K")
-            print("mean_tx: %.2e, mean_rx: %.2e "%(self.mean_tx,self.mean_rx))
+            print("mean_tx: %.2e, mean_rx: %.2e "%(est.mean_tx,est.mean_rx))
             if self.display_data:
                 print("\33[2K")
-            print("var_tx: %.2e, var_rx: %.2e "%(self.var_tx,self.var_rx))
+            print("var_tx: %.2e, var_rx: %.2e "%(est.var_tx,est.var_rx))
             if self.display_data:
                 print("\33[2K")
             print("mean_square_tx: %.2e, mean_square_rx: %.2e "%(mean_square_tx,mean_square_rx))
             if self.display_data:
                 print("\33[2K")
-            print("rate_data: %s"%(rate_data,))
+            print("rate_data: %s"%((samples,mean_tx,m2_tx,mean_rx,m2_rx),))
             exit(1)
 
-        if self.display_data:
-            try:
-                print("\33[H",end="") # move cursor home
-    # [PD] 2016-05-23, The calculation of "actual" seems to be buggy.
-    #            print("\33[2KEstimate (sample_rate: {:d} actual({:d}), interface: {}, linerate: {:d}".format(sampler.get_sample_rate(), n, sampler.get_interface(),self.linerate))
-                print("\33[2Ksample_rate (/s): {:d}, interface: {}, linerate (bytes/s): {:d}, link speed (Mbit/s): {:d}".format(sampler.get_sample_rate(), sampler.get_interface(),self.linerate,self.link_speed))
-                print("\33[2KTX(mean: %.2e b/s std: %.2e mu: %.2e s2: %.2e, ol-risk: %.2e) "%(self.mean_tx,math.sqrt(self.var_tx),self.mu_tx,self.sigma2_tx, self.overload_risk_tx))
-                print("\33[2KRX(mean: %.2e b/s std: %.2e mu: %.2e s2: %.2e, ol-risk: %.2e) "%(self.mean_rx,math.sqrt(self.var_rx),self.mu_rx,self.sigma2_rx, self.overload_risk_rx))
-                print("\33[2Kestimation timer: {:.4f}".format(est_timer))
-                print("\33[2Kestimation interval: {:.2f}".format(self.est_interval))
-                print("\33[2Kmeter interval: %d"%(self.meter_interval))
-                print("\33[2Kmode: %d"%(self.mode))
-                if self.debug:
-                    print("\33[2Kdebug: %s"%str(self.debug))
-                    print("\33[2Ksample_queue size: %s"%str(self.sample_queue.qsize()))
-            except ValueError as ve:
-                print("\33[2KError in display ({}):".format(ve))
-                traceback.print_exc()
-                print("\33[2Kvar_tx: %.2e, var_rx: %.2e "%(self.var_tx,self.var_rx))
-                print("\33[2Krate_data: %s"%(rate_data,))
-                exit(1)
+    # Calculate the overload risk of the interfaces.
+    def estimate_risks(self,estimates):
+        cutoff_rates = [est.linerate * self.cutoff for est in estimates]
+
+## Based on the original code, using the CDF (Cumulative Distribution Function).
+#            est.overload_risk_tx = (1-lognorm.cdf(est.linerate * self.cutoff,math.sqrt(est.sigma2_tx),0,math.exp(est.mu_tx)))*100
+
+## Using the survival function (1 - cdf). See http://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.lognorm.html for a motivation).
+## The survival function is computed in closed form by riskkernel.py.
+        risks_tx = lognorm_sf_many(cutoff_rates,
+                                   [est.mu_tx for est in estimates],
+                                   [est.sigma2_tx for est in estimates])
+        risks_rx = lognorm_sf_many(cutoff_rates,
+                                   [est.mu_rx for est in estimates],
+                                   [est.sigma2_rx for est in estimates])
+        for i in range(len(estimates)):
+            estimates[i].overload_risk_tx = risks_tx[i] * 100
+            estimates[i].overload_risk_rx = risks_rx[i] * 100
 
-        # FIXME: It should not be necessary to empty the queue here
-        # anymore, since the monitor code only puts stuff in the Queue
-        # on request.
-        # Verify this before remove this while loop!
-        while not self.sample_queue.empty():
-            self.sample_queue.get()
-            self.sample_queue.task_done()
+### According to our dicussion, using the PPF (Percentile Point Function (or Quantile function).
+#            est.cutoff_rate_tx = riskkernel.lognorm_ppf(self.cutoff,est.mu_tx,est.sigma2_tx)
+            # To estimate a risk: compare the calculated cutoff rate with the nominal line rate.
 
-    # Return a tuple with interface type and linerate
+
+    # Return a tuple with interface type and linerate (in bytes/s, or
+    # None if it cannot be determined), from the cache of line rates
+    # if it is fresh.
     def get_linerate(self,interface):
         if OS == OS_type.darwin:      # Fake it on OS X
             # 1 Gbit/s in bytes/s (NOTE: 1000, not 1024; see IEEE 802.3-2008)
-            lr = (InterfaceType.Ethernet,(1000*1000*1000)/8)
-        else:
-            lr = self.get_linerate_ethernet(interface)
-            if lr is None:
-                lr = self.get_linerate_wireless(interface)
-        return lr
-
-    def get_linerate_ethernet(self,interface):
-        try:
-            # The link speed in Mbits/sec.
-            with open("/sys/class/net/{interface}/speed".format(interface=interface)) as f:
-                speed = int(f.read()) * 1000 * 1000 / 8 # convert to bytes/s (NOTE: 1000, not 1024; see IEEE 802.3-2008)
-        except IOError:
-            speed = None
-        finally:
-            return InterfaceType.Ethernet,speed
-
-    def get_linerate_wireless(self,interface):
-        try:
-            iwres = iwconfig(interface,_ok_code=[0,1])
-            rx = re.compile("Bit Rate=([0-9]+)\s*Mb/s", re.MULTILINE | re.IGNORECASE)
-            lrg = rx.search(iwres)
-            if lrg.groups() != ():
-                bit_rate = int(lrg.group(1)) # Mbits/s
-                lr = (InterfaceType.Wireless,bit_rate * 1000 * 1000 / 8) # convert Mbit/s to bytes/s (NOTE: 1000, not 1024; see IEEE 802.3-2008)
-                return lr
-            else:
-                return None,None
-        except ErrorReturnCode:
-            return None,None
+            return (InterfaceType.Ethernet,(1000*1000*1000)/8)
+        wireless,linerate = self.link_speeds.lookup(interface)
+        if wireless:
+            return InterfaceType.Wireless,linerate
+        return InterfaceType.Ethernet,linerate
 
 
-    # Store metered data in Ceilometer
+    # Store metered data in Ceilometer, one record per sampled interface.
     def meter(self):
-        t = time.time()
+        t = monotonic()
         self.time_of_last_meter = t
 
-        alarm_value_tx = self.overload_risk_tx > self.alarm_trigger_value
-        alarm_value_rx = self.overload_risk_rx > self.alarm_trigger_value
-
         now = datetime.now(tz=UTC())
-        nowstr = now.strftime('%Y-%m-%dT%H.%M.%S')
-        data = {'timestamp': nowstr,
-                'interface': repr(self.sampler.get_interface()),
-                'linerate': repr(self.linerate),
-                'alarm_trigger_value': repr(self.alarm_trigger_value),
-                'cutoff': repr(self.cutoff),
-                'tx': repr(self.mean_tx),
-                'var_tx': repr(self.var_tx),
-                'mu_tx': repr(self.mu_tx),
-                'sigma2_tx': repr(self.sigma2_tx),
-                'overload_risk_tx': repr(self.overload_risk_tx),
-                'alarm_tx': repr(alarm_value_tx),
-                'rx': repr(self.mean_rx),
-                'var_rx': repr(self.var_rx),
-                'mu_rx': repr(self.mu_rx),
-                'sigma2_rx': repr(self.sigma2_rx),
-                'overload_risk_rx': repr(self.overload_risk_rx),
-                'alarm_rx': repr(alarm_value_rx),
-                'sample_rate': repr(self.sampler.get_sample_rate()),
-                'estimation_interval': repr(self.est_interval),
-                'meter_interval': repr(self.meter_interval)}
-        self.ceilorecord(now,data)
+        for data in self.meter_records(now):
+            self.ceilorecord(now,data)
+        self.meter_timer.add(monotonic() - t)
+
+
+    # The meter records of the current estimates at the given time (a
+    # datetime in UTC), one per interface.
+    def meter_records(self,now):
+        records = []
+        for i in range(len(self.estimates)):
+            est = self.estimates[i]
+            alarm_value_tx = est.overload_risk_tx > self.alarm_trigger_value
+            alarm_value_rx = est.overload_risk_rx > self.alarm_trigger_value
+
+            data = {'timestamp': now,
+                    'interface': est.interface,
+                    'linerate': est.linerate,
+                    'alarm_trigger_value': self.alarm_trigger_value,
+                    'cutoff': self.cutoff,
+                    'tx': est.mean_tx,
+                    'var_tx': est.var_tx,
+                    'mu_tx': est.mu_tx,
+                    'sigma2_tx': est.sigma2_tx,
+                    'overload_risk_tx': est.overload_risk_tx,
+                    'empirical_risk_tx': est.empirical_risk_tx,
+                    'alarm_tx': alarm_value_tx,
+                    'rx': est.mean_rx,
+                    'var_rx': est.var_rx,
+                    'mu_rx': est.mu_rx,
+                    'sigma2_rx': est.sigma2_rx,
+                    'overload_risk_rx': est.overload_risk_rx,
+                    'empirical_risk_rx': est.empirical_risk_rx,
+                    'alarm_rx': alarm_value_rx,
+                    'sample_rate': self.get_sample_rate(),
+                    'effective_sample_rate': self.effective_sample_rate,
+                    'achieved_sample_rate': self.achieved_sample_rate,
+                    'estimation_interval': self.est_interval,
+                    'meter_interval': self.meter_interval,
+                    'horizons': list(self.horizons)}
+            if self.exporter is not None:
+                stats = self.exporter.stats()
+                data['export_queue_depth'] = stats['queue_depth']
+                data['export_dropped'] = stats['dropped'] + stats['failed']
+                data['export_latency'] = stats['latency_mean']
+            if self.meter_telemetry:
+                data.update(self.telemetry_fields())
+            # The rates of the extra counters (per second) over the
+            # estimation interval, e.g. dropped_rx and var_dropped_rx,
+            # and the log-normal parameters of the packet rates (see
+            # meterformat.COUNTER_FIELDS).
+            for j in range(len(self.extra_counters)):
+                counter = self.extra_counters[j]
+                for d,direction in enumerate(('tx','rx')):
+                    if EXTRA_COUNTERS[counter][d] is None:
+                        continue
+                    name = counter + '_' + direction
+                    if est.extra_mean:
+                        mean,var = est.extra_mean[2 * j + d],est.extra_var[2 * j + d]
+                    else:
+                        mean,var = 0.0,0.0
+                    data[name] = mean
+                    data['var_' + name] = var
+                    if counter == 'packets':
+                        data['mu_' + name],data['sigma2_' + name] = lognormal_parameters(mean,var)
+            # The estimates over each horizon, e.g. overload_risk_tx_60s
+            # for the 60 second horizon.
+            for horizon,estimates in self.horizon_estimates:
+                hest = estimates[i]
+                suffix = horizon_suffix(horizon)
+                data['tx' + suffix] = hest.mean_tx
+                data['var_tx' + suffix] = hest.var_tx
+                data['mu_tx' + suffix] = hest.mu_tx
+                data['sigma2_tx' + suffix] = hest.sigma2_tx
+                data['overload_risk_tx' + suffix] = hest.overload_risk_tx
+                data['empirical_risk_tx' + suffix] = hest.empirical_risk_tx
+                data['rx' + suffix] = hest.mean_rx
+                data['var_rx' + suffix] = hest.var_rx
+                data['mu_rx' + suffix] = hest.mu_rx
+                data['sigma2_rx' + suffix] = hest.sigma2_rx
+                data['overload_risk_rx' + suffix] = hest.overload_risk_rx
+                data['empirical_risk_rx' + suffix] = hest.empirical_risk_rx
+            records.append(data)
+        return records
+
+
+    # The self-telemetry of the monitor, as returned by the stats
+    # command: the tick statistics of the sampler (see scheduler.py),
+    # the time spent in each stage (see telemetry.py), the depths of
+    # the queues, the statistics of the exporter and the sinks, and
+    # the share of a CPU used by the monitor process. snapshot is the
+    # number of slots the sampler has published that the monitor has
+    # not yet collected.
+    def telemetry_stats(self):
+        sampler = self.sampler
+        stats = {'sampler': sampler.scheduler.stats(),
+                 'achieved_sample_rate': self.achieved_sample_rate,
+                 'lost_slots': self.lost_slots,
+                 'stages': {'get_interface_data': sampler.read_timer.stats(),
+                            'estimate': self.estimate_timer.stats(),
+                            'meter': self.meter_timer.stats()},
+                 'queues': {'request_queue': self.request_queue.qsize(),
+                            'config_queue': self.config_queue.qsize(),
+                            'snapshot': sampler.snapshot.version - self.snapshot_version},
+                 'cpu_share': self.cpu_share.update()}
+        if self.exporter is not None:
+            stats['export'] = self.exporter.stats()
+            stats['queues']['export_queue'] = stats['export']['queue_depth']
+        if self.ceilocomm is not None:
+            stats['sinks'] = self.ceilocomm.stats()
+        if self.link_watcher is not None:
+            stats['links'] = self.link_watcher.stats()
+            stats['links']['read_errors'] = sampler.read_errors
+        if self.link_speeds is not None:
+            stats['link_speeds'] = self.link_speeds.stats()
+        return stats
+
+
+    # The self-telemetry added to the meter records with
+    # meter_telemetry (see meterformat.TELEMETRY_FIELDS). The times are
+    # in seconds, and the tick and stage statistics are those since
+    # the sampler was started.
+    def telemetry_fields(self):
+        ticks = self.sampler.scheduler
+        return {'telemetry_skipped_ticks': ticks.skipped,
+                'telemetry_lateness_mean': ticks.lateness_sum / ticks.ticks if ticks.ticks else 0.0,
+                'telemetry_lateness_max': ticks.lateness_max,
+                'telemetry_read_time': self.sampler.read_timer.mean(),
+                'telemetry_estimate_time': self.estimate_timer.mean(),
+                'telemetry_meter_time': self.meter_timer.mean(),
+                'telemetry_lost_slots': self.lost_slots,
+                'telemetry_sink_errors': self.ceilocomm.stats()['errors'] if self.ceilocomm is not None else 0,
+                'telemetry_cpu_share': self.cpu_share.share}
 
 
     def ceilomessage(self,message):
         now = datetime.now(tz=UTC())
         nowstr = now.strftime('%Y-%m-%dT%H:%M:%S')
-        data = {message: repr(nowstr)}
+        data = {message: nowstr}
         self.ceilorecord(now,data)
 
 
+    # Queue a record for export.
     def ceilorecord(self,now,data):
-        if not self.debug:
-            # Check if the authorization token has expired.
-            # Add one minute margin for possible bad time sync.
-            delta = timedelta(minutes=1)
-            if now + delta > self.authexptime:
-                self.get_auth_token()
         if self.display_data:
-            print("\33[15;1H")
+            print("\33[%d;1H"%(self.display_lines() + 7))
             print("\33[0J")      # clear rest of screen
         if self.debug:
-            print("\33[0J" + str(data))
+            print("\33[0J" + str(to_json(data)))
         else:
-            rjson = self.ceilocomm.putMeter(self.meter_name,data,self.authtoken,
-                                            username=self.username,
-                                            project_id=self.project_ID,
-                                            resource_id=self.resource_ID)
+            self.exporter.put(data)
             if self.display_data:
-                print(json.dumps(rjson,indent=4))
+                stats = self.exporter.stats()
+                print("export queue: %d, exported: %d, dropped: %d, failed: %d, latency (s): %.3f"%(
+                    stats['queue_depth'],stats['exported'],stats['dropped'],stats['failed'],stats['latency_last']))
+
+
+    # Export a record; called by the exporter thread.
+    def export_record(self,data):
+        self.ceilocomm.putMeter(self.meter_name,data,self.ceilocomm.authToken(),
+                                username=self.username,
+                                project_id=self.project_ID,
+                                resource_id=self.resource_ID)
 
 
     def main(self):
-        self.time_of_last_meter = self.time_of_last_calc = time.time()
+        self.time_of_last_meter = self.time_of_last_calc = monotonic()
         # Sampling is done in a separate thread to avoid
         # introducing a delay jitter in our measurements.
 #        self.sampler.setDaemon(True)
         self.sampler.start()
-        sleep_time = min(self.est_interval,self.meter_interval)
-
-        # Start the thread listening for configuration messages
-        conflistener = Thread(target=self.listen_for_configuration)
-        conflistener.setDaemon(True)
-        conflistener.start()
 
-### FIXME:
-#   The conflistener may not be completely initialized when ceilocomm
-#   starts sending messages on the local port (in mode 1).
-#   We should wait for the conflistener to initialize before
-#   proceeding here.
+        # Start the thread listening for configuration messages. The
+        # server is listening before the first message is sent.
+        if self.conflistenerport is None:
+            self.conf_server = None
+        else:
+            self.conf_server = createConfServer(self.conflistener_IP,self.conflistenerport,self)
+            conflistener = Thread(target=self.conf_server.serve_forever)
+            conflistener.setDaemon(True)
+            conflistener.start()
+
+        # Start following the links of the host
+        if self.link_watcher is not None:
+            self.link_watcher.start()
+        self.link_speeds.start()
+
+        # Start the thread serving the latest estimates to scrapers
+        if self.metrics is not None:
+            metrics_server = createMetricsServer(self.metrics_host,self.metrics_port,self.metrics)
+            metricslistener = Thread(target=metrics_server.serve_forever)
+            metricslistener.setDaemon(True)
+            metricslistener.start()
 
         if self.display_data:
             print("\33[2J")         # clear screen
@@ -644,7 +1170,7 @@ class Monitor():
                 if not self.config_queue.empty():
                     if self.debug:
                         self.debugPrint('main loop: handle_configuration()')
-                    self.handle_configuration(self.sampler,self.config_queue,self.config_reply)
+                    self.handle_configuration(self.sampler,self.config_queue)
                     continue
                     
 #                if self.status_sampler(self.sampler) == 'stopped':
@@ -652,15 +1178,25 @@ class Monitor():
                     self.conf_event.wait()
                     continue
 
-                timestamp = time.time()
-                # time to do an estimation?
-                if timestamp >= (self.time_of_last_calc  + self.est_interval):
-                    self.estimate(self.sampler)
+                # has the sampler published new slots?
+                if self.sampler.snapshot.version != self.snapshot_version:
+                    self.collect(self.sampler)
+                    # time to do an estimation?
+                    if self.estimate_due():
+                        self.estimate(self.sampler)
+                timestamp = monotonic()
                 # time to store a meter value?
                 if timestamp >= (self.time_of_last_meter  + self.meter_interval):
                     self.meter()        
-                self.conf_event.wait(sleep_time)
+                # Sleep until the sampler publishes its current slot or
+                # the next meter value is due, whichever comes first.
+                next_meter = self.time_of_last_meter + self.meter_interval
+                sleep_time = min(self.sampler.window_end, next_meter) - monotonic()
+                self.conf_event.wait(min(max(sleep_time, 0.001), self.slot_length))
                 self.conf_event.clear()
+            # Send the reply to the exit command before exiting.
+            if self.conf_server is not None:
+                self.conf_server.shutdown()
             print('exit')
 
         except KeyboardInterrupt:
@@ -670,5 +1206,12 @@ class Monitor():
     def exit(self):
         self.stop_sampler() # make sure the sampler thread is stopped in an
                             # orderly manner 
+        if self.link_watcher is not None:
+            self.link_watcher.stop()
+        self.link_speeds.stop()
         self.ceilomessage('exited')
+        if self.exporter is not None:
+            self.exporter.close()
+        if self.ceilocomm is not None:
+            self.ceilocomm.close()
         self.exit_flag = True
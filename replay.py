@@ -0,0 +1,542 @@
+#!/usr/bin/python2.7
+
+# Copyright 2016 SICS Swedish ICT AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+# Offline replay of recorded interface counters, to try out sample
+# rates, estimation intervals, cutoffs and alarm triggers on recorded
+# traffic instead of on live traffic, one configuration at a time.
+#
+# A trace is a text file (possibly gzipped) with one line per reading
+# of the counters:
+#
+#     # interfaces: eth0,eth1
+#     1458043200.000 <tx_bytes eth0> <rx_bytes eth0> <tx_bytes eth1> <rx_bytes eth1>
+#     1458043200.010 ...
+#
+# The first column is the time of the reading in seconds since the
+# epoch, the others are the tx and rx byte counters of each interface
+# (separated by spaces or commas). Lines starting with # are comments,
+# except the optional interfaces line. 'replay.py record' records such
+# a trace with any of the counter sources of the monitor.
+#
+# 'replay.py run' feeds the readings through the monitor's own Sampler
+# and estimation code (see ReplayMonitor) on a virtual clock that
+# follows the timestamps of the trace, as fast as it can. The trace is
+# read once for a whole grid of configurations:
+#
+#   - Each sample rate gets a Sampler, fed by a FakeCounterSource.
+#     Its tick scheduler picks the readings at or after each deadline,
+#     which decimates the trace to the sample rate (a trace recorded
+#     at a lower rate is used as it is).
+#   - Each estimation interval gets a ReplayMonitor that reads the
+#     windows of its Sampler, as the live monitor does.
+#   - The cutoffs and alarm triggers do not change the moments, only
+#     the risks computed from them, so the risks of all cutoffs are
+#     computed together after each estimation, in one call to the risk
+#     kernel.
+#
+# The meter records of each configuration are the ones the live
+# monitor would have written, with the time of the trace as their
+# timestamp. The summary of each configuration counts the estimations
+# with an alarm on any interface, and the alarm episodes (runs of such
+# estimations).
+
+import sys
+import json
+import time
+from datetime import datetime
+from Queue import Queue
+from counters import FakeCounterSource
+from monitor import Monitor
+from sampler import Sampler, SKETCH, interface_list
+from riskkernel import lognorm_sf_many
+from meterformat import to_json, encode, horizon_suffix
+from telemetry import StageTimer, CpuShare
+from utc import UTC
+
+
+# A clock that shows the time of the trace reading being replayed.
+class VirtualClock(object):
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+# The alarms of one configuration.
+class AlarmStats(object):
+    def __init__(self):
+        self.estimations = 0
+        self.alarms = 0             # estimations with an alarm
+        self.episodes = 0           # runs of estimations with an alarm
+        self.first_alarm = None     # trace time of the first alarm
+        self.max_risk = 0.0
+        self.alarm = False
+        self.meters = 0
+        self.alarm_meters = 0       # meter records with an alarm
+
+    def estimation(self, timestamp, risks, alarm_trigger_value):
+        self.estimations += 1
+        risk = max([max(r[0], r[1]) for r in risks] or [0.0])
+        self.max_risk = max(self.max_risk, risk)
+        alarm = risk > alarm_trigger_value
+        if alarm:
+            self.alarms += 1
+            if not self.alarm:
+                self.episodes += 1
+            if self.first_alarm is None:
+                self.first_alarm = timestamp
+        self.alarm = alarm
+
+
+# A Monitor without the sampler thread, the configuration server and
+# the sinks: the replay feeds it the windows of a Sampler, and it makes
+# the same estimations and meter records as the live monitor. The risks
+# and alarms are evaluated for each of the given cutoffs and alarm
+# triggers.
+class ReplayMonitor(Monitor):
+    def __init__(self, sampler, link_speed, estimation_interval,
+                 meter_interval, cutoffs, alarm_triggers, horizons=()):
+        self.debug = False
+        self.log = False
+        self.display_data = False
+        self.mode = 0
+        self.controller = None
+        self.exporter = None
+        self.ceilocomm = None
+        self.sample_ring = None
+        self.meter_telemetry = False
+        self.metrics = None
+        self.link_watcher = None
+        self.link_speeds = None
+        self.extra_counters = sampler.get_extra_counters()
+        self.estimate_timer = StageTimer()
+        self.meter_timer = StageTimer()
+        self.cpu_share = CpuShare()
+        self.linerate = None
+        self.set_linerate(link_speed)
+        self.cutoffs = list(cutoffs)
+        self.alarm_triggers = list(alarm_triggers)
+        self.set_cutoff(self.cutoffs[0])
+        self.set_alarm_trigger(self.alarm_triggers[0])
+        self.est_interval = estimation_interval
+        self.horizons = sorted(set(horizons))
+        self.slot_length = sampler.window_length
+        self.meter_interval = meter_interval
+        self.sampler = sampler
+        self.achieved_sample_rate = 0.0
+        self.effective_sample_rate = sampler.get_sample_rate()
+        self.snapshot_version = sampler.snapshot.version
+        self.rate_data = sampler.snapshot.reader_buffer()
+        self.time_of_last_calc = self.time_of_last_meter = sampler.scheduler.clock()
+        self.init_estimates(sampler.get_interfaces())
+        # cutoff -> [(suffix, risks of the interfaces)], see cutoff_risks()
+        self.risks = {}
+        self.stats = dict(((cutoff, trigger), AlarmStats())
+                          for cutoff in self.cutoffs
+                          for trigger in self.alarm_triggers)
+
+    # The overload and empirical risks (in percent) of the estimates
+    # for each cutoff: a dict of cutoff -> a list of (overload_risk_tx,
+    # overload_risk_rx, empirical_risk_tx, empirical_risk_rx), one per
+    # interface.
+    def cutoff_risks(self, estimates, window):
+        moments, sketches = window
+        rates = []
+        mus = []
+        sigma2s = []
+        for cutoff in self.cutoffs:
+            for est in estimates:
+                rate = est.linerate * cutoff / 100.0
+                rates.extend([rate, rate])
+                mus.extend([est.mu_tx, est.mu_rx])
+                sigma2s.extend([est.sigma2_tx, est.sigma2_rx])
+        sf = lognorm_sf_many(rates, mus, sigma2s)
+        counts = [SKETCH.counts(sketches.merged, k) for k in range(2 * len(estimates))]
+        risks = {}
+        k = 0
+        for cutoff in self.cutoffs:
+            risks[cutoff] = []
+            for i in range(len(estimates)):
+                rate = rates[k]
+                risks[cutoff].append((sf[k] * 100, sf[k + 1] * 100,
+                                      SKETCH.tail_probability(counts[2 * i], rate) * 100,
+                                      SKETCH.tail_probability(counts[2 * i + 1], rate) * 100))
+                k += 2
+        return risks
+
+    def estimate(self, sampler):
+        Monitor.estimate(self, sampler)
+        risks = [('', self.cutoff_risks(self.estimates,
+                                        self.windows[self.horizon_slots(self.est_interval)]))]
+        for horizon, estimates in self.horizon_estimates:
+            risks.append((horizon_suffix(horizon),
+                          self.cutoff_risks(estimates, self.windows[self.horizon_slots(horizon)])))
+        timestamp = sampler.scheduler.clock()
+        self.risks = {}
+        for cutoff in self.cutoffs:
+            self.risks[cutoff] = [(suffix, window_risks[cutoff]) for suffix, window_risks in risks]
+            for trigger in self.alarm_triggers:
+                self.stats[(cutoff, trigger)].estimation(timestamp, risks[0][1][cutoff], trigger)
+
+    # The meter records of each configuration at the given trace time:
+    # a list of ((cutoff, alarm_trigger), records).
+    def replay_meter(self, timestamp):
+        self.time_of_last_meter = timestamp
+        records = self.meter_records(datetime.fromtimestamp(timestamp, UTC()))
+        result = []
+        for cutoff in self.cutoffs:
+            for trigger in self.alarm_triggers:
+                stats = self.stats[(cutoff, trigger)]
+                point_records = []
+                for i in range(len(records)):
+                    data = dict(records[i])
+                    data['cutoff'] = cutoff / 100.0
+                    data['alarm_trigger_value'] = trigger
+                    for suffix, risks in self.risks.get(cutoff, []):
+                        risk_tx, risk_rx, empirical_tx, empirical_rx = risks[i]
+                        data['overload_risk_tx' + suffix] = risk_tx
+                        data['overload_risk_rx' + suffix] = risk_rx
+                        data['empirical_risk_tx' + suffix] = empirical_tx
+                        data['empirical_risk_rx' + suffix] = empirical_rx
+                    data['alarm_tx'] = data['overload_risk_tx'] > trigger
+                    data['alarm_rx'] = data['overload_risk_rx'] > trigger
+                    stats.meters += 1
+                    if data['alarm_tx'] or data['alarm_rx']:
+                        stats.alarm_meters += 1
+                    point_records.append(data)
+                result.append(((cutoff, trigger), point_records))
+        return result
+
+
+# The Sampler of one sample rate and the monitors reading it.
+class ReplayGroup(object):
+    def __init__(self, interfaces, sample_rate, slot_length, monitor_args,
+                 estimation_intervals, counter_bits=64):
+        self.clock = VirtualClock()
+        self.source = FakeCounterSource(interfaces, clock=self.clock,
+                                        counter_bits=counter_bits)
+        self.sampler = Sampler(Queue(), sample_rate, self, interface=interfaces,
+                               counter_source=self.source, tick_policy='skip',
+                               window_length=slot_length, clock=self.clock)
+        self.sample_rate = sample_rate
+        self.monitor_args = monitor_args
+        self.estimation_intervals = estimation_intervals
+        self.monitors = None
+
+    # The sampler reports counter wraps here.
+    def debugPrint(self, tracestring):
+        pass
+
+    def set_counters(self, tx, rx):
+        counters = self.source.counters
+        for i, interface in enumerate(self.source.interfaces):
+            counters[interface] = [tx[i], rx[i]]
+
+    # Take the first reading, and start the monitors at its time.
+    def start(self, timestamp, tx, rx):
+        self.clock.now = timestamp
+        self.set_counters(tx, rx)
+        sampler = self.sampler
+        sampler.last_data = sampler.get_interface_data()
+        sampler.start_window(timestamp)
+        sampler.scheduler.start()
+        sampler.scheduler.reset_stats()
+        self.monitors = [ReplayMonitor(sampler, estimation_interval=interval, **self.monitor_args)
+                         for interval in self.estimation_intervals]
+
+    # Feed a reading to the sampler if it is due, and the finished
+    # windows to the monitors. Returns the meter records that are due,
+    # as a list of (configuration, records), where a configuration is
+    # (sample_rate, estimation_interval, cutoff, alarm_trigger).
+    def feed(self, timestamp, tx, rx):
+        if self.monitors is None:
+            self.start(timestamp, tx, rx)
+            return []
+        self.clock.now = timestamp
+        scheduler = self.sampler.scheduler
+        if timestamp < scheduler.deadline:
+            return []
+        scheduler.record(timestamp - scheduler.deadline)
+        scheduler.advance(timestamp)
+        self.set_counters(tx, rx)
+        sampler = self.sampler
+        sampler.sample()
+        sampler.window_ticks += 1
+        if timestamp >= sampler.window_end:
+            sampler.end_window(timestamp)
+            for monitor in self.monitors:
+                monitor.collect(sampler)
+                if monitor.estimate_due():
+                    monitor.estimate(sampler)
+        result = []
+        for monitor in self.monitors:
+            if timestamp >= monitor.time_of_last_meter + monitor.meter_interval:
+                for (cutoff, trigger), records in monitor.replay_meter(timestamp):
+                    result.append(((self.sample_rate, monitor.est_interval, cutoff, trigger),
+                                   records))
+        return result
+
+
+# Replays a trace for a grid of configurations. on_records is called
+# with each configuration (sample_rate, estimation_interval, cutoff,
+# alarm_trigger) and its meter records, when they are due.
+class Replay(object):
+    def __init__(self, interfaces, link_speed, sample_rates=(1000,),
+                 estimation_intervals=(10.0,), cutoffs=(99,),
+                 alarm_triggers=(95,), meter_interval=30.0, horizons=(),
+                 counter_bits=64, on_records=None):
+        self.interfaces = interface_list(interfaces)
+        # The slots are short enough for all estimation intervals and
+        # horizons, like those of the live monitor.
+        slot_length = min([1.0] + list(estimation_intervals) + list(horizons))
+        monitor_args = {'link_speed': link_speed,
+                        'meter_interval': meter_interval,
+                        'cutoffs': cutoffs,
+                        'alarm_triggers': alarm_triggers,
+                        'horizons': horizons}
+        self.groups = [ReplayGroup(self.interfaces, rate, slot_length, monitor_args,
+                                   estimation_intervals, counter_bits)
+                       for rate in sample_rates]
+        self.on_records = on_records
+        self.readings = 0
+        self.first = self.last = None
+
+    def feed(self, timestamp, tx, rx):
+        if self.first is None:
+            self.first = timestamp
+        self.last = timestamp
+        self.readings += 1
+        for group in self.groups:
+            for configuration, records in group.feed(timestamp, tx, rx):
+                if self.on_records is not None:
+                    self.on_records(configuration, records)
+
+    def run(self, readings):
+        for timestamp, tx, rx in readings:
+            self.feed(timestamp, tx, rx)
+
+    # The length of the replayed trace in seconds.
+    def duration(self):
+        if self.first is None:
+            return 0.0
+        return self.last - self.first
+
+    # The alarm statistics of each configuration, as a list of dicts.
+    def summary(self):
+        result = []
+        for group in self.groups:
+            for monitor in group.monitors or []:
+                for cutoff in monitor.cutoffs:
+                    for trigger in monitor.alarm_triggers:
+                        stats = monitor.stats[(cutoff, trigger)]
+                        result.append({'sample_rate': group.sample_rate,
+                                       'achieved_sample_rate': group.sampler.scheduler.achieved_rate(),
+                                       'estimation_interval': monitor.est_interval,
+                                       'cutoff': cutoff,
+                                       'alarm_trigger': trigger,
+                                       'estimations': stats.estimations,
+                                       'alarms': stats.alarms,
+                                       'episodes': stats.episodes,
+                                       'first_alarm': stats.first_alarm,
+                                       'max_risk': stats.max_risk,
+                                       'meters': stats.meters,
+                                       'alarm_meters': stats.alarm_meters})
+        return result
+
+
+# Open a trace file; - is stdin, and .gz files are uncompressed.
+def open_trace(path, mode='r'):
+    if path == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, mode + 'b')
+    return open(path, mode)
+
+
+# The interface names of a trace, from its interfaces line, or None.
+def trace_interfaces(path):
+    tracefile = open_trace(path)
+    try:
+        for line in tracefile:
+            if not line.startswith('#'):
+                break
+            name, sep, value = line[1:].partition(':')
+            if sep and name.strip() == 'interfaces':
+                return interface_list(value)
+    finally:
+        if tracefile is not sys.stdin:
+            tracefile.close()
+    return None
+
+
+# Generate the readings of a trace as (timestamp, [tx_bytes, ...],
+# [rx_bytes, ...]).
+def read_trace(path):
+    tracefile = open_trace(path)
+    try:
+        for line in tracefile:
+            if line.startswith('#'):
+                continue
+            fields = line.replace(',', ' ').split()
+            if not fields:
+                continue
+            counters = map(int, fields[1:])
+            yield float(fields[0]), counters[0::2], counters[1::2]
+    finally:
+        if tracefile is not sys.stdin:
+            tracefile.close()
+
+
+# Record a trace of the interfaces for duration seconds (forever if
+# None) at the given rate, with the given counter source.
+def record_trace(path, interfaces, sample_rate, duration=None, counter_source='auto'):
+    from counters import create_counter_source
+    from scheduler import TickScheduler
+    interfaces = interface_list(interfaces)
+    source = create_counter_source(counter_source, interfaces)
+    scheduler = TickScheduler(sample_rate)
+    tracefile = open_trace(path, 'w')
+    # The timestamps are on the monotonic clock of the counter
+    # sources, moved to the epoch.
+    offset = time.time() - scheduler.clock()
+    try:
+        tracefile.write('# interfaces: ' + ','.join(interfaces) + '\n')
+        end = None if duration is None else scheduler.clock() + duration
+        while end is None or scheduler.clock() < end:
+            scheduler.wait()
+            timestamp, tx, rx = source.read()
+            counters = []
+            for i in range(len(interfaces)):
+                counters.append(str(tx[i]))
+                counters.append(str(rx[i]))
+            tracefile.write('%.6f %s\n' % (timestamp + offset, ' '.join(counters)))
+    finally:
+        source.close()
+        if tracefile is not sys.stdout:
+            tracefile.close()
+
+
+def float_list(value):
+    return [float(x) for x in value.split(',') if x.strip()]
+
+
+def int_list(value):
+    return [int(x) for x in value.split(',') if x.strip()]
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Replay recorded interface counters through the rate monitor, faster than real time')
+    subparsers = parser.add_subparsers(dest='command')
+    record = subparsers.add_parser('record', help='Record a trace of interface counters')
+    record.add_argument('trace', help='The trace file to write; .gz files are compressed; - for stdout')
+    record.add_argument('-i', "--interface", help='Interface(s) to record, as a comma separated list; default "eth0"', default='eth0')
+    record.add_argument('-s', "--sample_rate", help='How often to read the counters; default 100 times per second', type=int, default=100)
+    record.add_argument('-C', "--counter_source", help='How to read the interface counters: auto, netlink, procnetdev, sysfs or netstat; default auto', default='auto')
+    record.add_argument("--duration", help='How long to record (in seconds); default until interrupted', type=float)
+    run = subparsers.add_parser('run', help='Replay a trace for a grid of configurations')
+    run.add_argument('trace', help='The trace file to replay; .gz files are uncompressed; - for stdin')
+    run.add_argument('-i', "--interface", help='The names of the interfaces in the trace, as a comma separated list; default from the trace, or if0, if1, ...')
+    run.add_argument('-k', "--link_speed", help='The link speed of the interfaces (in Mbits per second)', type=int, required=True)
+    run.add_argument('-s', "--sample_rate", help='Sample rate(s) to replay at, as a comma separated list; default 1000', type=int_list, default=[1000])
+    run.add_argument('-e', "--estimation_interval", help='Estimation interval(s) in seconds, as a comma separated list; default 10', type=float_list, default=[10.0])
+    run.add_argument('-o', "--cutoff", help='Cutoff(s) in percent of the link speed, as a comma separated list; default 99', type=int_list, default=[99])
+    run.add_argument('-a', "--alarm_trigger", help='Alarm trigger(s) in percent, as a comma separated list; default 95', type=int_list, default=[95])
+    run.add_argument('-m', "--meter_interval", help='How often to meter (in seconds); default every 30 seconds', type=float, default=30.0)
+    run.add_argument('-H', "--horizons", help='Additional time horizons (in seconds) to estimate over, as a comma separated list', type=float_list, default=[])
+    run.add_argument("--counter_bits", help='The width of the counters of the trace, for the wrap-around adjustment; default 64', type=int, default=64)
+    run.add_argument("--records", help='Write the meter records of each configuration to a file whose name starts with this prefix')
+    run.add_argument("--meter_format", help='The format of the meter records written with --records: json or binary; default json', choices=['json', 'binary'], default='json')
+    run.add_argument("--json", help='Print the summary as JSON', action='store_true')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        try:
+            record_trace(args.trace, args.interface, args.sample_rate, args.duration, args.counter_source)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.interface is not None:
+        interfaces = interface_list(args.interface)
+    else:
+        interfaces = trace_interfaces(args.trace) if args.trace != '-' else None
+        if interfaces is None:
+            # Count the interfaces of the first reading.
+            for timestamp, tx, rx in read_trace(args.trace):
+                interfaces = ['if%d' % i for i in range(len(tx))]
+                break
+    if not interfaces:
+        parser.error('no interfaces in the trace')
+
+    files = {}
+    def on_records(configuration, records):
+        meterfile = files.get(configuration)
+        if meterfile is None:
+            name = '%s-s%d-e%g-o%d-a%d.%s' % ((args.records,) + configuration +
+                                              ('json' if args.meter_format == 'json' else 'bin',))
+            meterfile = files[configuration] = open(name, 'wb')
+        for data in records:
+            if args.meter_format == 'json':
+                meterfile.write(json.dumps(to_json(data)) + '\n')
+            else:
+                meterfile.write(encode(data))
+
+    replay = Replay(interfaces, args.link_speed,
+                    sample_rates=args.sample_rate,
+                    estimation_intervals=args.estimation_interval,
+                    cutoffs=args.cutoff,
+                    alarm_triggers=args.alarm_trigger,
+                    meter_interval=args.meter_interval,
+                    horizons=args.horizons,
+                    counter_bits=args.counter_bits,
+                    on_records=on_records if args.records else None)
+    start = time.time()
+    try:
+        replay.run(read_trace(args.trace))
+    finally:
+        for meterfile in files.values():
+            meterfile.close()
+    elapsed = time.time() - start
+    summary = replay.summary()
+    if args.json:
+        print(json.dumps({'readings': replay.readings,
+                          'duration': replay.duration(),
+                          'elapsed': elapsed,
+                          'configurations': summary}, indent=4))
+        return
+    print("%d readings, %.1f s of trace replayed in %.1f s (%.0fx real time)" % (
+        replay.readings, replay.duration(), elapsed,
+        replay.duration() / elapsed if elapsed > 0 else 0.0))
+    print("%11s %9s %6s %5s %11s %10s %8s %10s %8s %s" % (
+        'sample_rate', 'achieved', 'est', 'cut', 'alarm_trig', 'estimates', 'alarms', 'episodes', 'max_risk', 'first_alarm'))
+    for point in summary:
+        if point['first_alarm'] is None:
+            first = '-'
+        else:
+            first = datetime.fromtimestamp(point['first_alarm'], UTC()).strftime('%Y-%m-%dT%H:%M:%S')
+        print("%11d %9.1f %6g %5d %11d %10d %8d %10d %8.2f %s" % (
+            point['sample_rate'], point['achieved_sample_rate'], point['estimation_interval'],
+            point['cutoff'], point['alarm_trigger'], point['estimations'], point['alarms'],
+            point['episodes'], point['max_risk'], first))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+# Copyright 2016 SICS Swedish ICT AB
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Closed-form log-normal functions used for the overload risk, so that
+# the monitor does not need SciPy.
+#
+# The log-normal distribution is given by the parameters of the
+# underlying normal distribution: mu (location) and sigma2 (variance),
+# as estimated by Monitor.estimate. In SciPy terms
+#
+#     lognorm_sf(x, mu, sigma2) == lognorm.sf(x, sqrt(sigma2), 0, exp(mu))
+#     lognorm_ppf(q, mu, sigma2) == lognorm.ppf(q, sqrt(sigma2), 0, exp(mu))
+#
+# except that sigma2 == 0 is treated as a point mass at exp(mu)
+# instead of giving nan.
+
+import math
+
+SQRT2 = math.sqrt(2.0)
+
+
+# Survival function (1 - cdf) of the log-normal distribution at x.
+def lognorm_sf(x, mu, sigma2):
+    if x <= 0.0:
+        return 1.0
+    if sigma2 <= 0.0:
+        return 1.0 if x < math.exp(mu) else 0.0
+    return 0.5 * math.erfc((math.log(x) - mu) / (math.sqrt(sigma2) * SQRT2))
+
+
+# The survival function for many (x, mu, sigma2) triples at once,
+# e.g. one per interface. x can be a single value used for all
+# triples. Returns a list.
+def lognorm_sf_many(x, mus, sigma2s):
+    erfc = math.erfc
+    log = math.log
+    sqrt = math.sqrt
+    exp = math.exp
+    n = len(mus)
+    if not hasattr(x, '__len__'):
+        x = [x] * n
+    result = [0.0] * n
+    for i in range(n):
+        xi = x[i]
+        sigma2 = sigma2s[i]
+        if xi <= 0.0:
+            result[i] = 1.0
+        elif sigma2 <= 0.0:
+            result[i] = 1.0 if xi < exp(mus[i]) else 0.0
+        else:
+            result[i] = 0.5 * erfc((log(xi) - mus[i]) / (sqrt(sigma2) * SQRT2))
+    return result
+
+
+# Cumulative distribution function of the log-normal distribution at x.
+def lognorm_cdf(x, mu, sigma2):
+    if x <= 0.0:
+        return 0.0
+    if sigma2 <= 0.0:
+        return 0.0 if x < math.exp(mu) else 1.0
+    return 0.5 * math.erfc(-(math.log(x) - mu) / (math.sqrt(sigma2) * SQRT2))
+
+
+# Percent point function (quantile, inverse of the cdf) of the
+# log-normal distribution, 0 <= q <= 1.
+def lognorm_ppf(q, mu, sigma2):
+    if q <= 0.0:
+        return 0.0
+    if q >= 1.0:
+        return float('inf')
+    return math.exp(mu + math.sqrt(max(sigma2, 0.0)) * norm_ppf(q))
+
+
+# The quantile function for many (mu, sigma2) pairs at the same q.
+def lognorm_ppf_many(q, mus, sigma2s):
+    if q <= 0.0:
+        return [0.0] * len(mus)
+    if q >= 1.0:
+        return [float('inf')] * len(mus)
+    z = norm_ppf(q)
+    exp = math.exp
+    sqrt = math.sqrt
+    return [exp(mus[i] + sqrt(max(sigma2s[i], 0.0)) * z) for i in range(len(mus))]
+
+
+# Coefficients of the rational approximations of the inverse of the
+# standard normal cdf, by Peter J. Acklam.
+_A = (-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+      1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00)
+_B = (-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+      6.680131188771972e+01, -1.328068155288572e+01)
+_C = (-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+      -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00)
+_D = (7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00,
+      3.754408661907416e+00)
+_P_LOW = 0.02425
+
+
+# Inverse of the standard normal cdf, 0 < q < 1. Acklam's
+# approximation (relative error below 1.2e-9) refined with one step of
+# Halley's method, which gives full double precision. The upper half
+# is computed by symmetry, so that the refinement is done where the
+# cdf does not lose precision.
+def norm_ppf(q):
+    if q > 0.5:
+        return -norm_ppf(1.0 - q)
+    if q < _P_LOW:
+        r = math.sqrt(-2.0 * math.log(q))
+        z = ((((((_C[0]*r + _C[1])*r + _C[2])*r + _C[3])*r + _C[4])*r + _C[5]) /
+             ((((_D[0]*r + _D[1])*r + _D[2])*r + _D[3])*r + 1.0))
+    else:
+        r = q - 0.5
+        s = r * r
+        z = ((((((_A[0]*s + _A[1])*s + _A[2])*s + _A[3])*s + _A[4])*s + _A[5])*r /
+             (((((_B[0]*s + _B[1])*s + _B[2])*s + _B[3])*s + _B[4])*s + 1.0))
+    # Halley refinement.
+    e = 0.5 * math.erfc(-z / SQRT2) - q
+    u = e * math.sqrt(2.0 * math.pi) * math.exp(z * z / 2.0)
+    return z - u / (1.0 + z * u / 2.0)
@@ -27,12 +27,28 @@ from monitor import Monitor
 parser = argparse.ArgumentParser(description="Monitor")
 parser.add_argument('-b',"--meter_port", help='Port to send metering data to. This will inhibit storing metering data in Ceilometer',dest='meter_port',action='store',nargs='?',const=None,default=None, type=int)
 parser.add_argument('-g',"--meter_host", help='Host to send metering data to if the --meter-port argument is given; default is localhost. This will inhibit storing metering data in Ceilometer',dest='meter_host',action='store',nargs='?',const=None,default=None)
+parser.add_argument('-U',"--meter_socket", help='Path of a Unix domain socket to send metering data to. This will inhibit storing metering data in Ceilometer',dest='meter_socket',default=None)
+parser.add_argument("--meter_socket_type", help='Send the metering data to the port or the Unix domain socket as a stream, or as one datagram per record; default stream', choices=['stream','dgram'], default='stream')
+parser.add_argument("--backlog", help='The largest number of records waiting to be sent to the port or the Unix domain socket; default 1000', type=int, default=1000)
+parser.add_argument("--backlog_policy", help='What to do with a new record when the backlog is full: drop-oldest (drop the oldest record) or block (wait for room); default drop-oldest', choices=['drop-oldest','block'], default='drop-oldest')
 parser.add_argument('-f',"--meter_file", help='Name of a file to append metering data to. This will inhibit storing metering data in Ceilometer',dest='meter_file',action='store',nargs='?',const=None,default=None)
-parser.add_argument('-i',"--interface", help='Interface to monitor; default "eth0"', nargs='?', default='eth0')
+parser.add_argument('-i',"--interface", help='Interface(s) to monitor, as a comma separated list; default "eth0", or none with --watch', nargs='?')
+parser.add_argument("--watch", help='Monitor the interfaces of the host matching these patterns as they come and go, as a comma separated list of shell-style patterns, e.g. "tap*,eth*"; default none')
+parser.add_argument("--exclude", help='Do not monitor the interfaces matching these patterns with --watch, e.g. "lo,virbr*"; default none')
+parser.add_argument("--link_scan_interval", help='How often (in seconds) to scan the interfaces of the host with --watch, besides following the link messages of the kernel; default 5', type=float, default=5.0)
+parser.add_argument('-C',"--counter_source", help='How to read the interface counters: auto, netlink, procnetdev, sysfs or netstat; default auto (the first of netlink, procnetdev and sysfs that works)', choices=['auto','netlink','procnetdev','sysfs','netstat'], default='auto')
+parser.add_argument("--extra_counters", help='Counters to estimate besides the bytes, as a comma separated list of packets, dropped, errors and multicast; default none')
 parser.add_argument('-s',"--sample_rate", help='How often to sample; default 1000 samples per second',nargs='?', default='1000', type=int)
+parser.add_argument('-A',"--adaptive_rate", help='Adapt the sample rate to the overload risk, between --min_sample_rate and --sample_rate', action='store_true')
+parser.add_argument("--min_sample_rate", help='The lowest sample rate with --adaptive_rate; default 10 samples per second', type=int, default=10)
+parser.add_argument('-P',"--tick_policy", help='What to do with sample ticks that are missed because the sampler is late: catchup (take up to 10 missed ticks back to back) or skip; default catchup', choices=['catchup','skip'], default='catchup')
 parser.add_argument('-e',"--estimation_interval", help='How often to estimate; default every 10 seconds',nargs='?', default='10.0', type=float)
+parser.add_argument('-H',"--horizons", help='Additional time horizons (in seconds) to estimate over, as a comma separated list, e.g. 1,10,60,300; default none')
+parser.add_argument('-R',"--sample_ring", help='Write every sample to a shared memory ring buffer in this file (e.g. /dev/shm/ramon), for other programs to read (see shmring.py)')
+parser.add_argument("--sample_ring_size", help='The number of samples in the ring buffer; default 65536', type=int, default=65536)
 parser.add_argument('-m',"--meter_interval", help='How often to meter; default every 30 seconds',nargs='?', default='30.0', type=float)
 parser.add_argument('-k',"--link_speed", help='Set the link speed value for the monitored interface (in Mbits per second)', type=int)
+parser.add_argument("--link_speed_ttl", help='How often (in seconds) to look up the line rates of the interfaces again without -k; default 10', type=float, default=10.0)
 parser.add_argument('-a',"--alarm_trigger", help='The overload risk which will trigger an alarm; default 95%%', type=int, default=95)
 parser.add_argument('-o',"--cutoff", help='A percentage of the link speed to use in the overload risk calculation; default 99%%', type=int, default="99")
 parser.add_argument('-q',"--confport", help='Port number for configuration messages (see also monconf.py); default 54736', type=int, default='54736')
@@ -43,6 +59,20 @@ parser.add_argument('-c',"--controller", help="The IP adress of the controller r
 parser.add_argument('-u',"--username", help='User name; default "admin"',nargs='?')
 parser.add_argument('-w',"--password", help='Password',nargs='?')
 parser.add_argument('-t',"--tenantname", help='Tenant name; default "admin"',nargs='?')
+parser.add_argument("--meter_format", help='The format of the metering data written to the file, port or socket: json (one object per line) or binary (see meterformat.py); default json', choices=['json','binary'], default='json')
+parser.add_argument("--flush_size", help='The number of bytes written to the meter file between flushes; default 65536', type=int, default=65536)
+parser.add_argument("--flush_interval", help='The longest time (in seconds) metering data waits to be flushed to the meter file; default 1, must be above 0', type=float, default=1.0)
+parser.add_argument("--fsync", help='When to force the meter file to disk: never, flush (at every flush) or rotate (when the file is rotated or closed); default never', choices=['never','flush','rotate'], default='never')
+parser.add_argument("--rotate_size", help='Rotate the meter file when it has grown to this many bytes; default 0, never', type=int, default=0)
+parser.add_argument("--rotate_interval", help='Rotate the meter file every this many seconds, e.g. 3600 on the hour; default 0, never', type=float, default=0)
+parser.add_argument("--compress", help='Compress the rotated meter files: none, gzip or zstd; default none', choices=['none','gzip','zstd'], default='none')
+parser.add_argument("--batch_size", help='The largest number of samples to post to Ceilometer in one request; default 100', type=int, default=100)
+parser.add_argument("--batch_delay", help='The longest time (in seconds) a sample waits for its batch to fill up before it is posted to Ceilometer; default 1, must be above 0', type=float, default=1.0)
+parser.add_argument("--export_queue", help='The largest number of records waiting to be exported; default 1000', type=int, default=1000)
+parser.add_argument("--export_policy", help='What to do with a new record when the export queue is full: drop-oldest, drop-newest or block; default drop-oldest', choices=['drop-oldest','drop-newest','block'], default='drop-oldest')
+parser.add_argument("--meter_telemetry", help='Add the self-telemetry of the monitor (tick lateness, stage times, sink errors, CPU share) to the metering data', action='store_true')
+parser.add_argument("--metrics_port", help='Serve the latest estimates over HTTP on this port, at /metrics in the OpenMetrics format and at /metrics.json as JSON; default none', type=int)
+parser.add_argument("--metrics_host", help='The address to serve the latest estimates on with --metrics_port; default 127.0.0.1', default='127.0.0.1')
 parser.add_argument('-d',"--debug", help='Debug flag',action='store_true')
 parser.add_argument('-l',"--log", help='Log debug messages to a file of the form monitor_<meter_name>_%%Y-%%m-%%dT%%H.%%M.%%S.log',action='store_true')
 parser.add_argument('-x',"--display_data", help="Display rate data on the screen, continuously", action='store_true')
@@ -52,22 +82,28 @@ args = parser.parse_args()
 
 # Mode 1: output to file and/or port
 # valid options:
-# -i, -s, -e, -m, -k, -a, -o, -q, -d, -l, -f, -b, -v
+# -i, -C, -s, -A, -P, -e, -H, -R, -m, -k, -a, -o, -q, -d, -l, -f, -b, -U, -v,
+# --meter_socket_type, --backlog, --backlog_policy, --export_queue, --export_policy, --meter_telemetry,
+# --metrics_port, --metrics_host, --watch, --exclude, --link_scan_interval, --link_speed_ttl,
+# --extra_counters, --meter_format, --flush_size, --flush_interval, --fsync, --rotate_size, --rotate_interval, --compress
 # mandatory options:
-# -f or -b (obviously, since it triggers mode 1 behavior)
+# -f, -b or -U (obviously, since it triggers mode 1 behavior)
 # invalid options:
 # -n, -r, -p, -c, -u, -w, -t
 # 
 # Mode 2: output to ceilometer
 # valid options:
-# -n, -i, -s, -e, -m, -k, -a, -o, -q, -r, -p, -c, -d, -l, -u, -w, -t, -v
+# -n, -i, -C, -s, -A, -P, -e, -H, -R, -m, -k, -a, -o, -q, -r, -p, -c, -d, -l, -u, -w, -t, -v,
+# --batch_size, --batch_delay, --export_queue, --export_policy, --meter_telemetry,
+# --metrics_port, --metrics_host, --watch, --exclude, --link_scan_interval, --link_speed_ttl,
+# --extra_counters
 # mandatory options:
 # -n, -r, -p, -w
 # invalid option:
-# -f, -b
+# -f, -b, -U
 # 
-# The presence of the -f or -b option determines the mode.
-# if -f or -b is present:
+# The presence of the -f, -b or -U option determines the mode.
+# if -f, -b or -U is present:
 #     we are running in mode 1
 # else:
 #     we are running in mode 2
@@ -77,7 +113,15 @@ if args.version is True:
     print(__version__)
     exit(0)
 
-if args.meter_file is None and args.meter_port is None:     # mode 2
+if args.flush_interval <= 0:
+    print("--flush_interval must be above 0")
+    exit(1)
+
+if args.batch_delay <= 0:
+    print("--batch_delay must be above 0")
+    exit(1)
+
+if args.meter_file is None and args.meter_port is None and args.meter_socket is None:     # mode 2
     mode = 2
 else:                           # mode 1
     mode = 1
@@ -127,6 +171,25 @@ else:
     if args.meter_host is None:
         args.meter_host = '127.0.0.1'
 
+if args.interface is None:
+    if args.watch is None:
+        args.interface = 'eth0'
+    else:
+        args.interface = ''
+
+if args.horizons is None:
+    horizons = []
+else:
+    horizons = [float(horizon) for horizon in args.horizons.split(',') if horizon.strip()]
+
+# Where to send the metering data in mode 1, if not only to a file.
+if args.meter_socket is not None:
+    meter_host_and_port = args.meter_socket
+elif args.meter_port is not None:
+    meter_host_and_port = (args.meter_host,args.meter_port)
+else:
+    meter_host_and_port = None
+
 mon = Monitor(meter_name=args.meter_name,
               sample_rate=args.sample_rate,
               interface=args.interface,
@@ -144,10 +207,39 @@ mon = Monitor(meter_name=args.meter_name,
               display_data=args.display_data,
               meter_file_name=args.meter_file,
 #              meter_host_and_port=args.meter_port,
-              meter_host_and_port=(args.meter_host,args.meter_port),
+              meter_host_and_port=meter_host_and_port,
+              meter_socket_type=args.meter_socket_type,
+              backlog=args.backlog,
+              backlog_policy=args.backlog_policy,
               username=args.username,
               password=args.password,
               tenantname=args.tenantname,
+              counter_source=args.counter_source,
+              extra_counters=args.extra_counters,
+              tick_policy=args.tick_policy,
+              horizons=horizons,
+              sample_ring=args.sample_ring,
+              sample_ring_size=args.sample_ring_size,
+              adaptive_rate=args.adaptive_rate,
+              min_sample_rate=args.min_sample_rate,
+              batch_size=args.batch_size,
+              batch_delay=args.batch_delay,
+              meter_format=args.meter_format,
+              flush_size=args.flush_size,
+              flush_interval=args.flush_interval,
+              fsync=args.fsync,
+              rotate_size=args.rotate_size,
+              rotate_interval=args.rotate_interval,
+              compress=args.compress,
+              export_queue_size=args.export_queue,
+              export_policy=args.export_policy,
+              meter_telemetry=args.meter_telemetry,
+              metrics_host=args.metrics_host,
+              metrics_port=args.metrics_port,
+              watch_interfaces=args.watch,
+              exclude_interfaces=args.exclude,
+              link_scan_interval=args.link_scan_interval,
+              link_speed_ttl=args.link_speed_ttl,
               mode=mode)
 
 mon.main()
@@ -0,0 +1,188 @@
+#!/usr/bin/python2.7
+
+# Copyright 2016 SICS Swedish ICT AB
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Monitor many interfaces with a pool of worker processes (see
+# supervisor.py). The options are those of run_monitor.py, less the
+# ones that make no sense for a pool (-d, -l, -x, -R and
+# --metrics_port), plus the options of the pool.
+
+from __future__ import print_function
+
+import argparse
+from version import __version__
+from ceilocomm import CeiloComm
+from supervisor import Supervisor, parse_cores, get_affinity
+
+parser = argparse.ArgumentParser(description="Monitor supervisor")
+parser.add_argument('-W',"--workers", help='The number of worker processes; default one per core of --cores, or one per CPU', type=int)
+parser.add_argument("--cores", help='The cores to pin the workers to, round robin, e.g. 0,2,4-7; default no pinning')
+parser.add_argument("--report_interval", help='How often (in seconds) the workers report their load; default 5', type=float, default=5.0)
+parser.add_argument("--rebalance_interval", help='How often (in seconds) to move interfaces from the busiest worker to the least busy one; default 60, 0 never', type=float, default=60.0)
+parser.add_argument("--rebalance_threshold", help='The load (share of a CPU) of the busiest worker above which interfaces are moved; default 0.8', type=float, default=0.8)
+parser.add_argument("--rebalance_margin", help='The smallest difference of load between the busiest and the least busy worker for interfaces to be moved; default 0.2', type=float, default=0.2)
+parser.add_argument('-b',"--meter_port", help='Port to send metering data to. This will inhibit storing metering data in Ceilometer', type=int)
+parser.add_argument('-g',"--meter_host", help='Host to send metering data to if the --meter-port argument is given; default is localhost', default='127.0.0.1')
+parser.add_argument('-U',"--meter_socket", help='Path of a Unix domain socket to send metering data to. This will inhibit storing metering data in Ceilometer')
+parser.add_argument("--meter_socket_type", help='Send the metering data to the port or the Unix domain socket as a stream, or as one datagram per record; default stream', choices=['stream','dgram'], default='stream')
+parser.add_argument("--backlog", help='The largest number of records waiting to be sent to the port or the Unix domain socket; default 1000', type=int, default=1000)
+parser.add_argument("--backlog_policy", help='What to do with a new record when the backlog is full: drop-oldest or block; default drop-oldest', choices=['drop-oldest','block'], default='drop-oldest')
+parser.add_argument('-f',"--meter_file", help='Name of a file to append metering data to. This will inhibit storing metering data in Ceilometer')
+parser.add_argument('-i',"--interface", help='Interfaces to monitor, as a comma separated list; default "eth0"', default='eth0')
+parser.add_argument('-C',"--counter_source", help='How to read the interface counters: auto, netlink, procnetdev, sysfs or netstat; default auto', choices=['auto','netlink','procnetdev','sysfs','netstat'], default='auto')
+parser.add_argument("--extra_counters", help='Counters to estimate besides the bytes, as a comma separated list of packets, dropped, errors and multicast; default none')
+parser.add_argument('-s',"--sample_rate", help='How often to sample; default 1000 samples per second', type=int, default=1000)
+parser.add_argument('-A',"--adaptive_rate", help='Adapt the sample rate to the overload risk, between --min_sample_rate and --sample_rate', action='store_true')
+parser.add_argument("--min_sample_rate", help='The lowest sample rate with --adaptive_rate; default 10 samples per second', type=int, default=10)
+parser.add_argument('-P',"--tick_policy", help='What to do with sample ticks that are missed because the sampler is late: catchup or skip; default catchup', choices=['catchup','skip'], default='catchup')
+parser.add_argument('-e',"--estimation_interval", help='How often to estimate; default every 10 seconds', type=float, default=10.0)
+parser.add_argument('-H',"--horizons", help='Additional time horizons (in seconds) to estimate over, as a comma separated list; default none')
+parser.add_argument('-m',"--meter_interval", help='How often to meter; default every 30 seconds', type=float, default=30.0)
+parser.add_argument('-k',"--link_speed", help='Set the link speed value for the monitored interfaces (in Mbits per second)', type=int)
+parser.add_argument('-a',"--alarm_trigger", help='The overload risk which will trigger an alarm; default 95%%', type=int, default=95)
+parser.add_argument('-o',"--cutoff", help='A percentage of the link speed to use in the overload risk calculation; default 99%%', type=int, default=99)
+parser.add_argument('-q',"--confport", help='Port number for configuration messages (see also monconf.py); default 54736', type=int, default=54736)
+parser.add_argument('-n',"--meter_name", help='The name of this meter in Ceilometer')
+parser.add_argument('-r',"--resource_ID", help='Resource identifier for the resource to associate with the meter')
+parser.add_argument('-p',"--project_ID", help='Project identifier for the resource to associate with the meter')
+parser.add_argument('-c',"--controller", help="The IP adress of the controller running Ceilometer; default 10.0.0.11", default='10.0.0.11')
+parser.add_argument('-u',"--username", help='User name; default "admin"', default='admin')
+parser.add_argument('-w',"--password", help='Password')
+parser.add_argument('-t',"--tenantname", help='Tenant name; default "admin"', default='admin')
+parser.add_argument("--meter_format", help='The format of the metering data written to the file, port or socket: json or binary; default json', choices=['json','binary'], default='json')
+parser.add_argument("--flush_size", help='The number of bytes written to the meter file between flushes; default 65536', type=int, default=65536)
+parser.add_argument("--flush_interval", help='The longest time (in seconds) metering data waits to be flushed to the meter file; default 1, must be above 0', type=float, default=1.0)
+parser.add_argument("--fsync", help='When to force the meter file to disk: never, flush or rotate; default never', choices=['never','flush','rotate'], default='never')
+parser.add_argument("--rotate_size", help='Rotate the meter file when it has grown to this many bytes; default 0, never', type=int, default=0)
+parser.add_argument("--rotate_interval", help='Rotate the meter file every this many seconds; default 0, never', type=float, default=0)
+parser.add_argument("--compress", help='Compress the rotated meter files: none, gzip or zstd; default none', choices=['none','gzip','zstd'], default='none')
+parser.add_argument("--batch_size", help='The largest number of samples to post to Ceilometer in one request; default 100', type=int, default=100)
+parser.add_argument("--batch_delay", help='The longest time (in seconds) a sample waits for its batch to fill up; default 1, must be above 0', type=float, default=1.0)
+parser.add_argument("--export_queue", help='The largest number of records waiting to be exported; default 1000', type=int, default=1000)
+parser.add_argument("--export_policy", help='What to do with a new record when the export queue is full: drop-oldest, drop-newest or block; default drop-oldest', choices=['drop-oldest','drop-newest','block'], default='drop-oldest')
+parser.add_argument("--meter_telemetry", help='Add the self-telemetry of the workers to the metering data', action='store_true')
+parser.add_argument('-v',"--version", help='Show version and exit', action='store_true')
+
+args = parser.parse_args()
+
+if args.version is True:
+    print(__version__)
+    exit(0)
+
+if args.flush_interval <= 0:
+    print("--flush_interval must be above 0")
+    exit(1)
+
+if args.batch_delay <= 0:
+    print("--batch_delay must be above 0")
+    exit(1)
+
+# As with run_monitor.py, the presence of -f, -b or -U selects mode 1
+# (a file, port or socket), and otherwise mode 2 (Ceilometer).
+if args.meter_file is None and args.meter_port is None and args.meter_socket is None:
+    mode = 2
+    missing_option = False
+    for option in ['meter_name', 'resource_ID', 'project_ID', 'password']:
+        if getattr(args, option) is None:
+            print("Option --" + option + " must be set in mode 2.")
+            missing_option = True
+    if missing_option:
+        exit(1)
+else:
+    mode = 1
+
+# A worker pinned to a core outside the allowed ones would fail at
+# every restart, so the cores are checked once, here.
+if args.cores:
+    try:
+        cores = parse_cores(args.cores)
+    except ValueError:
+        print("Bad list of cores: " + args.cores)
+        exit(1)
+    allowed = get_affinity()
+    unavailable = [core for core in cores if core not in allowed]
+    if unavailable:
+        print("The cores %s are not available; the allowed cores are %s"
+              % (','.join(map(str, unavailable)), ','.join(map(str, allowed))))
+        exit(1)
+else:
+    cores = None
+
+if args.horizons is None:
+    horizons = []
+else:
+    horizons = [float(horizon) for horizon in args.horizons.split(',') if horizon.strip()]
+
+if args.meter_socket is not None:
+    meter_host_and_port = args.meter_socket
+elif args.meter_port is not None:
+    meter_host_and_port = (args.meter_host, args.meter_port)
+else:
+    meter_host_and_port = None
+
+ceilocomm = CeiloComm(args.resource_ID, args.project_ID, controller=args.controller,
+                      file_name=args.meter_file,
+                      host_and_port=meter_host_and_port,
+                      socket_type=args.meter_socket_type,
+                      backlog=args.backlog,
+                      backlog_policy=args.backlog_policy,
+                      batch_size=args.batch_size,
+                      batch_delay=args.batch_delay,
+                      flush_size=args.flush_size,
+                      flush_interval=args.flush_interval,
+                      fsync=args.fsync,
+                      rotate_size=args.rotate_size,
+                      rotate_interval=args.rotate_interval,
+                      compress=args.compress,
+                      meter_format=args.meter_format)
+
+# The options of the Monitor of every worker.
+monitor_args = dict(meter_name=args.meter_name,
+                    sample_rate=args.sample_rate,
+                    estimation_interval=args.estimation_interval,
+                    meter_interval=args.meter_interval,
+                    link_speed=args.link_speed,
+                    alarm_trigger_value=args.alarm_trigger,
+                    cutoff=args.cutoff,
+                    resid=args.resource_ID,
+                    projid=args.project_ID,
+                    username=args.username,
+                    counter_source=args.counter_source,
+                    extra_counters=args.extra_counters,
+                    tick_policy=args.tick_policy,
+                    horizons=horizons,
+                    adaptive_rate=args.adaptive_rate,
+                    min_sample_rate=args.min_sample_rate,
+                    meter_telemetry=args.meter_telemetry,
+                    mode=mode)
+
+supervisor = Supervisor(args.interface, ceilocomm, monitor_args,
+                        workers=args.workers,
+                        cores=cores,
+                        meter_name=args.meter_name,
+                        resid=args.resource_ID,
+                        projid=args.project_ID,
+                        username=args.username,
+                        password=args.password,
+                        tenantname=args.tenantname,
+                        confport=args.confport,
+                        export_queue_size=args.export_queue,
+                        export_policy=args.export_policy,
+                        report_interval=args.report_interval,
+                        rebalance_interval=args.rebalance_interval,
+                        rebalance_threshold=args.rebalance_threshold,
+                        rebalance_margin=args.rebalance_margin)
+
+supervisor.main()
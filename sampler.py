@@ -14,66 +14,185 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import time
+from array import array
+from collections import defaultdict
+from math import log, ceil
 from threading import Thread, Event
-from sh import netstat,ErrorReturnCode
-import re
 #import pdb
-from monitor import OS_type, OS
+from counters import create_counter_source
+from scheduler import TickScheduler
+from snapshot import Snapshot
+from sketch import RateSketch, sparse
+from clock import monotonic
+from telemetry import StageTimer
+from linkwatch import link_names
+
+# The moments of each interface over one estimation window, as
+# published in the sampler's snapshot. samples is the number of
+# rates in the window, mean_* their mean and m2_* the sum of their
+# squared deviations from the mean (see moments.py).
+MOMENT_FIELDS = [('samples', 'L'),
+                 ('mean_tx', 'd'), ('m2_tx', 'd'),
+                 ('mean_rx', 'd'), ('m2_rx', 'd')]
+
+# The bucket counts of the tx and the rx rates of each interface over
+# the window, published next to the moments as sparse counts (see
+# sketch.py), since most of the buckets are empty.
+SKETCH = RateSketch()
+SKETCH_FIELD = ('sketch', 'I', None)
+
+# The moments of the extra counters (see counters.py), if any: the
+# mean and m2 of the tx and the rx rate of each extra counter, k
+# counters making 2 * k values per interface.
+def extra_moment_fields(k):
+    if k == 0:
+        return []
+    return [('mean_extra', 'd', 2 * k), ('m2_extra', 'd', 2 * k)]
+
+# Window number, start and end time (on the monotonic clock), number
+# of ticks, and sample rate of the published window.
+WINDOW_SCALARS = ['window', 'start', 'end', 'ticks', 'rate']
+
+# The number of windows kept in the snapshot, i.e. how many windows a
+# reader can fall behind without losing any.
+SNAPSHOT_DEPTH = 16
+
+# The number of reads in a row that may fail, with drop_missing, while
+# all the interfaces are still on the host: the counters of a link
+# that is being deleted cannot be read for a moment before the link
+# is gone.
+MAX_FAILED_READS = 100
 
 #
 # Partly based on code from the UNIFY FP7 Demo for the Y1 review 2015,
 # by Pontus Skldstrm, Acreo Swedish ICT AB / Per Kreuger, SICS Swedish ICT AB.
 #
 
+# The number of values per interface of a field of MOMENT_FIELDS.
+def moment_width(field):
+    return field[2] if len(field) > 2 else 1
+
+
+# Split an interface specification into a list of interface names.
+# The specification can be a list of names or a comma separated string,
+# e.g. "eth0,tap0,tap1". The names are plain strings, also when they
+# come from JSON.
+def interface_list(interface):
+    if isinstance(interface, basestring):
+        return [str(i.strip()) for i in interface.split(',') if i.strip() != '']
+    return [str(i) for i in interface]
+
+
+# One Sampler thread samples all configured interfaces. The counters
+# of every interface are read in a single pass per tick, from the
+# counter source given by counter_source (see counters.py), and the
+# moments of the rates are kept in arrays indexed by interface number
+# (in the order given by get_interfaces()).
+#
+# With extra_counters (e.g. ['packets', 'dropped']), the source also
+# reads those counters in the same pass, and the sampler keeps the
+# moments of their rates next to those of the byte rates. They are
+# not counted in the sketch, nor written to the ring.
+#
+# The ticks are scheduled on absolute deadlines by a TickScheduler
+# (see scheduler.py), with the given tick_policy for late ticks.
+#
+# The moments are accumulated per window of window_length seconds.
+# When a window ends, its moments are published in self.snapshot (see
+# snapshot.py), where the monitor and anyone else can read them
+# without waking the sampler thread, and the accumulators are reset
+# for the next window. The monitor merges consecutive windows into
+# its estimates (see moments.py).
+#
+# If ring is given (a shmring.SampleRingWriter), the rate of every
+# interface and tick is also written to it, for other processes to
+# read.
+#
+# The ticks are scheduled on the given clock, which is only replaced
+# to replay recorded counters on a virtual clock (see replay.py).
+#
+# The time spent reading the counters is measured (on the real clock)
+# in self.read_timer, for the telemetry of the monitor (see
+# telemetry.py).
+#
+# Interfaces can be added and removed while sampling (see
+# add_interfaces() and remove_interfaces()), keeping the moments of
+# the other interfaces. With drop_missing, interfaces that disappear
+# from the host are dropped instead of stopping the sampler, for when
+# the monitor follows the links of the host (see linkwatch.py).
 class Sampler(Thread):
-    def __init__(self, inq, outq, sample_rate, monitor, interface='eth0', name='Sampler', debug=False):
+    def __init__(self, inq, sample_rate, monitor, interface='eth0', name='Sampler', debug=False, counter_source='auto', tick_policy='catchup', window_length=1.0, ring=None, clock=monotonic, drop_missing=False, extra_counters=()):
         Thread.__init__(self, name=name)
         self.inq = inq
-        self.outq = outq
         self.request_event = Event()
+        if isinstance(counter_source, basestring):
+            self.source = create_counter_source(counter_source, interface_list(interface), extra_counters)
+        else:
+            self.source = counter_source
+        self.extra_counters = list(self.source.extra)
+        self.moment_fields = MOMENT_FIELDS + extra_moment_fields(len(self.extra_counters))
+        self.snapshot = Snapshot(self.moment_fields + [SKETCH_FIELD], WINDOW_SCALARS, depth=SNAPSHOT_DEPTH)
+        self.scheduler = TickScheduler(sample_rate, policy=tick_policy, clock=clock)
         self.set_sample_rate(sample_rate)
+        self.set_window_length(window_length)
+        self.window = 0
+        self.window_start = self.window_end = 0.0
+        self.window_ticks = 0
         self.monitor = monitor
-        self.interface = interface
         self.debug = debug
         self.keep_running = True
-        self.tx_agg = self.rx_agg = 0.0
-        self.txb2 = self.rxb2 = 0.0
-        self.tx_file = None
-        self.rx_file = None
-        self.samples = 0
-        self.last_data = self.get_interface_data(self.interface)
-        # FIXME: These two should be inferred by checking the word
-        #        length of the computer we're running on.
-        #        Perhaps with platform.architecture() or sys.maxsize
-        #        For now assume 32-bit architecture.
-        self.tx_byte_counter_wrap_adjustment = (2 ** 32) - 1
-        self.rx_byte_counter_wrap_adjustment = (2 ** 32) - 1
+        self.ring = ring
+        self.drop_missing = drop_missing
+        self.read_errors = 0
+        self.failed_reads = 0
+        self.read_timer = StageTimer()
+        # The counters of the source wrap at 2**counter_bits.
+        self.tx_byte_counter_wrap_adjustment = 2 ** self.source.counter_bits
+        self.rx_byte_counter_wrap_adjustment = 2 ** self.source.counter_bits
+        self.set_interface(interface)
 
 
     def run(self):
         if (self.debug):
             self.monitor.debugPrint("sampler.py: starting run()")
-        self.last_data = self.get_interface_data(self.interface)
+        self.last_data = self.get_interface_data()
+        self.start_window(self.last_data[0])
+        self.scheduler.start()
+        self.scheduler.reset_stats()
         while self.keep_running:
-            timestamp = self.sample()
+            # The wait ends early if there is a request for us.
+            if self.scheduler.wait(self.request_event.is_set) is not None:
+                try:
+                    timestamp = self.sample()
+                    self.failed_reads = 0
+                except (IOError, OSError):
+                    if not self.drop_missing_interfaces():
+                        raise
+                    timestamp = None
+                if timestamp is not None:
+                    self.window_ticks += 1
+                    if timestamp >= self.window_end:
+                        self.end_window(timestamp)
+            self.request_event.clear()
 
             while not self.inq.empty():
                 request = self.inq.get()
-                if request == 'rate_data':
-                    self.inq.task_done()
-                    self.outq.put({'ts': timestamp, 'samples': self.samples, 'txb2': self.txb2, 'rxb2': self.rxb2, 'tx_agg': self.tx_agg, 'rx_agg': self.rx_agg})
-#                    self.samples = 0 # Don't do this!
-                elif request == 'stop':
+                if request == 'stop':
                     self.inq.task_done()
                     self.keep_running = False
+                elif isinstance(request, tuple) and request[0] == 'interface':
+                    self.inq.task_done()
+                    self.set_interface(request[1])
+                    self.start_window(self.last_data[0])
+                elif isinstance(request, tuple) and request[0] == 'add':
+                    self.inq.task_done()
+                    self.add_interfaces(request[1])
+                elif isinstance(request, tuple) and request[0] == 'remove':
+                    self.inq.task_done()
+                    self.remove_interfaces(request[1])
                 else:
                     self.inq.task_done()
                     pass # unknown request, FIXME: perhaps report an error?
-            #
-#            time.sleep(self.sleep_time)
-            self.request_event.wait(self.sleep_time)
-            self.request_event.clear()
         if (self.debug):
             # Race conditions can cause things to be pulled from under
             # our feet, so catch all exceptions here.
@@ -83,100 +202,291 @@ class Sampler(Thread):
                 pass
 
 
-    # Read the traffic flow data from the network interface and accumulate the rate
+    # Read the traffic flow data from all network interfaces and
+    # accumulate the rates, one interface at a time.
     def sample(self):
-        self.samples += 1
-        curr = self.get_interface_data(self.interface)
+        start = monotonic()
+        curr = self.get_interface_data()
+        self.read_timer.add(monotonic() - start)
+        last = self.last_data
+        timestamp = curr[0]
+        obs_time = timestamp - last[0]
+        curr_tx = curr[1]
+        curr_rx = curr[2]
+        last_tx = last[1]
+        last_rx = last[2]
+        samples = self.samples
+        mean_tx = self.mean_tx
+        m2_tx = self.m2_tx
+        mean_rx = self.mean_rx
+        m2_rx = self.m2_rx
+        ring = self.ring
+        if ring is not None:
+            ring.reserve(len(curr_tx))
+        sketch = self.sketch
+        buckets = SKETCH.buckets
+        last_bucket = buckets - 1
+        min_rate = SKETCH.min_rate
+        inv_log_gamma = SKETCH.inv_log_gamma
 
-        if curr[1] < self.last_data[1]:
-            # tx counter has wrapped
-            self.monitor.debugPrint("sampler.py: self.last_data[1] before wrap adjustment: " + str(self.last_data[1]))
-            self.last_data[1] -= self.tx_byte_counter_wrap_adjustment
-       
-        tx_bytes = curr[1] - self.last_data[1]
+        if self.debug:
+            self.monitor.debugPrint("sampler.py: curr: " + str(curr) + ", self.last_data: " + str(last))
+            self.monitor.debugPrint("sampler.py: obs_time: " + str(obs_time))
 
-        if curr[2] < self.last_data[2]:
-            # rx counter has wrapped
-            self.monitor.debugPrint("sampler.py: self.last_data[2] before wrap adjustment: " + str(self.last_data[2]))
-            self.last_data[2] -= self.rx_byte_counter_wrap_adjustment
+        for i in xrange(len(curr_tx)):
+            if curr_tx[i] < last_tx[i]:
+                # tx counter has wrapped
+                self.monitor.debugPrint("sampler.py: tx counter of " + self.interfaces[i] + " before wrap adjustment: " + str(last_tx[i]))
+                last_tx[i] -= self.tx_byte_counter_wrap_adjustment
+            if curr_rx[i] < last_rx[i]:
+                # rx counter has wrapped
+                self.monitor.debugPrint("sampler.py: rx counter of " + self.interfaces[i] + " before wrap adjustment: " + str(last_rx[i]))
+                last_rx[i] -= self.rx_byte_counter_wrap_adjustment
 
-        rx_bytes = curr[2] - self.last_data[2]
+            tx_byte_rate = (curr_tx[i] - last_tx[i]) / obs_time
+            rx_byte_rate = (curr_rx[i] - last_rx[i]) / obs_time
 
-        timestamp = curr[0] #- self.last_data[0]
-        obs_time = timestamp - self.last_data[0]
+            # Welford's update of the moments (see moments.py).
+            n = samples[i] + 1
+            samples[i] = n
+            delta = tx_byte_rate - mean_tx[i]
+            mean_tx[i] += delta / n
+            m2_tx[i] += delta * (tx_byte_rate - mean_tx[i])
+            delta = rx_byte_rate - mean_rx[i]
+            mean_rx[i] += delta / n
+            m2_rx[i] += delta * (rx_byte_rate - mean_rx[i])
 
-        if self.debug:
-            self.monitor.debugPrint("sampler.py: curr: " + str(curr) + ", self.last_data: " + str(self.last_data))
-            self.monitor.debugPrint("sampler.py: tx_bytes: " + str(tx_bytes) + ", rx_bytes: " + str(rx_bytes))
-            self.monitor.debugPrint("sampler.py: obs_time: " + str(obs_time))
+            # Count the rates in the sketch buckets (see
+            # RateSketch.index(), inlined here for speed).
+            base = 2 * i * buckets
+            if tx_byte_rate > min_rate:
+                j = int(ceil(log(tx_byte_rate / min_rate) * inv_log_gamma))
+                sketch[base + (j if j < last_bucket else last_bucket)] += 1
+            else:
+                sketch[base] += 1
+            base += buckets
+            if rx_byte_rate > min_rate:
+                j = int(ceil(log(rx_byte_rate / min_rate) * inv_log_gamma))
+                sketch[base + (j if j < last_bucket else last_bucket)] += 1
+            else:
+                sketch[base] += 1
 
-#        self.last_data = curr
-        self.last_data = list(curr) # copy curr
+            if ring is not None:
+                ring.append(timestamp, tx_byte_rate, rx_byte_rate, i)
 
-        tx_byte_rate  = tx_bytes / obs_time
-        rx_byte_rate  = rx_bytes / obs_time
-        self.tx_agg = self.tx_agg + tx_byte_rate
-        self.rx_agg = self.rx_agg + rx_byte_rate
-        self.txb2 = self.txb2 + (tx_byte_rate*tx_byte_rate)
-        self.rxb2 = self.rxb2 + (rx_byte_rate*rx_byte_rate)
+            if self.debug:
+                self.monitor.debugPrint("sampler.py: " + self.interfaces[i] + ": tx_byte_rate: " + str(tx_byte_rate) + ", rx_byte_rate: " + str(rx_byte_rate) + ", mean_tx: " + str(mean_tx[i]) + ". mean_rx: " + str(mean_rx[i]) + ", m2_tx: " + str(m2_tx[i]) + ", m2_rx: " + str(m2_rx[i]))
 
-        if self.debug:
-            self.monitor.debugPrint("sampler.py: tx_byte_rate: " + str(tx_byte_rate) + ", rx_byte_rate: " + str(rx_byte_rate) + ", self.tx_agg: " + str(self.tx_agg) + ". self.rx_agg: " + str(self.rx_agg) + ", self.txb2: " + str(self.txb2) + ", self.rxb2: " + str(self.rxb2))
+        if ring is not None:
+            ring.commit()
+
+        # The extra counters, 2 * k values per interface. Most of them
+        # (drops, errors) stay at zero, and a zero rate does not change
+        # zero moments, so those are skipped.
+        k2 = 2 * len(self.extra_counters)
+        if k2:
+            curr_extra = curr[3]
+            last_extra = last[3]
+            mean_extra = self.mean_extra
+            m2_extra = self.m2_extra
+            for j in xrange(len(curr_extra)):
+                count = curr_extra[j] - last_extra[j]
+                if count == 0 and mean_extra[j] == 0.0:
+                    continue
+                if count < 0:
+                    # the counter has wrapped
+                    count += 2 ** self.source.counter_bits
+                rate = count / obs_time
+                n = samples[j // k2]
+                delta = rate - mean_extra[j]
+                mean_extra[j] += delta / n
+                m2_extra[j] += delta * (rate - mean_extra[j])
+
+        self.last_data = curr
 
         return timestamp
-            
-
-    # Read the number of bytes received and sent to/from the network interface
-    def get_interface_data(self,interface):
-        if OS == OS_type.darwin: # OS X does not have /sys/class/net/...
-            # This is only for testing on OS X. Running netstat takes
-            # way to much time to be a practical method for reading
-            # the byte counters of an interface.
-            netstat_output = netstat("-i", "-b", "-I", interface)
-            for line in netstat_output:
-                if line.startswith(interface):
-                    words = line.split()
-                    rx_bytes = int(words[6])
-                    tx_bytes = int(words[9])
-                    return time.time(),rx_bytes,tx_bytes
-            return  time.time(),0,0
-        else:
-            # FIXME: Perhaps open the tx_file and the rx_file in the
-            #        __init__ method instead. Is there really a good
-            #        reason for doing it this way?
-            tx_fn = "/sys/class/net/%s/statistics/tx_bytes" % interface
-            rx_fn = "/sys/class/net/%s/statistics/rx_bytes" % interface
-            if self.tx_file is None:
-                self.tx_file = open(tx_fn)
-                tx_bytes = int(self.tx_file.read())
-            else:
-                self.tx_file.seek(0)
-                tx_bytes = int(self.tx_file.read())
 
-            if self.rx_file is None:
-                self.rx_file = open(rx_fn)
-                rx_bytes = int(self.rx_file.read())
-            else:
-                self.rx_file.seek(0)
-                rx_bytes = int(self.rx_file.read())
 
-#            return time.time(), tx_bytes, rx_bytes
-            return [time.time(), tx_bytes, rx_bytes]
+    # Start a new estimation window at the given time, with all
+    # moments reset. A new sample rate takes effect here, so all
+    # samples of a window are taken at the same rate.
+    def start_window(self, timestamp):
+        if self.scheduler.rate != self.sample_rate:
+            self.scheduler.set_rate(self.sample_rate)
+        self.window_start = timestamp
+        self.window_end = timestamp + self.window_length
+        self.window_ticks = 0
+        for field in self.moment_fields:
+            self.moments[field[0]][:] = self.zeros[field[0]]
+        self.sketch.clear()
+
+
+    # Publish the moments of the current window, which ends with the
+    # sample taken at timestamp, and start the next one. The window
+    # ends stay on a fixed grid so that they do not drift, unless the
+    # sampler has fallen so far behind that the next window would be
+    # less than half as long as the others.
+    def end_window(self, timestamp):
+        self.window += 1
+        arrays = dict(self.moments)
+        arrays['sketch'] = sparse(self.sketch)
+        self.snapshot.publish(self.interfaces, arrays,
+                              {'window': self.window,
+                               'start': self.window_start,
+                               'end': timestamp,
+                               'ticks': self.window_ticks,
+                               'rate': self.scheduler.rate})
+        next_end = self.window_end + self.window_length
+        self.start_window(timestamp)
+        if next_end - timestamp > 0.5 * self.window_length:
+            self.window_end = next_end
+
 
+    # Read the number of bytes received and sent to/from all the
+    # sampled network interfaces in one pass.
+    # Returns [timestamp, [tx_bytes, ...], [rx_bytes, ...]] with one
+    # entry per interface, and the extra counters if any (see
+    # counters.py).
+    def get_interface_data(self):
+        return self.source.read()
 
-    # 
+
+    # The new rate is picked up by the sampler thread before its next tick.
     def set_sample_rate(self,sample_rate):
         self.sample_rate = sample_rate
-        self.sleep_time = 1.0 / sample_rate
 
     def get_sample_rate(self):
         return self.sample_rate
 
+    # Set the length of the windows in seconds. A new length takes
+    # effect from the next window.
+    def set_window_length(self, window_length):
+        self.window_length = float(window_length)
+
+    # Set the interface(s) to sample. This resets the moments of all
+    # interfaces and points the counter source at the new interfaces.
+    # The current window is discarded when the sampler is running.
     def set_interface(self,interface):
-        self.interface = interface
+        self.interfaces = tuple(interface_list(interface))
+        n = len(self.interfaces)
+        self.set_moments(dict((field[0], array(field[1], [0] * (n * moment_width(field))))
+                              for field in self.moment_fields))
+        # The bucket counts of the window, by index into the flat
+        # array of counts (see sketch.py).
+        self.sketch = defaultdict(int)
+        self.source.set_interfaces(self.interfaces)
+        if self.ring is not None:
+            self.ring.set_interfaces(self.interfaces)
+        self.last_data = self.get_interface_data()
+
+    def set_moments(self, moments):
+        self.moments = moments
+        self.samples = moments['samples']
+        self.mean_tx = moments['mean_tx']
+        self.m2_tx = moments['m2_tx']
+        self.mean_rx = moments['mean_rx']
+        self.m2_rx = moments['m2_rx']
+        self.mean_extra = moments.get('mean_extra')
+        self.m2_extra = moments.get('m2_extra')
+        # Used to reset the moments at the start of each window.
+        self.zeros = dict((name, array(values.typecode, [0] * len(values)))
+                          for name, values in moments.items())
+
+    # Sample the given interfaces from now on, keeping the moments of
+    # the current window of those already sampled. The new interfaces
+    # start from zero in the current window. Unlike set_interface(),
+    # this only opens the counters of the new interfaces (where the
+    # source keeps them open) and does not discard the window.
+    def update_interfaces(self, interfaces):
+        interfaces = tuple(interfaces)
+        if interfaces == self.interfaces:
+            return
+        try:
+            self.source.set_interfaces(interfaces)
+        except (IOError, OSError):
+            if not self.drop_missing:
+                raise
+            # Some of the new interfaces are already gone again.
+            present = set(link_names())
+            interfaces = tuple(interface for interface in interfaces if interface in present)
+            self.source.set_interfaces(interfaces)
+        old = dict((interface, i) for i, interface in enumerate(self.interfaces))
+        moments = {}
+        for field in self.moment_fields:
+            values = self.moments[field[0]]
+            width = moment_width(field)
+            moved = array(values.typecode)
+            for interface in interfaces:
+                i = old.get(interface)
+                if i is None:
+                    moved.extend(array(values.typecode, [0] * width))
+                else:
+                    moved.extend(values[i * width:(i + 1) * width])
+            moments[field[0]] = moved
+        new = dict((interface, i) for i, interface in enumerate(interfaces))
+        buckets = SKETCH.buckets
+        sketch = defaultdict(int)
+        for index, count in self.sketch.iteritems():
+            i = new.get(self.interfaces[index // (2 * buckets)])
+            if i is not None:
+                sketch[2 * i * buckets + index % (2 * buckets)] = count
+        self.sketch = sketch
+        self.interfaces = interfaces
+        self.set_moments(moments)
+        if self.ring is not None:
+            self.ring.set_interfaces(self.interfaces)
+        # The counters are read again, so the next sample of every
+        # interface is over a shorter period than the others.
+        self.last_data = self.get_interface_data()
+
+    # Add interfaces that are not already sampled.
+    def add_interfaces(self, interfaces):
+        added = []
+        for interface in interface_list(interfaces):
+            if interface not in self.interfaces and interface not in added:
+                added.append(interface)
+        if added:
+            self.update_interfaces(self.interfaces + tuple(added))
 
+    def remove_interfaces(self, interfaces):
+        removed = set(interface_list(interfaces))
+        self.update_interfaces([interface for interface in self.interfaces
+                                if interface not in removed])
+
+    # After a failed read, drop the interfaces that are no longer on
+    # the host. Returns True if any were dropped, or if none are
+    # missing yet but fewer than MAX_FAILED_READS reads in a row have
+    # failed (and drop_missing is set), and False if the read failed
+    # for another reason.
+    def drop_missing_interfaces(self):
+        if not self.drop_missing:
+            return False
+        self.read_errors += 1
+        self.failed_reads += 1
+        present = set(link_names())
+        missing = [interface for interface in self.interfaces if interface not in present]
+        if not missing:
+            return self.failed_reads < MAX_FAILED_READS
+        self.update_interfaces([interface for interface in self.interfaces
+                                if interface in present])
+        return True
+
+    # Return the sampled interfaces as a comma separated string.
     def get_interface(self):
-        return self.interface
+        return ','.join(self.interfaces)
+
+    def get_interfaces(self):
+        return list(self.interfaces)
+
+    def get_counter_source(self):
+        return self.source.name
+
+    def get_extra_counters(self):
+        return list(self.extra_counters)
+
+    # Release the counter source of a stopped sampler.
+    def close(self):
+        self.source.close()
 
     def running(self):
         return self.keep_running
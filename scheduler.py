@@ -0,0 +1,143 @@
+# Copyright 2016 SICS Swedish ICT AB
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A drift-free tick scheduler for the sampler.
+#
+# Ticks are scheduled at absolute deadlines start + k * period on the
+# monotonic clock, so the time spent between two ticks (reading the
+# counters, accumulating the rates) does not lower the achieved rate.
+# When a tick is late by more than a period, the tick policy decides
+# what happens to the missed deadlines:
+#
+#   catchup - The missed ticks are taken back to back until the
+#             schedule is caught up, but never more than max_catchup
+#             of them; older missed ticks are skipped.
+#   skip    - The missed ticks are skipped, and the next tick is at
+#             the next deadline in the future.
+#
+# The lateness of each tick (the time between its deadline and when it
+# actually ran) is recorded in a histogram.
+
+import time
+from clock import monotonic
+
+TICK_POLICIES = ['catchup', 'skip']
+
+# Upper bounds (in seconds) of the lateness histogram buckets; the
+# last bucket holds everything later than LATENESS_BUCKETS[-1].
+LATENESS_BUCKETS = [1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2, 2e-2, 5e-2, 1e-1]
+
+
+class TickScheduler(object):
+    def __init__(self, rate, policy='catchup', max_catchup=10, spin=0.0,
+                 clock=monotonic, sleep=time.sleep):
+        if policy not in TICK_POLICIES:
+            raise ValueError("Unknown tick policy: " + repr(policy))
+        self.policy = policy
+        self.max_catchup = max_catchup
+        # Time before the deadline to stop sleeping and busy wait
+        # instead, to reduce the jitter at high rates.
+        self.spin = spin
+        self.clock = clock
+        self.sleep = sleep
+        self.set_rate(rate)
+        self.reset_stats()
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.start()
+
+    # Start a new schedule with the first tick one period from now.
+    def start(self):
+        self.epoch = self.clock()
+        self.tick = 0
+        self.deadline = self.epoch + self.period
+
+    def reset_stats(self):
+        self.ticks = 0
+        self.skipped = 0
+        self.lateness_sum = 0.0
+        self.lateness_max = 0.0
+        self.histogram = [0] * (len(LATENESS_BUCKETS) + 1)
+        self.stats_start = self.clock()
+
+    # Wait for the next deadline and return its lateness in seconds.
+    # should_stop is called regularly during long waits; if it returns
+    # True the wait ends early and None is returned.
+    def wait(self, should_stop=None):
+        clock = self.clock
+        deadline = self.deadline
+        now = clock()
+        remaining = deadline - now
+        while remaining > self.spin:
+            if should_stop is not None and should_stop():
+                return None
+            # Sleep in slices so that a stop request is noticed even
+            # at low rates.
+            self.sleep(min(remaining - self.spin, 0.1))
+            now = clock()
+            remaining = deadline - now
+        while remaining > 0.0:
+            now = clock()
+            remaining = deadline - now
+        lateness = now - deadline
+        self.record(lateness)
+        self.advance(now)
+        return lateness
+
+    # Compute the deadline of the next tick.
+    def advance(self, now):
+        self.tick += 1
+        next_deadline = self.epoch + (self.tick + 1) * self.period
+        if now > next_deadline:
+            # The number of deadlines that have already passed.
+            missed = int((now - next_deadline) / self.period) + 1
+            if self.policy == 'skip':
+                skip = missed
+            else:
+                skip = max(0, missed - self.max_catchup)
+            self.tick += skip
+            self.skipped += skip
+            next_deadline = self.epoch + (self.tick + 1) * self.period
+        self.deadline = next_deadline
+
+    def record(self, lateness):
+        self.ticks += 1
+        self.lateness_sum += lateness
+        if lateness > self.lateness_max:
+            self.lateness_max = lateness
+        i = 0
+        buckets = LATENESS_BUCKETS
+        while i < len(buckets) and lateness > buckets[i]:
+            i += 1
+        self.histogram[i] += 1
+
+    # The rate actually achieved since the statistics were last reset.
+    def achieved_rate(self):
+        elapsed = self.clock() - self.stats_start
+        if elapsed <= 0.0:
+            return 0.0
+        return self.ticks / elapsed
+
+    def stats(self):
+        return {'rate': self.rate,
+                'policy': self.policy,
+                'ticks': self.ticks,
+                'skipped': self.skipped,
+                'achieved_rate': self.achieved_rate(),
+                'mean_lateness': self.lateness_sum / self.ticks if self.ticks else 0.0,
+                'max_lateness': self.lateness_max,
+                'lateness_buckets': list(LATENESS_BUCKETS),
+                'lateness_histogram': list(self.histogram)}
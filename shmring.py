@@ -0,0 +1,226 @@
+# Copyright 2016 SICS Swedish ICT AB
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A fixed-size ring of raw samples in a memory-mapped file (normally
+# under /dev/shm), written by the sampler and read by any number of
+# other processes on the same computer, e.g. to look at microbursts in
+# the full rate series without reading the interface counters again.
+#
+# The file is a header followed by capacity records. All values are
+# little-endian.
+#
+#   Header (HEADER_SIZE bytes):
+#     offset  size  type    name
+#          0     8  char[]  magic, "RAMONRB1"
+#          8     4  uint32  format version, 1
+#         12     4  uint32  header size, HEADER_SIZE
+#         16     4  uint32  record size, RECORD_SIZE
+#         20     4  uint32  reserved
+#         24     8  uint64  capacity, the number of records in the ring
+#         32     8  uint64  write_seq, the number of records written
+#         40     8  uint64  reserve_seq, the number of records written
+#                           or being written
+#         48     8  uint64  generation, incremented when the
+#                           interfaces change
+#         56  4040  char[]  the sampled interfaces, comma separated
+#                           and NUL padded
+#
+#   Record (RECORD_SIZE bytes), record seq is at offset
+#   HEADER_SIZE + (seq % capacity) * RECORD_SIZE:
+#     offset  size  type     name
+#          0     8  uint64   seq, the sequence number of the record
+#          8     8  double   timestamp, on the monotonic clock of the
+#                            sampler (see clock.py), in seconds
+#         16     8  double   tx_rate, in bytes per second
+#         24     8  double   rx_rate, in bytes per second
+#         32     4  uint32   interface, index in the interface list
+#         36     4  uint32   reserved
+#
+# The sampler writes one record per interface and tick. Before writing
+# the records of a tick it sets reserve_seq, and when they are written
+# it sets write_seq, so records [0, write_seq) are complete. A reader
+# that falls more than capacity records behind has lost the oldest
+# ones (an overrun); so has a reader whose records were overwritten
+# while it copied them, which it detects by reading reserve_seq again
+# after the copy.
+
+import os
+import mmap
+import struct
+
+MAGIC = 'RAMONRB1'
+FORMAT_VERSION = 1
+HEADER_SIZE = 4096
+
+HEADER = struct.Struct('<8sIIII QQQQ')
+INTERFACES_OFFSET = HEADER.size
+SEQ_OFFSET = 32
+RESERVE_OFFSET = 40
+GENERATION_OFFSET = 48
+SEQ = struct.Struct('<Q')
+
+RECORD = struct.Struct('<QdddII')
+RECORD_SIZE = RECORD.size
+
+# The record layout as a NumPy dtype, see SampleRingReader.array().
+RECORD_DTYPE = [('seq', '<u8'), ('timestamp', '<f8'), ('tx_rate', '<f8'),
+                ('rx_rate', '<f8'), ('interface', '<u4'), ('reserved', '<u4')]
+
+DEFAULT_CAPACITY = 65536
+
+
+# Writes the ring. Not thread safe; only the sampler thread writes.
+class SampleRingWriter(object):
+    def __init__(self, path, capacity=DEFAULT_CAPACITY, interfaces=()):
+        self.path = path
+        self.capacity = capacity
+        size = HEADER_SIZE + capacity * RECORD_SIZE
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.seq = 0
+        self.generation = 0
+        HEADER.pack_into(self.map, 0, MAGIC, FORMAT_VERSION, HEADER_SIZE,
+                         RECORD_SIZE, 0, capacity, 0, 0, 0)
+        self.set_interfaces(interfaces)
+
+    def set_interfaces(self, interfaces):
+        names = ','.join(interfaces)
+        if len(names) >= HEADER_SIZE - INTERFACES_OFFSET:
+            raise ValueError("Too many interfaces for the sample ring")
+        self.generation += 1
+        self.map[INTERFACES_OFFSET:HEADER_SIZE] = names.ljust(HEADER_SIZE - INTERFACES_OFFSET, '\0')
+        SEQ.pack_into(self.map, GENERATION_OFFSET, self.generation)
+
+    # Announce that n records are about to be appended.
+    def reserve(self, n):
+        SEQ.pack_into(self.map, RESERVE_OFFSET, self.seq + n)
+
+    def append(self, timestamp, tx_rate, rx_rate, interface):
+        seq = self.seq
+        RECORD.pack_into(self.map, HEADER_SIZE + (seq % self.capacity) * RECORD_SIZE,
+                         seq, timestamp, tx_rate, rx_rate, interface, 0)
+        self.seq = seq + 1
+
+    # Make the appended records visible to the readers.
+    def commit(self):
+        SEQ.pack_into(self.map, SEQ_OFFSET, self.seq)
+
+    def close(self):
+        self.map.close()
+
+    # Remove the ring file. Readers that have it mapped keep their
+    # mapping.
+    def unlink(self):
+        os.unlink(self.path)
+
+
+# Reads the ring. Each reader keeps its own position, and counts the
+# records it has lost in overruns.
+class SampleRingReader(object):
+    def __init__(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self.map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        (magic, version, header_size, record_size, reserved,
+         self.capacity, write_seq, reserve_seq, generation) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(path + " is not a sample ring")
+        if header_size != HEADER_SIZE or record_size != RECORD_SIZE:
+            raise ValueError(path + " has an unsupported layout")
+        # Start with the records written from now on.
+        self.next_seq = write_seq
+        self.overruns = 0
+
+    def write_seq(self):
+        return SEQ.unpack_from(self.map, SEQ_OFFSET)[0]
+
+    def generation(self):
+        return SEQ.unpack_from(self.map, GENERATION_OFFSET)[0]
+
+    # The sampled interfaces; the interface of a record is an index in
+    # this list.
+    def interfaces(self):
+        names = self.map[INTERFACES_OFFSET:HEADER_SIZE].rstrip('\0')
+        if not names:
+            return []
+        return names.split(',')
+
+    # The range [start, end) of the records to read next, at most
+    # max_records of them. Records already overwritten are counted as
+    # overruns and skipped.
+    def next_range(self, max_records=None):
+        end = self.write_seq()
+        start = self.next_seq
+        if end - start > self.capacity:
+            self.overruns += end - self.capacity - start
+            start = end - self.capacity
+        if max_records is not None and end - start > max_records:
+            end = start + max_records
+        return start, end
+
+    # The number of records at the start of [start, end) that were
+    # overwritten while being copied.
+    def overwritten(self, start, end):
+        oldest = SEQ.unpack_from(self.map, RESERVE_OFFSET)[0] - self.capacity
+        if oldest <= start:
+            return 0
+        return min(oldest, end) - start
+
+    # Return the records written since the last read as a list of
+    # (seq, timestamp, tx_rate, rx_rate, interface) tuples, oldest
+    # first.
+    def read(self, max_records=None):
+        start, end = self.next_range(max_records)
+        records = []
+        for seq in xrange(start, end):
+            records.append(RECORD.unpack_from(self.map, HEADER_SIZE + (seq % self.capacity) * RECORD_SIZE)[:5])
+        lost = self.overwritten(start, end)
+        self.overruns += lost
+        self.next_seq = end
+        return records[lost:]
+
+    # The whole ring as a NumPy structured array with the fields of
+    # RECORD_DTYPE, mapped without copying. The records are in ring
+    # order, not time order, and may change under the caller's feet;
+    # see read_array() for a consistent copy.
+    def array(self):
+        import numpy
+        return numpy.frombuffer(self.map, dtype=numpy.dtype(RECORD_DTYPE),
+                                count=self.capacity, offset=HEADER_SIZE)
+
+    # Return the records written since the last read as a NumPy
+    # structured array, oldest first.
+    def read_array(self, max_records=None):
+        import numpy
+        ring = self.array()
+        start, end = self.next_range(max_records)
+        first = start % self.capacity
+        last = first + (end - start)
+        if last <= self.capacity:
+            records = ring[first:last].copy()
+        else:
+            records = numpy.concatenate((ring[first:], ring[:last - self.capacity]))
+        lost = self.overwritten(start, end)
+        self.overruns += lost
+        self.next_seq = end
+        return records[lost:]
+
+    def close(self):
+        self.map.close()
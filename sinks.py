@@ -0,0 +1,337 @@
+# Copyright 2016 SICS Swedish ICT AB
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Sinks for the meter data of mode 1.
+#
+# A StreamSink sends messages (e.g. JSON lines) over one long-lived
+# socket: TCP to a (host, port) address, or a Unix domain socket given
+# by its path, as a stream or as datagrams (one message per
+# datagram). The messages are queued in a bounded backlog and sent by
+# a background thread, which reconnects with exponential backoff when
+# the connection is lost or cannot be made. When the backlog is full,
+# the oldest message is dropped (drop-oldest), or the caller waits
+# until there is room (block).
+#
+# A message that was being sent when the connection broke is sent
+# again on the new connection, so the receiver may see it twice. Over
+# a stream, the old connection may also end with only a part of it,
+# so a receiver must discard an incomplete last line when the
+# connection closes. When the sink is closed, it does not reconnect:
+# what is left in the backlog after a failed send is dropped.
+#
+# A FileSink appends messages to a file that it keeps open, through a
+# write buffer. The buffer is flushed when flush_size bytes have been
+# written since the last flush, and by a background thread when the
+# oldest unflushed message is flush_interval seconds old. The fsync
+# policy decides when the data is also forced to disk: never (leave it
+# to the kernel), at every flush, or when a segment is rotated or the
+# sink closed.
+#
+# The file is rotated when it has grown to rotate_size bytes, or at
+# every multiple of rotate_interval seconds of wall clock time
+# (e.g. 3600 rotates on the hour), whichever comes first; zero
+# disables either. A rotated segment is renamed to
+# <path>.<UTC time of rotation>, e.g. meter.json.20160315T120000, and
+# then optionally compressed to <segment>.gz or <segment>.zst in the
+# background. close() writes and rotates nothing more, but waits for
+# the data to be flushed and the compressions to finish.
+
+import errno
+import os
+import gzip
+import shutil
+import socket
+import time
+from collections import deque
+from threading import Thread, Condition, Event, Lock
+
+SOCKET_TYPES = ['stream', 'dgram']
+BACKLOG_POLICIES = ['drop-oldest', 'block']
+FSYNC_POLICIES = ['never', 'flush', 'rotate']
+COMPRESSIONS = ['none', 'gzip', 'zstd']
+
+
+class StreamSink(object):
+    def __init__(self, address, socket_type='stream', backlog=1000,
+                 policy='drop-oldest', min_backoff=0.1, max_backoff=30.0,
+                 timeout=5.0):
+        if socket_type not in SOCKET_TYPES:
+            raise ValueError("Unknown socket type: " + repr(socket_type))
+        if policy not in BACKLOG_POLICIES:
+            raise ValueError("Unknown backlog policy: " + repr(policy))
+        self.address = address
+        if isinstance(address, basestring):
+            self.family = socket.AF_UNIX
+        else:
+            self.family = socket.AF_INET
+        if socket_type == 'stream':
+            self.type = socket.SOCK_STREAM
+        else:
+            self.type = socket.SOCK_DGRAM
+        self.backlog = backlog
+        self.policy = policy
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.queue = deque()
+        self.cond = Condition()
+        self.closing = Event()
+        self.sock = None
+        self.sent = 0
+        self.dropped = 0
+        self.connects = 0
+        self.errors = 0
+        self.thread = Thread(target=self.run, name='StreamSink')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    # Queue a message for sending.
+    def send(self, message):
+        with self.cond:
+            while len(self.queue) >= self.backlog:
+                if self.policy == 'drop-oldest' or self.closing.is_set():
+                    self.queue.popleft()
+                    self.dropped += 1
+                else:
+                    self.cond.wait(0.1)
+            self.queue.append(message)
+            self.cond.notify_all()
+
+    def connect(self):
+        sock = socket.socket(self.family, self.type)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except:
+            sock.close()
+            raise
+        self.sock = sock
+        self.connects += 1
+
+    def disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def run(self):
+        backoff = self.min_backoff
+        while True:
+            with self.cond:
+                while not self.queue and not self.closing.is_set():
+                    self.cond.wait(0.5)
+                if not self.queue:
+                    break       # closing and nothing left to send
+                message = self.queue[0]
+            try:
+                if self.sock is None:
+                    self.connect()
+                    backoff = self.min_backoff
+                if self.type == socket.SOCK_STREAM:
+                    self.sock.sendall(message)
+                else:
+                    self.sock.send(message)
+            except (socket.error, socket.timeout) as e:
+                self.errors += 1
+                self.disconnect()
+                if getattr(e, 'errno', None) == errno.EMSGSIZE:
+                    # The message can never be sent as a datagram.
+                    with self.cond:
+                        if self.queue and self.queue[0] is message:
+                            self.queue.popleft()
+                            self.dropped += 1
+                            self.cond.notify_all()
+                    continue
+                if self.closing.is_set():
+                    with self.cond:
+                        self.dropped += len(self.queue)
+                        self.queue.clear()
+                        self.cond.notify_all()
+                    break
+                self.closing.wait(backoff)
+                backoff = min(2 * backoff, self.max_backoff)
+                continue
+            with self.cond:
+                if self.queue and self.queue[0] is message:
+                    self.queue.popleft()
+                self.sent += 1
+                self.cond.notify_all()
+        self.disconnect()
+
+    # Send what is left in the backlog, waiting at most timeout
+    # seconds, and close the connection.
+    def close(self, timeout=1.0):
+        with self.cond:
+            self.closing.set()
+            self.cond.notify_all()
+        self.thread.join(timeout)
+
+    def stats(self):
+        return {'backlog': len(self.queue),
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'connects': self.connects,
+                'errors': self.errors}
+
+
+class FileSink(object):
+    def __init__(self, path, flush_size=65536, flush_interval=1.0,
+                 fsync='never', rotate_size=0, rotate_interval=0,
+                 compress='none'):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy: " + repr(fsync))
+        if compress not in COMPRESSIONS:
+            raise ValueError("Unknown compression: " + repr(compress))
+        if compress == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError("zstd compression needs the zstandard module")
+        self.path = path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.compress = compress
+        self.lock = Lock()
+        self.closing = Event()
+        self.file = None
+        self.unflushed = 0
+        self.first_unflushed = None
+        self.written = 0
+        self.flushes = 0
+        self.rotations = 0
+        self.errors = 0
+        self.compressors = []
+        self.open()
+        self.thread = Thread(target=self.run, name='FileSink')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def open(self):
+        self.file = open(self.path, 'ab', max(self.flush_size, 4096))
+        self.size = self.file.tell()
+        if self.rotate_interval > 0:
+            now = time.time()
+            self.rotate_at = now - now % self.rotate_interval + self.rotate_interval
+        else:
+            self.rotate_at = None
+
+    # Append a message to the file.
+    def send(self, message):
+        with self.lock:
+            if self.file is None:
+                raise ValueError("Write to a closed FileSink")
+            if (self.rotate_at is not None and time.time() >= self.rotate_at) or \
+               (self.rotate_size > 0 and self.size > 0 and
+                self.size + len(message) > self.rotate_size):
+                self.rotate()
+            self.file.write(message)
+            self.size += len(message)
+            self.written += 1
+            self.unflushed += len(message)
+            if self.first_unflushed is None:
+                self.first_unflushed = time.time()
+            if self.unflushed >= self.flush_size:
+                self.flush()
+
+    # Write the buffer to the file. Called with the lock held.
+    def flush(self):
+        if self.first_unflushed is None:
+            return
+        self.file.flush()
+        if self.fsync == 'flush':
+            os.fsync(self.file.fileno())
+        self.unflushed = 0
+        self.first_unflushed = None
+        self.flushes += 1
+
+    # Close the current segment, rename it and start a new one. Called
+    # with the lock held.
+    def rotate(self):
+        self.flush()
+        if self.fsync != 'never':
+            os.fsync(self.file.fileno())
+        self.file.close()
+        segment = self.path + '.' + time.strftime('%Y%m%dT%H%M%S', time.gmtime())
+        n = 1
+        name = segment
+        while os.path.exists(name) or os.path.exists(name + '.gz') or \
+              os.path.exists(name + '.zst'):
+            n += 1
+            name = segment + '-' + str(n)
+        os.rename(self.path, name)
+        self.rotations += 1
+        if self.compress != 'none':
+            compressor = Thread(target=self.compress_segment, args=(name,),
+                                name='FileSinkCompress')
+            compressor.setDaemon(True)
+            compressor.start()
+            self.compressors = [c for c in self.compressors if c.is_alive()]
+            self.compressors.append(compressor)
+        self.open()
+
+    # Compress a rotated segment, and remove it when its compressed
+    # copy is complete.
+    def compress_segment(self, name):
+        try:
+            if self.compress == 'gzip':
+                with open(name, 'rb') as src:
+                    dst = gzip.open(name + '.gz.tmp', 'wb')
+                    try:
+                        shutil.copyfileobj(src, dst)
+                    finally:
+                        dst.close()
+                os.rename(name + '.gz.tmp', name + '.gz')
+            else:
+                import zstandard
+                with open(name, 'rb') as src:
+                    with open(name + '.zst.tmp', 'wb') as dst:
+                        zstandard.ZstdCompressor().copy_stream(src, dst)
+                os.rename(name + '.zst.tmp', name + '.zst')
+            os.unlink(name)
+        except (IOError, OSError) as e:
+            self.errors += 1
+            print("Could not compress " + name + ": " + str(e))
+
+    # Flush the messages that have waited flush_interval seconds.
+    def run(self):
+        while not self.closing.is_set():
+            self.closing.wait(self.flush_interval / 4.0)
+            with self.lock:
+                if self.file is not None and self.first_unflushed is not None and \
+                   time.time() - self.first_unflushed >= self.flush_interval:
+                    self.flush()
+
+    # Flush the file and close it, and wait for the compressions of
+    # the rotated segments to finish.
+    def close(self):
+        self.closing.set()
+        with self.lock:
+            if self.file is not None:
+                self.flush()
+                if self.fsync != 'never':
+                    os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+        self.thread.join()
+        for compressor in self.compressors:
+            compressor.join()
+
+    def stats(self):
+        return {'written': self.written,
+                'flushes': self.flushes,
+                'rotations': self.rotations,
+                'size': self.size,
+                'errors': self.errors}
@@ -0,0 +1,140 @@
+# Copyright 2016 SICS Swedish ICT AB
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A bounded-memory, mergeable quantile sketch of the sampled rates, in
+# the style of DDSketch (Masson, Rim and Lee, 2019).
+#
+# The rates are counted in logarithmically spaced buckets: bucket 0
+# holds the rates up to min_rate (including the many zero rates of an
+# idle link), and bucket i > 0 the rates in
+# (min_rate * gamma**(i-1), min_rate * gamma**i], with
+# gamma = (1 + accuracy) / (1 - accuracy). Every rate in a bucket is
+# within a relative error of accuracy from the bucket's value, so the
+# quantiles and tail probabilities read from the sketch are too. Rates
+# above max_rate are counted in the last bucket, which bounds the
+# memory to a fixed number of buckets.
+#
+# A sketch is just an array of counts, so sketches are merged by
+# adding them, and a sketch is removed from a merge by subtracting it.
+# The sketches of all interfaces and directions are laid out one after
+# the other in a flat array of counts; RateSketch describes the bucket
+# layout.
+#
+# Most buckets of a window's sketch are empty, so the windows are kept
+# sparse: an array of (index, count) pairs of the non-empty buckets,
+# with index into the flat array of counts (see sparse()). Only the
+# merge over a sliding window of slots is a flat array.
+
+import math
+from array import array
+from collections import deque
+from itertools import izip
+
+DEFAULT_ACCURACY = 0.02
+DEFAULT_MIN_RATE = 1.0
+DEFAULT_MAX_RATE = 1e11     # bytes/s, 800 Gbit/s
+
+
+class RateSketch(object):
+    def __init__(self, accuracy=DEFAULT_ACCURACY, min_rate=DEFAULT_MIN_RATE,
+                 max_rate=DEFAULT_MAX_RATE):
+        self.accuracy = accuracy
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.gamma = (1.0 + accuracy) / (1.0 - accuracy)
+        self.inv_log_gamma = 1.0 / math.log(self.gamma)
+        self.buckets = int(math.ceil(math.log(max_rate / min_rate) * self.inv_log_gamma)) + 1
+
+    # The bucket of the rate x.
+    def index(self, x):
+        if x <= self.min_rate:
+            return 0
+        i = int(math.ceil(math.log(x / self.min_rate) * self.inv_log_gamma))
+        if i >= self.buckets:
+            return self.buckets - 1
+        return i
+
+    # The value of bucket i, within accuracy of all rates in it.
+    def value(self, i):
+        if i == 0:
+            return 0.0
+        return 2.0 * self.min_rate * self.gamma ** i / (self.gamma + 1.0)
+
+    # The counts of sketch k of a flat array of counts.
+    def counts(self, flat, k):
+        return flat[k * self.buckets:(k + 1) * self.buckets]
+
+    # Sparse counts with sketch k moved to sketch moved[k], leaving out
+    # the sketches that are not in moved.
+    def move(self, pairs, moved):
+        buckets = self.buckets
+        result = array(pairs.typecode)
+        it = iter(pairs)
+        for index, count in izip(it, it):
+            k = moved.get(index // buckets)
+            if k is not None:
+                result.append(k * buckets + index % buckets)
+                result.append(count)
+        return result
+
+    # The fraction of the rates counted in counts (one sketch) that
+    # are above x.
+    def tail_probability(self, counts, x):
+        total = sum(counts)
+        if total == 0:
+            return 0.0
+        return sum(counts[self.index(x) + 1:]) / float(total)
+
+    # The q quantile (0 <= q <= 1) of the rates counted in counts.
+    def quantile(self, counts, q):
+        total = sum(counts)
+        if total == 0:
+            return 0.0
+        rank = q * (total - 1)
+        seen = 0
+        for i in range(len(counts)):
+            seen += counts[i]
+            if seen > rank:
+                return self.value(i)
+        return self.value(len(counts) - 1)
+
+
+# The sparse counts of a dict of index -> count, in order of index.
+def sparse(counts):
+    pairs = array('I')
+    for index in sorted(counts):
+        pairs.append(index)
+        pairs.append(counts[index])
+    return pairs
+
+
+# The merge, in a flat array of length counts, of the last size sparse
+# counts pushed, e.g. the sketches of a sliding window of slots. Only
+# the buckets of the pushed and the expired counts are updated.
+class SlidingSketch(object):
+    def __init__(self, size, length):
+        self.size = size
+        self.items = deque()
+        self.merged = array('L', [0] * length)
+
+    def push(self, pairs):
+        self.items.append(pairs)
+        merged = self.merged
+        it = iter(pairs)
+        for index, count in izip(it, it):
+            merged[index] += count
+        if len(self.items) > self.size:
+            it = iter(self.items.popleft())
+            for index, count in izip(it, it):
+                merged[index] -= count
@@ -0,0 +1,112 @@
+# Copyright 2016 SICS Swedish ICT AB
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A versioned, multi-buffered snapshot of per-interface arrays,
+# written by one thread (the sampler) and read by any number of other
+# threads without locks and without waking the writer.
+#
+# The writer keeps depth buffers (two by default) and writes version v
+# into buffer v % depth; it publishes a buffer by incrementing the
+# version, and readers copy the buffer of the version they want. Before
+# writing, the writer announces the version it is about to write in
+# write_version. A reader's copy of version v is consistent unless the
+# writer has started on version v + depth, which reuses the buffer
+# being copied, in which case the reader retries (or gives up on that
+# version). So the last depth - 1 versions can always be read, which
+# lets a reader that falls behind catch up on the versions it missed.
+# Setting an attribute is atomic in CPython, which is all the ordering
+# this needs.
+
+from array import array
+
+
+class Snapshot(object):
+    # fields is a list of (name, array typecode) pairs of per-interface
+    # arrays, or (name, typecode, width) triples of arrays with width
+    # values per interface, or with width None of arrays of any length
+    # (e.g. sparse sketches), scalars a list of names of single values,
+    # and depth the number of buffers.
+    def __init__(self, fields, scalars, depth=2):
+        self.fields = list(fields)
+        self.scalars = list(scalars)
+        self.depth = depth
+        self.buffers = [self.new_buffer(0) for i in range(depth)]
+        self.version = 0
+        self.write_version = 0
+
+    def new_buffer(self, n):
+        buf = {'interfaces': ()}
+        for name in self.scalars:
+            buf[name] = 0
+        for field in self.fields:
+            buf[field[0]] = self.field_array(field, n)
+        return buf
+
+    def field_array(self, field, n):
+        if len(field) > 2:
+            n = 0 if field[2] is None else n * field[2]
+        return array(field[1], [0] * n)
+
+    # Publish the current values. interfaces is a tuple of interface
+    # names, which must be the same object as long as the interfaces
+    # do not change. arrays maps each field name to an array with one
+    # value per interface (or width values, or any number), and scalars
+    # each scalar name to its value.
+    def publish(self, interfaces, arrays, scalars):
+        version = self.version + 1
+        self.write_version = version
+        buf = self.buffers[version % self.depth]
+        if buf['interfaces'] is not interfaces:
+            # The interfaces have changed; this is the only time the
+            # writer allocates, apart from resizing the arrays of any
+            # length.
+            buf = self.new_buffer(len(interfaces))
+            buf['interfaces'] = interfaces
+            self.buffers[version % self.depth] = buf
+        for field in self.fields:
+            buf[field[0]][:] = arrays[field[0]]
+        for name in self.scalars:
+            buf[name] = scalars[name]
+        self.version = version
+
+    # Copy the latest published values into dest, a buffer made by
+    # new_buffer() (see reader_buffer()), and return the version that
+    # was copied. dest is only reallocated if the interfaces changed.
+    #
+    # If version is given, that version is copied instead, and None is
+    # returned if it has already been overwritten (or not yet been
+    # published).
+    def read_into(self, dest, version=None):
+        latest = version is None
+        while True:
+            if latest:
+                version = self.version
+            elif version > self.version or self.write_version >= version + self.depth:
+                return None
+            buf = self.buffers[version % self.depth]
+            interfaces = buf['interfaces']
+            if dest['interfaces'] is not interfaces:
+                for field in self.fields:
+                    dest[field[0]] = self.field_array(field, len(interfaces))
+                dest['interfaces'] = interfaces
+            for field in self.fields:
+                dest[field[0]][:] = buf[field[0]]
+            for name in self.scalars:
+                dest[name] = buf[name]
+            if self.write_version < version + self.depth:
+                return version
+
+    # A buffer to use with read_into().
+    def reader_buffer(self):
+        return self.new_buffer(0)
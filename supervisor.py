@@ -0,0 +1,580 @@
+# Copyright 2016 SICS Swedish ICT AB
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+# A supervisor that shards the interfaces of a host across a pool of
+# worker processes, so that the monitor is not limited to the one core
+# a Python process can use (see run_supervisor.py).
+#
+# Each worker runs a Monitor on its shard of the interfaces, pinned to
+# its cores with sched_setaffinity(). The workers have no sinks and no
+# configuration server of their own. They send their meter records to
+# the supervisor, which exports them all through one Exporter and
+# CeiloComm (a file, a port or Ceilometer, as with run_monitor.py).
+# The supervisor also serves the one configuration port (see
+# confserver.py). It forwards each command to all the workers and
+# merges their replies: a value that all workers agree on is returned
+# as it is, and otherwise as {worker: value}. The status and stats
+# replies also hold the shards, their cores, processes and loads.
+#
+# The supervisor restarts a worker that exits, after a delay that
+# grows with its consecutive failures (up to 30 seconds). The settings
+# changed by commands are kept for the restarted workers.
+#
+# Every report_interval seconds each worker reports its load: its
+# telemetry (see Monitor.telemetry_stats), from which the supervisor
+# takes the share of a CPU used by the worker, or 1.0 if the sampler
+# does not achieve 90% of its sample rate. Every rebalance_interval
+# seconds (and on the rebalance command) the supervisor moves
+# interfaces from the busiest worker to the least busy one, if the
+# busiest worker is above rebalance_threshold and the difference
+# between them is above rebalance_margin. The number of interfaces
+# moved is estimated to halve the difference, assuming that every
+# interface of the busiest worker costs the same.
+
+import os
+import sys
+import time
+import ctypes
+import ctypes.util
+import traceback
+import multiprocessing
+from Queue import Queue, Empty
+from threading import Thread, Event
+from datetime import datetime
+
+from monitor import Monitor
+from sampler import interface_list
+from exporter import Exporter
+from confserver import createConfServer
+from meterformat import is_meter
+from clock import monotonic
+from utc import UTC
+
+# The number of CPUs in the affinity mask of sched_setaffinity().
+CPU_SETSIZE = 1024
+
+# The longest delay (in seconds) before restarting a failed worker.
+MAX_RESTART_DELAY = 30.0
+
+# A worker that has run this long (in seconds) before it failed is
+# restarted without delay.
+STABLE_TIME = 60.0
+
+# The commands that change a setting of the monitors, and the argument
+# of Monitor that a restarted worker gets the new setting in.
+SETTINGS = {'sample_rate': 'sample_rate',
+            'estimation_interval': 'estimation_interval',
+            'meter_interval': 'meter_interval',
+            'link_speed': 'link_speed',
+            'alarm_trigger': 'alarm_trigger_value',
+            'cutoff': 'cutoff'}
+
+
+# Parse a list of cores such as "0,2,4-7".
+def parse_cores(cores):
+    result = []
+    for part in cores.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            result.extend(range(int(first), int(last) + 1))
+        else:
+            result.append(int(part))
+    return result
+
+
+# Pin the calling thread, and the threads and processes it starts
+# later, to the given cores. Python 2 has no os.sched_setaffinity(),
+# so the C library is called through ctypes.
+def set_affinity(cores):
+    bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong * (CPU_SETSIZE // bits))()
+    for core in cores:
+        if not 0 <= core < CPU_SETSIZE:
+            raise ValueError("No such core: " + repr(core))
+        mask[core // bits] |= 1 << (core % bits)
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, 'Cannot pin to the cores %s: %s' % (cores, os.strerror(errno)))
+
+
+# The cores that the calling thread may run on, with
+# sched_getaffinity() through ctypes as in set_affinity().
+def get_affinity():
+    bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong * (CPU_SETSIZE // bits))()
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if libc.sched_getaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, 'Cannot get the allowed cores: ' + os.strerror(errno))
+    return [core for core in range(CPU_SETSIZE) if mask[core // bits] & (1 << (core % bits))]
+
+
+# The body of a worker process: a Monitor of the given interfaces,
+# whose meter records and replies go to the results queue, and which
+# takes (request id, command) pairs from the commands queue.
+def run_worker(worker_id, interfaces, cores, monitor_args, commands, results, report_interval):
+    try:
+        if cores:
+            set_affinity(cores)
+
+        def export(record):
+            if is_meter(record):
+                results.put(('record', worker_id, record))
+
+        monitor = Monitor(interface=','.join(interfaces), confport=None,
+                          export=export, **monitor_args)
+        for target, args in [(worker_commands, (monitor, worker_id, commands, results)),
+                             (worker_reports, (monitor, worker_id, results, report_interval))]:
+            thread = Thread(target=target, args=args)
+            thread.setDaemon(True)
+            thread.start()
+        results.put(('started', worker_id, os.getpid()))
+        monitor.main()
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        results.put(('error', worker_id, traceback.format_exc()))
+        sys.exit(1)
+
+
+# Hand the commands of the supervisor to the monitor of a worker, the
+# way its configuration server would.
+def worker_commands(monitor, worker_id, commands, results):
+    while True:
+        request_id, data = commands.get()
+
+        def reply_to(reply, request_id=request_id):
+            results.put(('reply', worker_id, request_id, reply))
+
+        monitor.config_queue.put((data, reply_to))
+        monitor.conf_event.set()
+
+
+# Report the load of a worker every interval seconds.
+def worker_reports(monitor, worker_id, results, interval):
+    while not monitor.exit_flag:
+        time.sleep(interval)
+        try:
+            results.put(('load', worker_id, monitor.telemetry_stats()))
+        except Exception as e:
+            print("Worker " + str(worker_id) + ": could not report the load: " + str(e))
+
+
+# Merge the replies of the workers to one command.
+def merge_replies(replies):
+    merged = {}
+    for key in set(key for reply in replies.values() for key in reply):
+        values = dict((worker_id, reply[key]) for worker_id, reply in replies.items() if key in reply)
+        distinct = values.values()
+        if len(values) == len(replies) and all(value == distinct[0] for value in distinct):
+            merged[key] = distinct[0]
+        else:
+            merged[key] = dict((str(worker_id), value) for worker_id, value in values.items())
+    return merged
+
+
+# A worker process and its shard of the interfaces.
+class Worker(object):
+    def __init__(self, worker_id, interfaces, cores):
+        self.id = worker_id
+        self.interfaces = list(interfaces)
+        self.cores = cores
+        self.process = None
+        self.commands = None
+        self.pid = None
+        self.started = None
+        self.restarts = 0
+        self.failures = 0
+        self.restart_at = 0.0
+        self.load = None        # the latest telemetry_stats() of the worker
+
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+
+class Supervisor(object):
+    def __init__(self, interfaces, ceilocomm, monitor_args,
+                 workers=None, # the number of workers; default one per core
+                 cores=None, # the cores to pin the workers to, round robin
+                 meter_name=None,
+                 resid=None,
+                 projid=None,
+                 username='admin',
+                 password=None,
+                 tenantname='admin',
+                 conflistener_IP='0.0.0.0',
+                 confport=54736,
+                 export_queue_size=1000,
+                 export_policy='drop-oldest',
+                 report_interval=5.0, # seconds between load reports
+                 rebalance_interval=60.0, # seconds between rebalancings; 0 never
+                 rebalance_threshold=0.8, # share of a CPU of the busiest worker
+                 rebalance_margin=0.2, # smallest difference of loads to rebalance
+                 request_timeout=5.0, # longest wait for the replies of the workers
+                 debug=False):
+        self.interfaces = interface_list(interfaces)
+        if not self.interfaces:
+            raise ValueError("No interfaces to monitor")
+        self.cores = list(cores or [])
+        if workers is None:
+            workers = len(self.cores) or multiprocessing.cpu_count()
+        self.nworkers = workers
+        self.monitor_args = dict(monitor_args)
+        self.ceilocomm = ceilocomm
+        self.meter_name = meter_name
+        self.resource_ID = resid
+        self.project_ID = projid
+        self.username = username
+        self.conflistener_IP = conflistener_IP
+        self.conflistenerport = confport
+        self.report_interval = report_interval
+        self.rebalance_interval = rebalance_interval
+        self.rebalance_threshold = rebalance_threshold
+        self.rebalance_margin = rebalance_margin
+        self.request_timeout = request_timeout
+        self.debug = debug
+        self.exit_flag = False
+        # The configuration server puts its commands here (see
+        # confserver.py).
+        self.config_queue = Queue()
+        self.conf_event = Event()
+        self.results = multiprocessing.Queue()
+        self.requests = {}      # request id -> pending request, see forward()
+        self.next_request = 1
+        self.workers = []
+        self.shard(self.interfaces)
+        self.ceilocomm.startTokenRefresh(tenantname=tenantname, username=username, password=password)
+        self.exporter = Exporter(self.export_record, maxsize=export_queue_size,
+                                 policy=export_policy)
+        self.exporter.start()
+
+    def debugPrint(self, tracestring):
+        print(tracestring)
+
+    # Deal the interfaces out to the workers, round robin. There are
+    # never more workers than interfaces.
+    def shard(self, interfaces):
+        n = min(self.nworkers, len(interfaces))
+        self.workers = []
+        for i in range(n):
+            cores = [self.cores[i % len(self.cores)]] if self.cores else []
+            self.workers.append(Worker(i, interfaces[i::n], cores))
+
+    def start_worker(self, worker):
+        worker.commands = multiprocessing.Queue()
+        worker.process = multiprocessing.Process(target=run_worker,
+                                                 name='MonitorWorker-%d' % worker.id,
+                                                 args=(worker.id, worker.interfaces, worker.cores,
+                                                       self.monitor_args, worker.commands,
+                                                       self.results, self.report_interval))
+        worker.process.daemon = True
+        worker.process.start()
+        worker.pid = worker.process.pid
+        worker.started = monotonic()
+        worker.load = None
+
+    # Tell the workers to exit, and wait at most timeout seconds for
+    # them before terminating them. Their results are handled
+    # meanwhile, so that none of them blocks on a full queue.
+    def stop_workers(self, workers, timeout=5.0):
+        for worker in workers:
+            if worker.alive():
+                worker.commands.put((None, {'exit': True}))
+        deadline = monotonic() + timeout
+        while [worker for worker in workers if worker.alive()] and monotonic() < deadline:
+            self.handle_results(0.05)
+        for worker in workers:
+            if worker.alive():
+                worker.process.terminate()
+            if worker.process is not None:
+                worker.process.join()
+                worker.process = None
+
+    # Restart the workers that have exited.
+    def check_workers(self):
+        now = monotonic()
+        for worker in self.workers:
+            if worker.process is not None and not worker.process.is_alive():
+                if now - worker.started >= STABLE_TIME:
+                    worker.failures = 0
+                delay = min(2.0 ** worker.failures - 1, MAX_RESTART_DELAY)
+                print("Worker %d (pid %d) exited with %s; restarting it in %g s" % (
+                    worker.id, worker.pid, worker.process.exitcode, delay))
+                worker.process.join()
+                worker.process = None
+                worker.failures += 1
+                worker.restarts += 1
+                worker.restart_at = now + delay
+                for request_id in self.requests.keys():
+                    self.handle_reply(worker.id, request_id, None)
+            if worker.process is None and now >= worker.restart_at:
+                self.start_worker(worker)
+
+    # Handle the results of the workers, waiting at most timeout
+    # seconds for the first.
+    def handle_results(self, timeout):
+        try:
+            result = self.results.get(True, timeout)
+            while True:
+                self.handle_result(result)
+                result = self.results.get_nowait()
+        except Empty:
+            pass
+
+    def handle_result(self, result):
+        kind, worker_id = result[0], result[1]
+        if kind == 'record':
+            self.exporter.put(result[2])
+        elif kind == 'reply':
+            if result[2] is not None:
+                self.handle_reply(worker_id, result[2], result[3])
+        elif kind == 'load':
+            if worker_id < len(self.workers):
+                self.workers[worker_id].load = result[2]
+        elif kind == 'error':
+            print("Worker %d failed:\n%s" % (worker_id, result[2]))
+
+    # Send a command to all running workers, or with commands a
+    # command of its own to each worker in the dict (worker -> data).
+    # reply_to is called with the merged replies, added to reply, when
+    # all have replied or request_timeout seconds have passed.
+    def forward(self, data, reply_to, reply, shards=False, commands=None):
+        request_id = self.next_request
+        self.next_request += 1
+        if commands is None:
+            commands = dict((worker, data) for worker in self.workers)
+        waiting = set()
+        for worker, worker_data in commands.items():
+            if worker.alive():
+                worker.commands.put((request_id, worker_data))
+                waiting.add(worker.id)
+        self.requests[request_id] = {'reply_to': reply_to, 'reply': reply,
+                                     'waiting': waiting, 'replies': {},
+                                     'shards': shards,
+                                     'deadline': monotonic() + self.request_timeout}
+        if not waiting:
+            self.finish_request(request_id)
+
+    # A reply of a worker to a request, or None if the worker is gone.
+    def handle_reply(self, worker_id, request_id, reply):
+        request = self.requests.get(request_id)
+        if request is None or worker_id not in request['waiting']:
+            return
+        request['waiting'].discard(worker_id)
+        if reply is not None:
+            request['replies'][worker_id] = reply
+        if not request['waiting']:
+            self.finish_request(request_id)
+
+    def finish_request(self, request_id):
+        request = self.requests.pop(request_id)
+        reply = request['reply']
+        reply.update(merge_replies(request['replies']))
+        if request['waiting']:
+            reply['no reply'] = sorted(request['waiting'])
+        if request['shards']:
+            reply['shards'] = self.shards()
+            reply['export'] = self.exporter.stats()
+        request['reply_to'](reply)
+
+    def expire_requests(self):
+        now = monotonic()
+        for request_id, request in self.requests.items():
+            if now >= request['deadline']:
+                self.finish_request(request_id)
+
+    # Carry out one command from the configuration server.
+    def handle_configuration(self):
+        data, reply_to = self.config_queue.get()
+        self.config_queue.task_done()
+        if self.debug:
+            self.debugPrint('Supervisor.handle_configuration: ' + repr(data))
+        data = dict(data)
+        if data.get('exit') is not None:
+            reply_to({'exit': 'ok'})
+            self.exit()
+            return
+        reply = {}
+        if data.pop('rebalance', None) is not None:
+            reply['rebalance'] = self.rebalance(force=True)
+        interface = data.pop('interface', None)
+        if interface is not None:
+            self.reshard(interface_list(interface))
+            reply['interface'] = ','.join(self.interfaces)
+        added = data.pop('add_interfaces', None)
+        removed = data.pop('remove_interfaces', None)
+        if added is not None or removed is not None:
+            commands = self.change_interfaces(interface_list(added or []),
+                                              interface_list(removed or []))
+            reply['interface'] = ','.join(self.interfaces)
+            if commands and not data:
+                self.forward(None, reply_to, reply, commands=commands)
+                return
+            for worker, worker_data in commands.items():
+                if worker.alive():
+                    worker.commands.put((None, worker_data))
+        if data:
+            for command, argument in SETTINGS.items():
+                if data.get(command) is not None:
+                    self.monitor_args[argument] = data[command]
+            self.forward(data, reply_to, reply,
+                         shards=data.get('status') is not None or data.get('stats') is not None)
+        elif reply:
+            reply_to(reply)
+        else:
+            reply_to({'unknown option(s)': data})
+
+    # Monitor another set of interfaces: the workers are restarted
+    # with new shards.
+    def reshard(self, interfaces):
+        if not interfaces:
+            return
+        self.stop_workers(self.workers)
+        self.interfaces = interfaces
+        self.shard(interfaces)
+        for worker in self.workers:
+            self.start_worker(worker)
+
+    # Add interfaces to the shards and remove them from their shards,
+    # without restarting the workers. An added interface goes to the
+    # worker with the fewest interfaces. Returns the commands for the
+    # workers whose shards changed (worker -> data), which have to be
+    # sent to them; a worker that is not running gets its new shard
+    # when it is restarted.
+    def change_interfaces(self, added, removed):
+        changes = {}
+        for interface in removed:
+            for worker in self.workers:
+                if interface in worker.interfaces:
+                    worker.interfaces.remove(interface)
+                    self.interfaces.remove(interface)
+                    changes.setdefault(worker, ([], []))[1].append(interface)
+        for interface in added:
+            if interface in self.interfaces or not self.workers:
+                continue
+            worker = min(self.workers, key=lambda worker: len(worker.interfaces))
+            worker.interfaces.append(interface)
+            self.interfaces.append(interface)
+            changes.setdefault(worker, ([], []))[0].append(interface)
+        commands = {}
+        for worker, (worker_added, worker_removed) in changes.items():
+            data = {}
+            if worker_added:
+                data['add_interfaces'] = ','.join(worker_added)
+            if worker_removed:
+                data['remove_interfaces'] = ','.join(worker_removed)
+            commands[worker] = data
+        return commands
+
+    # The load of a worker: the share of a CPU it uses, or 1.0 if its
+    # sampler does not keep up.
+    def worker_load(self, worker):
+        stats = worker.load
+        if stats is None:
+            return None
+        load = stats['cpu_share']
+        sampler = stats['sampler']
+        if sampler['ticks'] >= sampler['rate'] and sampler['achieved_rate'] < 0.9 * sampler['rate']:
+            load = max(load, 1.0)
+        return load
+
+    # Move interfaces from the busiest worker to the least busy one
+    # (see above). With force, the busiest worker need not be above
+    # the threshold. Returns what was done.
+    def rebalance(self, force=False):
+        loads = [(self.worker_load(worker), worker) for worker in self.workers
+                 if worker.alive() and worker.load is not None]
+        if len(loads) < 2:
+            return 'no load reports'
+        loads.sort(key=lambda pair: pair[0])
+        idle_load, idlest = loads[0]
+        busy_load, busiest = loads[-1]
+        if len(busiest.interfaces) < 2 or busy_load - idle_load < self.rebalance_margin or \
+           (not force and busy_load < self.rebalance_threshold):
+            return 'balanced'
+        per_interface = busy_load / len(busiest.interfaces)
+        count = max(1, int((busy_load - idle_load) / 2 / per_interface))
+        count = min(count, len(busiest.interfaces) - 1)
+        moved = busiest.interfaces[-count:]
+        busiest.interfaces = busiest.interfaces[:-count]
+        idlest.interfaces = idlest.interfaces + moved
+        # Only the moved interfaces are removed and added, so the
+        # other interfaces of both workers keep their estimates.
+        for worker, command in ((busiest, 'remove_interfaces'), (idlest, 'add_interfaces')):
+            worker.commands.put((None, {command: ','.join(moved)}))
+            worker.load = None
+        print("Moved %s from worker %d to worker %d" % (','.join(moved), busiest.id, idlest.id))
+        return {'moved': moved, 'from': busiest.id, 'to': idlest.id}
+
+    # The shards of the workers, for the status and stats replies.
+    def shards(self):
+        shards = {}
+        for worker in self.workers:
+            shards[str(worker.id)] = {'interfaces': worker.interfaces,
+                                      'cores': worker.cores,
+                                      'pid': worker.pid,
+                                      'alive': worker.alive(),
+                                      'restarts': worker.restarts,
+                                      'load': self.worker_load(worker)}
+        return shards
+
+    def export_record(self, data):
+        self.ceilocomm.putMeter(self.meter_name, data, self.ceilocomm.authToken(),
+                                username=self.username,
+                                project_id=self.project_ID,
+                                resource_id=self.resource_ID)
+
+    def export_message(self, message):
+        now = datetime.now(tz=UTC())
+        self.exporter.put({message: now.strftime('%Y-%m-%dT%H:%M:%S')})
+
+    def main(self):
+        for worker in self.workers:
+            self.start_worker(worker)
+        self.conf_server = createConfServer(self.conflistener_IP, self.conflistenerport, self)
+        conflistener = Thread(target=self.conf_server.serve_forever)
+        conflistener.setDaemon(True)
+        conflistener.start()
+        self.export_message('initialized')
+        next_rebalance = monotonic() + self.rebalance_interval
+        try:
+            while not self.exit_flag:
+                self.handle_results(0.1)
+                while not self.config_queue.empty() and not self.exit_flag:
+                    self.handle_configuration()
+                if self.exit_flag:
+                    break
+                self.expire_requests()
+                self.check_workers()
+                if self.rebalance_interval > 0 and monotonic() >= next_rebalance:
+                    self.rebalance()
+                    next_rebalance = monotonic() + self.rebalance_interval
+            # Send the reply to the exit command before exiting.
+            self.conf_server.shutdown()
+            print('exit')
+        except KeyboardInterrupt:
+            self.exit()
+
+    def exit(self):
+        self.exit_flag = True
+        self.stop_workers(self.workers)
+        self.export_message('exited')
+        self.exporter.close()
+        self.ceilocomm.close()
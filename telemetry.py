@@ -0,0 +1,79 @@
+# Copyright 2016 SICS Swedish ICT AB
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The self-telemetry of the rate monitor: how long its stages take
+# (reading the counters, estimating, metering), and how much CPU time
+# the monitor process uses. The monitor reports these with the tick
+# statistics of the sampler (see scheduler.py) and the queue depths
+# in reply to the stats command (see Monitor.telemetry_stats).
+
+import os
+from clock import monotonic
+
+
+# The number of times a stage has run, and the time it took (in
+# seconds): the last, the mean and the longest.
+class StageTimer(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        self.last = elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def stats(self):
+        return {'count': self.count,
+                'last': self.last,
+                'mean': self.mean(),
+                'max': self.max}
+
+
+# The share of one CPU used by the process (all its threads, user and
+# system time), between two updates at least min_interval seconds
+# apart. The process times only have the resolution of the clock tick
+# (usually 10 ms), which is why shorter intervals are not measured.
+class CpuShare(object):
+    def __init__(self, min_interval=1.0, clock=monotonic):
+        self.min_interval = min_interval
+        self.clock = clock
+        self.share = 0.0
+        self.cpu = self.cpu_time()
+        self.wall = clock()
+
+    def cpu_time(self):
+        times = os.times()
+        return times[0] + times[1]
+
+    # Update the share if min_interval has passed since the last
+    # update, and return it.
+    def update(self):
+        wall = self.clock()
+        if wall - self.wall >= self.min_interval:
+            cpu = self.cpu_time()
+            self.share = (cpu - self.cpu) / (wall - self.wall)
+            self.cpu = cpu
+            self.wall = wall
+        return self.share